@@ -0,0 +1,201 @@
+"""Caches of loaded data shared by all processes on a machine.
+
+This module implements two caches:
+
+* a session cache in memory, which shares data loaded into memory between processes
+  (:func:`get_cache_key`)
+* a transform cache on disk, which stores transformed signals so that transforms only need to be
+  computed once (:func:`get_transform_cache_key`)
+
+Both caches store data with :func:`load_cached`.
+
+Session cache
+-------------
+
+When fitting many models in parallel (e.g. with the test-tube grid searches), each process builds
+its own data generator. If all data is loaded into memory (:obj:`batch_load=False`), every process
+holds a private copy of the same session. The functions in this module instead store each loaded
+(and transformed) signal once in a directory that is backed by memory, :obj:`/dev/shm` by
+default; the first process to request a signal populates the cache, and all processes then
+memory-map the cached data, so that the operating system shares a single copy between them.
+
+Cache entries are keyed by the data file (path, size and modification time), the signal name, the
+transform applied to the signal, and any other options that change the loaded data; entries
+become stale, rather than incorrect, when data files are updated. Entries are not deleted
+automatically; use :func:`clear_cache` to remove them.
+
+Transform cache
+---------------
+The transforms in :mod:`behavenet.data.transforms` (e.g. thresholding and selecting neurons) are
+otherwise recomputed every time a trial is loaded (:obj:`batch_load=True`) or every time a
+process starts (:obj:`batch_load=False`). The transform cache instead stores each transformed
+signal in a directory on disk and memory-maps it. Entries are content-addressed: the key combines
+a hash of the data file contents (see :func:`behavenet.data.storage.get_data_hash`) with the
+:obj:`repr` of the transform, so that entries remain valid when data files are copied or touched,
+and are shared by all models (e.g. all decoders in a grid search) that use the same signal and
+transform. Transforms must therefore include all of their parameters in their :obj:`repr`.
+
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from behavenet.data.storage import export_ragged
+from behavenet.data.storage import get_data_hash
+from behavenet.data.storage import get_ragged_paths
+from behavenet.data.storage import load_ragged
+from behavenet.data.storage import ragged_exists
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking on windows; concurrent processes may then populate the same entry, which is
+    # wasteful but safe since entries are written atomically
+    fcntl = None
+
+
+def get_default_cache_dir():
+    """Return the default cache directory.
+
+    Returns
+    -------
+    :obj:`str`
+        :obj:`/dev/shm/behavenet` if shared memory is available, else a directory in the system's
+        temporary directory
+
+    """
+    if os.path.isdir('/dev/shm'):
+        return os.path.join('/dev/shm', 'behavenet')
+    else:
+        return os.path.join(tempfile.gettempdir(), 'behavenet')
+
+
+def get_default_transform_cache_dir():
+    """Return the default transform cache directory.
+
+    Returns
+    -------
+    :obj:`str`
+        :obj:`$XDG_CACHE_HOME/behavenet/transforms`, where :obj:`$XDG_CACHE_HOME` defaults to
+        :obj:`~/.cache`
+
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME', None) or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'behavenet', 'transforms')
+
+
+def get_transform_cache_key(path, signal, transform, **kwargs):
+    """Compute the content-addressed transform cache key of a signal.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+    signal : :obj:`str`
+        signal name, e.g. 'images' | 'neural' | 'ae_latents'
+    transform : :obj:`behavenet.data.transforms.Transform`
+        transform applied to the signal; contributes to the key through its :obj:`repr`
+    kwargs : :obj:`dict`
+        other options that change the loaded data
+
+    Returns
+    -------
+    :obj:`str`
+
+    """
+    h = hashlib.sha1()
+    h.update(pickle.dumps((get_data_hash(path), signal, repr(transform), sorted(kwargs.items()))))
+    return 'transform_' + h.hexdigest()
+
+
+def get_cache_key(path, signal, transform=None, **kwargs):
+    """Compute the cache key of a signal.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+    signal : :obj:`str`
+        signal name, e.g. 'images' | 'neural' | 'ae_latents'
+    transform : :obj:`behavenet.data.transforms.Transform` or :obj:`NoneType`, optional
+        transform applied to the signal; the full state of the transform (e.g. the selected
+        indices of :class:`behavenet.data.transforms.SelectIdxs`) contributes to the key
+    kwargs : :obj:`dict`
+        other options that change the loaded data
+
+    Returns
+    -------
+    :obj:`str`
+
+    """
+    path = os.path.abspath(path)
+    # exported latents/states/predictions may be stored next to the requested file
+    files = [path]
+    if ragged_exists(path):
+        files += list(get_ragged_paths(path))
+    stats = []
+    for file in files:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            stats.append((file, stat.st_size, stat.st_mtime_ns))
+    h = hashlib.sha1()
+    h.update(pickle.dumps((stats, signal, sorted(kwargs.items()))))
+    h.update(pickle.dumps(transform))
+    return h.hexdigest()
+
+
+def load_cached(cache_dir, key, load_fn):
+    """Load a list of per-trial arrays from the cache, populating the cache if necessary.
+
+    Parameters
+    ----------
+    cache_dir : :obj:`str`
+        cache directory
+    key : :obj:`str`
+        cache key, see :func:`get_cache_key`
+    load_fn : :obj:`callable`
+        function without arguments that returns the data as a :obj:`list` of :obj:`np.ndarray`
+        (or a :obj:`behavenet.data.storage.RaggedArray`); only called if the data is not yet
+        cached
+
+    Returns
+    -------
+    :obj:`behavenet.data.storage.RaggedArray` object
+        copy-on-write memory-mapped cached data; pages are shared between processes until they are
+        written to
+
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + '.pkl')
+    if not ragged_exists(path):
+        with open(os.path.join(cache_dir, key + '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process may have populated the cache while we waited for the lock
+                if not ragged_exists(path):
+                    export_ragged(path, load_fn(), key=key)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+    ragged, _ = load_ragged(path, mmap_mode='c')
+    return ragged
+
+
+def clear_cache(cache_dir=None):
+    """Delete all cached data.
+
+    Parameters
+    ----------
+    cache_dir : :obj:`str` or :obj:`NoneType`, optional
+        cache directory; if :obj:`NoneType`, uses the default directory (see
+        :func:`get_default_cache_dir`)
+
+    """
+    if cache_dir is None:
+        cache_dir = get_default_cache_dir()
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
@@ -22,13 +22,32 @@ how to use the data generators.
 """
 
 from collections import OrderedDict
-import h5py
+import hashlib
+import inspect
 import numpy as np
 import os
 import pickle
 import torch
 from torch.utils import data
-from torch.utils.data import SubsetRandomSampler
+from torch.utils.data import Sampler
+from behavenet.data.cache import get_cache_key
+from behavenet.data.cache import get_transform_cache_key
+from behavenet.data.cache import load_cached
+from behavenet.data.storage import get_hdf5_file
+from behavenet.data.storage import get_hdf5_pool
+from behavenet.data.storage import get_data_hash
+from behavenet.data.storage import get_signal_metadata
+from behavenet.data.storage import load_ragged
+from behavenet.data.storage import load_transform_stats
+from behavenet.data.storage import RaggedArray
+from behavenet.data.storage import ragged_exists
+from behavenet.data.storage import read_trial
+from behavenet.data.storage import save_transform_stats
+from behavenet.data.transforms import Compose
+from behavenet.data.transforms import FitTransform
+
+# persistent workers/prefetching are only available in newer versions of pytorch (>=1.7)
+_LOADER_PERSISTENT = 'persistent_workers' in inspect.signature(data.DataLoader).parameters
 
 
 def split_trials(n_trials, rng_seed=0, train_tr=8, val_tr=1, test_tr=1, gap_tr=0):
@@ -90,6 +109,44 @@ def split_trials(n_trials, rng_seed=0, train_tr=8, val_tr=1, test_tr=1, gap_tr=0
     return batch_idxs
 
 
+def get_frame_windows(n_frames, frame_window, pad=0):
+    """Tile a trial with windows containing a fixed number of frames.
+
+    Each window consists of a core of :obj:`frame_window - 2 * pad` frames, plus :obj:`pad` frames
+    on either side; for decoders these padding frames provide the lagged inputs needed to predict
+    the core frames, and are not themselves scored by the loss. The cores of consecutive windows
+    tile the frames :obj:`[pad, n_frames - pad)` of the trial. The last window is shifted back to
+    end at the last frame of the trial so that all windows have the same size; its core then
+    overlaps that of the previous window. Trials with no more than :obj:`frame_window` frames are
+    returned as a single window.
+
+    Parameters
+    ----------
+    n_frames : :obj:`int`
+        number of frames in trial
+    frame_window : :obj:`int`
+        number of frames in each window, including padding
+    pad : :obj:`int`, optional
+        number of padding frames on either side of each window
+
+    Returns
+    -------
+    :obj:`np.ndarray`
+        array of shape (n_windows, 2); each row contains the first frame and one past the last
+        frame of a window
+
+    """
+    core = frame_window - 2 * pad
+    if core <= 0:
+        raise ValueError(
+            'frame_window=%i must be larger than twice the padding (%i)' % (frame_window, pad))
+    if n_frames <= frame_window:
+        return np.array([[0, n_frames]], dtype=np.int64)
+    begs = np.arange(0, n_frames - 2 * pad, core)
+    begs = np.minimum(begs, n_frames - frame_window)
+    return np.stack([begs, begs + frame_window], axis=1).astype(np.int64)
+
+
 def _load_pkl_dict(path, key, idx=None, dtype='float32'):
     """Helper function to load pickled data.
 
@@ -121,12 +178,134 @@ def _load_pkl_dict(path, key, idx=None, dtype='float32'):
     return samp
 
 
+def images_to_float(images):
+    """Convert frames stored as uint8 to float32 values in [0, 1].
+
+    The conversion is performed wherever the data lives, so that uint8 frames can be moved to the
+    gpu before being converted. Frames that are not uint8 are returned unchanged.
+
+    Parameters
+    ----------
+    images : :obj:`torch.Tensor` or :obj:`np.ndarray`
+        frames of any shape
+
+    Returns
+    -------
+    :obj:`torch.Tensor` or :obj:`np.ndarray`
+        same type as input
+
+    """
+    if isinstance(images, torch.Tensor):
+        if images.dtype == torch.uint8:
+            return images.float().div_(255)
+    elif isinstance(images, np.ndarray):
+        if images.dtype == np.uint8:
+            return images.astype('float32') / 255
+    return images
+
+
+def _worker_init_fn(worker_id):
+    """Initialize a data loader worker process.
+
+    Closes hdf5 handles inherited from the parent process so that each worker reads from its own
+    handles, and seeds numpy from the worker's torch seed; the latter is set by the data loader
+    from the global torch seed, so that workers are reproducible but not identical.
+
+    Parameters
+    ----------
+    worker_id : :obj:`int`
+        id of worker process
+
+    """
+    get_hdf5_pool().close()
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+class OrderedSubsetSampler(Sampler):
+    """Sample elements from a list of indices, in order.
+
+    The indices can be replaced between epochs; this allows the trial order to be chosen in the
+    main process (see :meth:`ConcatSessionsGenerator.reset_iterators`) while reusing persistent
+    data loader workers.
+
+    """
+
+    def __init__(self, indices):
+        """
+
+        Parameters
+        ----------
+        indices : :obj:`array-like`
+            trial indices to sample from, or array of shape (n, 3) whose rows contain the trial
+            index, first frame and one past the last frame of a window
+
+        """
+        self.indices = indices
+
+    def __iter__(self):
+        if np.ndim(self.indices) == 2:
+            # windows of frames, see ConcatSessionsGenerator.set_frame_window
+            return (tuple(int(j) for j in i) for i in self.indices)
+        return (int(i) for i in self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class ScheduleSampler(Sampler):
+    """Sample (session, trial) pairs of several sessions in the order of a schedule.
+
+    The session of each batch is given by the schedule, and its trial (or window of frames) by the
+    next element of that session's :class:`OrderedSubsetSampler`. This allows a single data loader
+    (and a single pool of worker processes) to serve all sessions.
+
+    """
+
+    def __init__(self, samplers):
+        """
+
+        Parameters
+        ----------
+        samplers : :obj:`list` of :obj:`OrderedSubsetSampler`
+            one sampler per session
+
+        """
+        self.samplers = samplers
+        self.sessions = np.array([], dtype=np.int64)
+
+    def __iter__(self):
+        iters = [iter(sampler) for sampler in self.samplers]
+        return ((int(i), next(iters[i])) for i in self.sessions)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class _SessionsDataset(data.Dataset):
+    """Index the datasets of several sessions with (session, trial) pairs."""
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    def __len__(self):
+        return int(np.sum([len(dataset) for dataset in self.datasets]))
+
+    def __getitem__(self, idx):
+        return self.datasets[idx[0]][idx[1]]
+
+
 class SingleSessionDatasetBatchedLoad(data.Dataset):
     """Dataset class for a single session with batch loading of data."""
 
+    # keys of exported latents/states/predictions, indexed by signal
+    _export_keys = {
+        'ae_latents': 'latents', 'ae_predictions': 'predictions', 'arhmm': 'states',
+        'arhmm_states': 'states', 'arhmm_predictions': 'predictions'}
+
     def __init__(
             self, data_dir, lab='', expt='', animal='', session='', signals=None, transforms=None,
-            paths=None, device='cpu', as_numpy=False):
+            paths=None, device='cpu', as_numpy=False, images_as_uint8=False,
+            transform_cache_dir=None):
         """
 
         Parameters
@@ -155,6 +334,13 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
             location of data; options are :obj:`cpu | cuda`
         as_numpy : bool
             if :obj:`True` return data as a numpy array, else return as a torch tensor
+        images_as_uint8 : :obj:`bool`, optional
+            if :obj:`True` return images as uint8 values in [0, 255] rather than float32 values in
+            [0, 1]; see :func:`images_to_float` for converting these on the compute device
+        transform_cache_dir : :obj:`str` or :obj:`NoneType`, optional
+            if not :obj:`NoneType`, transformed signals are computed once for all trials, stored
+            in this directory, and memory-mapped (see :mod:`behavenet.data.cache`); signals
+            without transforms are not cached
 
         """
 
@@ -176,23 +362,21 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
             self.transforms[signal] = transform
             self.paths[signal] = path
 
-        # get total number of trials by loading images/neural data
+        # memory-mapped latents/states/predictions, indexed by signal
+        self._ragged = {}
+        # number of trials, trial lengths, etc. indexed by signal; see get_metadata
+        self._metadata = {}
+        # memory-mapped transformed signals, indexed by signal; see _load_transformed
+        self.transform_cache_dir = transform_cache_dir
+        self._transformed = {}
+
+        # get total number of trials from images/neural data
         self.n_trials = None
-        for i, signal in enumerate(signals):
-            if signal == 'images' or signal == 'neural' or signal == 'labels':
-                data_file = paths[i]
-                with h5py.File(data_file, 'r', libver='latest', swmr=True) as f:
-                    self.n_trials = len(f[signal])
-                    break
-            elif signal == 'ae_latents':
-                try:
-                    latents = _load_pkl_dict(self.paths[signal], 'latents') #[0]
-                except FileNotFoundError:
-                    raise NotImplementedError(
-                        ('Could not open %s\nMust create ae latents from model;' +
-                         ' currently not implemented') % self.paths[signal])
-
-                self.n_trials = len(latents)
+        for signal in signals:
+            if signal == 'images' or signal == 'neural' or signal == 'labels' \
+                    or signal == 'ae_latents':
+                self.n_trials = self.get_metadata(signal)['n_trials']
+                break
 
         # meta data about train/test/xv splits; set by ConcatSessionsGenerator
         self.batch_idxs = None
@@ -200,6 +384,7 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
 
         self.device = device
         self.as_numpy = as_numpy
+        self.images_as_uint8 = images_as_uint8
 
     def __str__(self):
         """Pretty printing of dataset info"""
@@ -212,13 +397,22 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
     def __len__(self):
         return self.n_trials
 
+    def __getstate__(self):
+        # memory-mapped stores are reopened on first access rather than copied into data loader
+        # worker processes
+        state = self.__dict__.copy()
+        state['_ragged'] = {}
+        state['_transformed'] = {}
+        return state
+
     def __getitem__(self, idx):
         """Return batch of data; if idx is None, return all data
 
         Parameters
         ----------
-        idx : :obj:`int` or :obj:`NoneType`
-            trial index to load; if :obj:`NoneType`, return all data.
+        idx : :obj:`int` or :obj:`tuple` or :obj:`NoneType`
+            trial index to load; if :obj:`tuple`, of the form (trial, frame_beg, frame_end) to
+            load a window of frames from a single trial; if :obj:`NoneType`, return all data.
 
         Returns
         -------
@@ -230,80 +424,22 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
         if idx is None and not self.as_numpy:
             raise NotImplementedError('Cannot currently load all data as torch tensors')
 
+        if isinstance(idx, tuple):
+            idx, frames = idx[0], slice(idx[1], idx[2])
+        else:
+            frames = None
+
         sample = OrderedDict()
         for signal in self.signals:
 
-            # index correct trial
-            if signal == 'images':
-                dtype = 'float32'
-                with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
-                    if idx is None:
-                        print('Warning: loading all images!')
-                        temp_data = []
-                        for tr in range(self.n_trials):
-                            temp_data.append(f[signal][str(
-                                'trial_%04i' % tr)][()].astype(dtype) / 255)
-                        sample[signal] = temp_data
-                    else:
-                        sample[signal] = [f[signal][str(
-                            'trial_%04i' % idx)][()].astype(dtype) / 255]
-
-            elif signal == 'masks':
-                dtype = 'float32'
-                with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
-                    if idx is None:
-                        print('Warning: loading all masks!')
-                        temp_data = []
-                        for tr in range(self.n_trials):
-                            temp_data.append(f[signal][str(
-                                'trial_%04i' % tr)][()].astype(dtype))
-                        sample[signal] = temp_data
-                    else:
-                        sample[signal] = f[signal][str('trial_%04i' % idx)][()].astype(dtype)
-
-            elif signal == 'neural' or signal == 'labels':
-                dtype = 'float32'
-                with h5py.File(self.paths[signal], 'r', libver='latest', swmr=True) as f:
-                    if idx is None:
-                        temp_data = []
-                        for tr in range(self.n_trials):
-                            temp_data.append(f[signal][str(
-                                'trial_%04i' % tr)][()].astype(dtype))
-                        sample[signal] = temp_data
-                    else:
-                        sample[signal] = [f[signal][str('trial_%04i' % idx)][()].astype(dtype)]
-
-            elif signal == 'ae_latents':
-                dtype = 'float32'
-                sample[signal] = self._try_to_load(
-                    signal, key='latents', idx=idx, dtype=dtype)
-
-            elif signal == 'ae_predictions':
-                dtype = 'float32'
-                sample[signal] = self._try_to_load(
-                    signal, key='predictions', idx=idx, dtype=dtype)
-
-            elif signal == 'arhmm' or signal == 'arhmm_states':
-                dtype = 'int32'
-                sample[signal] = self._try_to_load(
-                    signal, key='states', idx=idx, dtype=dtype)
-
-            elif signal == 'arhmm_predictions':
-                dtype = 'float32'
-                sample[signal] = self._try_to_load(
-                    signal, key='predictions', idx=idx, dtype=dtype)
-
-            else:
-                raise ValueError('"%s" is an invalid signal type' % signal)
-
-            # apply transforms
-            if self.transforms[signal]:
-                sample[signal] = [self.transforms[signal](samp) for samp in sample[signal]]
+            sample[signal], dtype = self._load_signal(signal, idx, frames)
 
             # transform into tensor
             if not self.as_numpy:
                 if dtype == 'float32':
                     sample[signal] = torch.from_numpy(sample[signal][0]).float()
+                elif dtype == 'uint8':
+                    sample[signal] = torch.from_numpy(sample[signal][0])
                 else:
                     sample[signal] = torch.from_numpy(sample[signal][0]).long()
 
@@ -311,25 +447,289 @@ class SingleSessionDatasetBatchedLoad(data.Dataset):
 
         return sample
 
-    def _try_to_load(self, signal, key, idx, dtype):
-        # try:
-        #     data = _load_pkl_dict(self.paths[signal], key, idx=idx, dtype=dtype)
-        # except FileNotFoundError:
-        #     # try prepending session string
-        #     try:
-        #         self.paths[signal] = _prepend_sess_id(self.paths[signal], self.sess_str)
-        #         data = _load_pkl_dict(self.paths[signal], key, idx=idx, dtype=dtype)
-        #     except FileNotFoundError:
-        #         raise NotImplementedError(
-        #             ('Could not open %s\nMust create %s from model;' +
-        #              ' currently not implemented') % (self.paths[signal], key))
+    def _load_signal(self, signal, idx, frames=None):
+        """Load and transform trial(s) of a single signal.
+
+        If a transform cache is used, transformed signals are served from the cache; otherwise
+        data is read and transformed on every call (see :meth:`_read_signal`).
+
+        Parameters
+        ----------
+        signal : :obj:`str`
+            signal name, see :obj:`signals` input to class
+        idx : :obj:`int` or :obj:`NoneType`
+            trial index to load; if :obj:`NoneType`, load all trials
+        frames : :obj:`slice` or :obj:`NoneType`, optional
+            if not :obj:`NoneType`, only return these frames from the trial
+
+        Returns
+        -------
+        :obj:`tuple`
+            - data (:obj:`list` of :obj:`np.ndarray`)
+            - dtype (:obj:`str`): data type before transforms are applied
+
+        """
+        if self.transforms[signal] and self.transform_cache_dir is not None:
+            data = self._load_transformed(signal)
+            if idx is None:
+                data = data.to_list()
+            else:
+                data = [np.array(data[idx][() if frames is None else frames])]
+            return data, self._get_dtype(signal)
+        else:
+            return self._read_signal(signal, idx, frames)
+
+    def _read_signal(self, signal, idx, frames=None, transform=True):
+        """Read and transform trial(s) of a single signal, bypassing the transform cache.
+
+        See :meth:`_load_signal` for parameters and return values; if :obj:`transform=False`,
+        data is returned without applying transforms.
+
+        """
+        dtype = self._get_dtype(signal)
+
+        # transforms may depend on all frames of a trial (e.g. z-scoring); in this case load
+        # the full trial and select the window of frames after transforming
+        if self.transforms[signal] and transform:
+            frames_ = None
+        else:
+            frames_ = frames
+
+        # index correct trial
+        if signal == 'images':
+            if idx is None:
+                print('Warning: loading all images!')
+            if self.images_as_uint8:
+                data = self._load_hdf5(signal, idx, dtype, frames=frames_)
+            else:
+                data = self._load_hdf5(signal, idx, dtype, scale=255, frames=frames_)
+
+        elif signal == 'masks':
+            if idx is None:
+                print('Warning: loading all masks!')
+            data = self._load_hdf5(signal, idx, dtype, frames=frames_)
+
+        elif signal == 'neural' or signal == 'labels':
+            data = self._load_hdf5(signal, idx, dtype, frames=frames_)
+
+        elif signal in self._export_keys:
+            data = self._try_to_load(
+                signal, key=self._export_keys[signal], idx=idx, dtype=dtype, frames=frames_)
+
+        else:
+            raise ValueError('"%s" is an invalid signal type' % signal)
+
+        # apply transforms
+        if self.transforms[signal] and transform:
+            data = [self.transforms[signal](samp) for samp in data]
+            if frames is not None:
+                data = [samp[frames] for samp in data]
+
+        return data, dtype
+
+    def fit_transforms(self, idxs):
+        """Fit transforms that depend on statistics of the data (e.g. z-scoring) to a set of trials.
+
+        Statistics are computed in a single pass over the requested trials, one trial at a time,
+        and stored in a sidecar file next to the data file (see
+        :func:`behavenet.data.storage.save_transform_stats`); later calls with the same data,
+        transforms and trials load the stored statistics instead. For chains of transforms, each
+        transform is fit to the output of the preceding transforms. Transforms that are already
+        fit are not refit.
+
+        Parameters
+        ----------
+        idxs : :obj:`array-like`
+            trial indices, usually the training trials of the session
+
+        Returns
+        -------
+        :obj:`list` of :obj:`str`
+            signals whose transforms were fit
+
+        """
+        idxs = [int(i) for i in idxs]
+        fit_signals = []
+        for signal, transform in self.transforms.items():
+            if transform is None:
+                continue
+            transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+            for i, t in enumerate(transforms):
+                if not isinstance(t, FitTransform) or t.is_fitted:
+                    continue
+                preceding = Compose(transforms[:i])
+                key = hashlib.sha1(repr((
+                    get_data_hash(self.paths[signal]), signal, self._get_dtype(signal),
+                    repr(preceding), repr(t), idxs)).encode()).hexdigest()
+                stats = load_transform_stats(self.paths[signal], key)
+                if stats is not None:
+                    t.set_stats(stats)
+                else:
+                    t.fit(preceding(self._read_signal(signal, idx, transform=False)[0][0])
+                          for idx in idxs)
+                    save_transform_stats(self.paths[signal], key, t.get_stats())
+                if signal not in fit_signals:
+                    fit_signals.append(signal)
+        # transformed signals that were cached before the transforms were fit are stale
+        for signal in fit_signals:
+            self._transformed.pop(signal, None)
+        return fit_signals
+
+    def _needs_fit(self, signal):
+        """Check whether the transform of a signal contains transforms that are not yet fit."""
+        transform = self.transforms[signal]
+        transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+        return any(isinstance(t, FitTransform) and not t.is_fitted for t in transforms)
+
+    def _get_dtype(self, signal):
+        """Return the numpy data type a signal is loaded as, before transforms are applied."""
+        if signal == 'images' and self.images_as_uint8:
+            return 'uint8'
+        elif signal == 'arhmm' or signal == 'arhmm_states':
+            return 'int32'
+        else:
+            return 'float32'
+
+    def _load_transformed(self, signal):
+        """Return all transformed trials of a signal from the transform cache.
+
+        On a cache miss all trials are loaded, transformed and stored; afterwards data is
+        memory-mapped from the cache and returned as a :class:`behavenet.data.storage.RaggedArray`.
+
+        """
+        if signal not in self._transformed:
+            transform = self.transforms[signal]
+            key = get_transform_cache_key(
+                self.paths[signal], signal, transform, dtype=self._get_dtype(signal))
+            self._transformed[signal] = load_cached(
+                self.transform_cache_dir, key, lambda: self._read_signal(signal, idx=None)[0])
+        return self._transformed[signal]
+
+    def get_metadata(self, signal):
+        """Return the number of trials, trial lengths, and the shape/dtype of a stored signal.
+
+        Metadata is read from a small sidecar file written next to the data file on first access,
+        so that constructing a dataset does not require reading the data itself; see
+        :func:`behavenet.data.storage.get_signal_metadata` for details. Note that shapes and
+        dtypes refer to the stored data, before transforms are applied.
+
+        Parameters
+        ----------
+        signal : :obj:`str`
+            signal name, see :obj:`signals` input to class
+
+        Returns
+        -------
+        :obj:`dict`
+            keys are 'n_trials', 'lengths', 'shape', 'dtype'
+
+        """
+        if signal not in self._metadata:
+            key = self._export_keys.get(signal, None)
+            try:
+                self._metadata[signal] = get_signal_metadata(self.paths[signal], signal, key=key)
+            except FileNotFoundError:
+                raise NotImplementedError(
+                    ('Could not open %s\nMust create %s from model;' +
+                     ' currently not implemented') % (self.paths[signal], signal))
+        return self._metadata[signal]
+
+    def get_signal_shape(self, signal):
+        """Return the shape of a single time point of a signal, after transforms are applied.
+
+        Parameters
+        ----------
+        signal : :obj:`str`
+            signal name, see :obj:`signals` input to class
+
+        Returns
+        -------
+        :obj:`tuple`
+
+        """
+        metadata = self.get_metadata(signal)
+        if not self.transforms[signal]:
+            return metadata['shape']
+        # transforms may change the shape; load a single (non-empty) trial to find out
+        idx = int(np.argmax(metadata['lengths'] > 0))
+        return self._load_signal(signal, idx)[0][0].shape[1:]
+
+    def get_n_frames(self, idx):
+        """Return the number of frames in a trial, without reading any data.
+
+        Parameters
+        ----------
+        idx : :obj:`int`
+            trial index
+
+        Returns
+        -------
+        :obj:`int`
+
+        """
+        return int(self.get_metadata(self.signals[0])['lengths'][idx])
+
+    def _load_hdf5(self, signal, idx, dtype, scale=None, frames=None):
+        """Load trial(s) of a signal stored in an hdf5 file.
+
+        The file handle is taken from the process-wide :class:`behavenet.data.storage.HDF5FilePool`
+        so that the file is not reopened for every trial and signal. Both the per-trial and the
+        packed layout are supported; see :func:`behavenet.data.storage.read_trial`.
+
+        Parameters
+        ----------
+        signal : :obj:`str`
+            hdf5 group name, e.g. 'images' | 'masks' | 'neural' | 'labels'
+        idx : :obj:`int` or :obj:`NoneType`
+            trial index to load; if :obj:`NoneType`, load all trials
+        dtype : :obj:`str`
+            numpy data type of returned data
+        scale : :obj:`float` or :obj:`NoneType`, optional
+            if not :obj:`NoneType`, data is divided by this value
+        frames : :obj:`slice` or :obj:`NoneType`, optional
+            if not :obj:`NoneType`, only read these frames from the trial
+
+        Returns
+        -------
+        :obj:`list` of :obj:`numpy.ndarray`
+
+        """
+        group = get_hdf5_file(self.paths[signal])[signal]
+        idxs = range(self.n_trials) if idx is None else [idx]
+        samp = []
+        for tr in idxs:
+            data = read_trial(group, tr, frames=frames).astype(dtype, copy=False)
+            if scale is not None:
+                data /= scale
+            samp.append(data)
+        return samp
+
+    def _get_ragged(self, signal):
+        """Return the memory-mapped indexed store of a signal, loading it on first access."""
+        if signal not in self._ragged:
+            self._ragged[signal], _ = load_ragged(self.paths[signal])
+        return self._ragged[signal]
+
+    def _try_to_load(self, signal, key, idx, dtype, frames=None):
+        """Load trial(s) of exported latents/states/predictions.
+
+        Data is read from the indexed store written by the export functions in
+        :mod:`behavenet.fitting.eval`, which only touches the requested trial; legacy pickle files
+        are read if no indexed store exists.
+
+        """
+        frames = slice(None) if frames is None else frames
+        if signal in self._ragged or ragged_exists(self.paths[signal]):
+            ragged = self._get_ragged(signal)
+            idxs = range(len(ragged)) if idx is None else [idx]
+            return [np.array(ragged[i][frames], dtype=dtype) for i in idxs]
         try:
             data = _load_pkl_dict(self.paths[signal], key, idx=idx, dtype=dtype)
         except FileNotFoundError:
             raise NotImplementedError(
                 ('Could not open %s\nMust create %s from model;' +
                  ' currently not implemented') % (self.paths[signal], key))
-        return data
+        return [d[frames] for d in data]
 
 
 class SingleSessionDataset(SingleSessionDatasetBatchedLoad):
@@ -337,17 +737,19 @@ class SingleSessionDataset(SingleSessionDatasetBatchedLoad):
 
     Loads all data during Dataset creation and saves as an attribute. Batches are then sampled from
     this stored data. All data transformations are applied to the full dataset upon load, *not*
-    for each batch. This automatically returns data as lists of numpy arrays.
+    for each batch.
 
-    Note
-    ----
-    This data loader cannot be used to fit pytorch models, only ssm models.
+    Each signal is stored as a :class:`behavenet.data.storage.RaggedArray`, i.e. a single
+    contiguous array of all trials plus trial offsets, and trials are served as views into this
+    array. If :obj:`as_numpy=False` the array is stored as a single torch tensor, optionally in
+    page-locked memory (:obj:`pin_memory=True`).
 
     """
 
     def __init__(
             self, data_dir, lab='', expt='', animal='', session='', signals=None, transforms=None,
-            paths=None, device='cuda', as_numpy=False):
+            paths=None, device='cuda', as_numpy=False, images_as_uint8=False, cache_dir=None,
+            transform_cache_dir=None, pin_memory=False):
         """
 
         Parameters
@@ -374,15 +776,35 @@ class SingleSessionDataset(SingleSessionDatasetBatchedLoad):
             of data
         device : :obj:`str`, optional
             location of data; options are :obj:`cpu | cuda`
+        as_numpy : bool
+            if :obj:`True` return data as a numpy array, else return as a torch tensor
+        images_as_uint8 : :obj:`bool`, optional
+            if :obj:`True` store images as uint8 values in [0, 255], which requires 4x less memory
+            than float32 values in [0, 1]
+        cache_dir : :obj:`str` or :obj:`NoneType`, optional
+            if not :obj:`NoneType`, load data through a cache in this directory that is shared by
+            all processes on the machine (see :mod:`behavenet.data.cache`)
+        transform_cache_dir : :obj:`str` or :obj:`NoneType`, optional
+            if not :obj:`NoneType`, transformed signals are stored in this directory so that
+            transforms are only computed once (see :mod:`behavenet.data.cache`)
+        pin_memory : :obj:`bool`, optional
+            if :obj:`as_numpy=False`, :obj:`True` to store data in page-locked memory, which
+            speeds up transfers to the gpu
 
         """
 
-        super().__init__(data_dir, lab, expt, animal, session, signals, transforms, paths, device)
+        super().__init__(
+            data_dir, lab, expt, animal, session, signals, transforms, paths, device,
+            images_as_uint8=images_as_uint8, transform_cache_dir=transform_cache_dir)
 
-        # grab all data as a single batch
+        # grab all data as a single batch; signals with transforms that still need to be fit
+        # (see fit_transforms) are loaded once they are fit, or on first access
         self.as_numpy = as_numpy
-        self.data = super(SingleSessionDataset, self).__getitem__(idx=None)
-        _ = self.data.pop('batch_idx')
+        self.cache_dir = cache_dir
+        self.pin_memory = pin_memory
+        self.data = OrderedDict()
+        for signal in self.signals:
+            self.data[signal] = None if self._needs_fit(signal) else self._preload(signal)
 
         # collect dims for easy reference
         # self.dims = OrderedDict()
@@ -395,13 +817,50 @@ class SingleSessionDataset(SingleSessionDatasetBatchedLoad):
     def __len__(self):
         return self.n_trials
 
+    def _preload(self, signal):
+        """Load all trials of a signal into a single array, through a cache if requested."""
+        if self.cache_dir is not None:
+            key = get_cache_key(
+                self.paths[signal], signal, self.transforms[signal],
+                images_as_uint8=self.images_as_uint8)
+            data = load_cached(
+                self.cache_dir, key, lambda: self._load_signal(signal, idx=None)[0])
+        elif self.transforms[signal] and self.transform_cache_dir is not None:
+            data = self._load_transformed(signal)
+        else:
+            data = RaggedArray.from_list(self._load_signal(signal, idx=None)[0])
+        if not self.as_numpy:
+            # same tensor types as SingleSessionDatasetBatchedLoad.__getitem__
+            dtype = self._get_dtype(signal)
+            if dtype == 'float32':
+                torch_dtype = torch.float32
+            elif dtype == 'uint8':
+                torch_dtype = torch.uint8
+            else:
+                torch_dtype = torch.int64
+            data = data.to_torch(dtype=torch_dtype, pin_memory=self.pin_memory)
+        return data
+
+    def fit_transforms(self, idxs):
+        """Fit transforms to a set of trials and load the transformed signals.
+
+        See :meth:`SingleSessionDatasetBatchedLoad.fit_transforms` for parameters and return
+        values.
+
+        """
+        fit_signals = super().fit_transforms(idxs)
+        for signal in fit_signals:
+            self.data[signal] = self._preload(signal)
+        return fit_signals
+
     def __getitem__(self, idx):
         """Return batch of data.
 
         Parameters
         ----------
-        idx : :obj:`int` or :obj:`NoneType`
-            trial index to load; if :obj:`NoneType`, return all data.
+        idx : :obj:`int` or :obj:`tuple`
+            trial index to load; if :obj:`tuple`, of the form (trial, frame_beg, frame_end) to
+            load a window of frames from a single trial
 
         Returns
         -------
@@ -410,9 +869,20 @@ class SingleSessionDataset(SingleSessionDatasetBatchedLoad):
 
         """
 
+        if isinstance(idx, tuple):
+            idx, frames = idx[0], slice(idx[1], idx[2])
+        else:
+            frames = slice(None)
+
         sample = OrderedDict()
         for signal in self.signals:
-            sample[signal] = [self.data[signal][idx]]
+            if self.data[signal] is None:
+                self.data[signal] = self._preload(signal)
+            # same format as SingleSessionDatasetBatchedLoad.__getitem__
+            if self.as_numpy:
+                sample[signal] = [self.data[signal][idx][frames]]
+            else:
+                sample[signal] = self.data[signal][idx][frames]
 
         sample['batch_idx'] = idx
         return sample
@@ -430,7 +900,9 @@ class ConcatSessionsGenerator(object):
     def __init__(
             self, data_dir, ids_list, signals_list=None, transforms_list=None, paths_list=None,
             device='cuda', as_numpy=False, batch_load=True, rng_seed=0, trial_splits=None,
-            train_frac=1.0):
+            train_frac=1.0, num_workers=0, pin_memory=False, persistent_workers=True,
+            prefetch_factor=2, images_as_uint8=False, session_cache_dir=None,
+            transform_cache_dir=None):
         """
 
         Parameters
@@ -463,6 +935,35 @@ class ConcatSessionsGenerator(object):
             if :obj:`0 < train_frac < 1.0`, defines the fraction of assigned training trials to
             actually use; if :obj:`train_frac > 1.0`, defines the number of assigned training
             trials to actually use
+        num_workers : :obj:`int`, optional
+            number of worker processes used to load data for each data type; the workers of a data
+            type are shared by all sessions, so that at most :obj:`3 * num_workers` worker
+            processes (train, val and test) exist at any time, independently of the number of
+            sessions. Test workers are not persistent and exit once all test data has been served.
+            Each worker holds a (copy-on-write) copy of all datasets. If :obj:`0`, data is loaded
+            in the main process
+        pin_memory : :obj:`bool`, optional
+            :obj:`True` to load data into page-locked memory, which speeds up transfers to the gpu;
+            if :obj:`batch_load=False` and :obj:`as_numpy=False`, stored data is also kept in
+            page-locked memory
+        persistent_workers : :obj:`bool`, optional
+            :obj:`True` to keep train/val worker processes alive between epochs; only used if
+            :obj:`num_workers > 0` (requires pytorch>=1.7)
+        prefetch_factor : :obj:`int`, optional
+            number of trials loaded in advance by each worker; only used if
+            :obj:`num_workers > 0` (requires pytorch>=1.7)
+        images_as_uint8 : :obj:`bool`, optional
+            if :obj:`True` serve images as uint8 values in [0, 255] rather than float32 values in
+            [0, 1]; this reduces memory usage and host-to-gpu transfers by 4x. Use
+            :func:`images_to_float` to convert images on the compute device
+        session_cache_dir : :obj:`str` or :obj:`NoneType`, optional
+            if not :obj:`NoneType` and :obj:`batch_load=False`, data is loaded through a cache in
+            this directory that is shared by all processes on the machine, so that parallel model
+            fits share a single in-memory copy of each session (see :mod:`behavenet.data.cache`)
+        transform_cache_dir : :obj:`str` or :obj:`NoneType`, optional
+            if not :obj:`NoneType`, transformed signals are stored in this directory on disk so
+            that transforms are only computed once across all processes and model fits (see
+            :mod:`behavenet.data.cache`)
 
         """
         if isinstance(ids_list, dict):
@@ -473,8 +974,12 @@ class ConcatSessionsGenerator(object):
         self.batch_load = batch_load
         if self.batch_load:
             SingleSession = SingleSessionDatasetBatchedLoad
+            dataset_kwargs = {'transform_cache_dir': transform_cache_dir}
         else:
             SingleSession = SingleSessionDataset
+            dataset_kwargs = {
+                'cache_dir': session_cache_dir, 'transform_cache_dir': transform_cache_dir,
+                'pin_memory': pin_memory}
 
         self.datasets = []
         self.datasets_info = []
@@ -487,7 +992,8 @@ class ConcatSessionsGenerator(object):
             self.datasets.append(SingleSession(
                 data_dir, lab=ids['lab'], expt=ids['expt'], animal=ids['animal'],
                 session=ids['session'], signals=signals, transforms=transforms, paths=paths,
-                device=device, as_numpy=self.as_numpy))
+                device=device, as_numpy=self.as_numpy, images_as_uint8=images_as_uint8,
+                **dataset_kwargs))
             self.datasets_info.append({
                 'lab': ids['lab'], 'expt': ids['expt'], 'animal': ids['animal'],
                 'session': ids['session']})
@@ -523,6 +1029,9 @@ class ConcatSessionsGenerator(object):
                         dataset.batch_idxs[dtype] = dataset.batch_idxs[dtype][idxs_rand]
                     self.batch_ratios[i] = len(dataset.batch_idxs[dtype])
                 dataset.n_batches[dtype] = len(dataset.batch_idxs[dtype])
+            # fit transforms that depend on statistics of the data (e.g. z-scoring) to the
+            # training trials, so that all trials are transformed with the same statistics
+            dataset.fit_transforms(dataset.batch_idxs['train'])
         self.batch_ratios = np.array(self.batch_ratios) / np.sum(self.batch_ratios)
 
         # find total number of batches per data type; this will be iterated over in the train loop
@@ -531,24 +1040,53 @@ class ConcatSessionsGenerator(object):
             self.n_tot_batches[dtype] = np.sum(
                 [dataset.n_batches[dtype] for dataset in self.datasets])
 
-        # create data loaders (will shuffle/batch/etc datasets)
-        self.dataset_loaders = [None] * self.n_datasets
+        # trial order within each session is set by the per-session samplers, session order by
+        # the schedule samplers
+        self.dataset_samplers = [None] * self.n_datasets
         for i, dataset in enumerate(self.datasets):
-            self.dataset_loaders[i] = {}
+            self.dataset_samplers[i] = {}
             for dtype in self._dtypes:
-                self.dataset_loaders[i][dtype] = torch.utils.data.DataLoader(
-                    dataset,
-                    batch_size=1,
-                    sampler=SubsetRandomSampler(dataset.batch_idxs[dtype]),
-                    num_workers=0,
-                    pin_memory=False)
-
-        # create all iterators (will iterate through data loaders)
-        self.dataset_iters = [None] * self.n_datasets
-        for i in range(self.n_datasets):
-            self.dataset_iters[i] = {}
-            for dtype in self._dtypes:
-                self.dataset_iters[i][dtype] = iter(self.dataset_loaders[i][dtype])
+                self.dataset_samplers[i][dtype] = OrderedSubsetSampler(dataset.batch_idxs[dtype])
+        self.schedule_samplers = {
+            dtype: ScheduleSampler([samplers[dtype] for samplers in self.dataset_samplers])
+            for dtype in self._dtypes}
+
+        # create one data loader for each data type, shared by all sessions, so that the number of
+        # worker processes does not grow with the number of sessions
+        self.num_workers = num_workers
+        # numpy data loaded in the main process is served directly from the datasets, without
+        # data loaders (see next_batch)
+        self.serve_numpy = self.as_numpy and num_workers == 0
+        self.data_loaders = {}
+        for dtype in self._dtypes:
+            if self.serve_numpy:
+                self.data_loaders[dtype] = None
+                continue
+            loader_kwargs = {}
+            if num_workers > 0:
+                loader_kwargs['worker_init_fn'] = _worker_init_fn
+            if num_workers > 0 and _LOADER_PERSISTENT:
+                # test data is only loaded once, no need to keep workers around
+                loader_kwargs['persistent_workers'] = persistent_workers and dtype != 'test'
+                loader_kwargs['prefetch_factor'] = prefetch_factor
+            self.data_loaders[dtype] = torch.utils.data.DataLoader(
+                _SessionsDataset(self.datasets),
+                batch_size=1,
+                sampler=self.schedule_samplers[dtype],
+                num_workers=num_workers,
+                pin_memory=pin_memory,
+                **loader_kwargs)
+
+        # iterators over (session, trial) pairs (numpy data) or data loaders; see _set_schedule
+        self.data_iters = {}
+
+        # windows of frames served in place of full training trials; see set_frame_window
+        self.frame_windows = None
+
+        # order in which sessions are visited, and current position in this order
+        self.schedule = {}
+        self.schedule_pos = {}
+        self.reset_iterators('all')
 
     def __str__(self):
         """Pretty printing of dataset info"""
@@ -564,28 +1102,167 @@ class ConcatSessionsGenerator(object):
     def __len__(self):
         return self.n_datasets
 
+    def set_frame_window(self, frame_window, pad=0):
+        """Serve training data in windows containing a fixed number of frames.
+
+        By default each batch is a full trial, so that the batch size varies with trial length.
+        Setting a frame window instead tiles each training trial with windows of
+        :obj:`frame_window` frames (see :func:`get_frame_windows`); windows are then shuffled
+        across trials and sessions like full trials. Validation and test data are always served as
+        full trials.
+
+        Parameters
+        ----------
+        frame_window : :obj:`int` or :obj:`NoneType`
+            number of frames per window, including padding; :obj:`NoneType` or :obj:`0` to serve
+            full trials
+        pad : :obj:`int`, optional
+            number of frames on either side of each window that provide context but are not
+            scored, e.g. the maximum number of lags of a decoder
+
+        """
+        if frame_window:
+            self.frame_windows = []
+            for dataset in self.datasets:
+                windows = [np.zeros((0, 3), dtype=np.int64)]
+                for trial in dataset.batch_idxs['train']:
+                    frames = get_frame_windows(dataset.get_n_frames(trial), frame_window, pad)
+                    windows.append(np.concatenate(
+                        [np.full((frames.shape[0], 1), trial, dtype=np.int64), frames], axis=1))
+                self.frame_windows.append(np.concatenate(windows, axis=0))
+        else:
+            self.frame_windows = None
+
+        # update batch counts
+        for i, dataset in enumerate(self.datasets):
+            dataset.n_batches['train'] = len(self._get_batch_units(i, 'train'))
+        self.n_tot_batches['train'] = np.sum(
+            [dataset.n_batches['train'] for dataset in self.datasets])
+        self.batch_ratios = np.array(
+            [dataset.n_batches['train'] for dataset in self.datasets]) / \
+            self.n_tot_batches['train']
+
+        self.reset_iterators('train')
+
+    def _get_batch_units(self, i, dtype):
+        """Return the trials (or windows of frames) served as batches for a session."""
+        if dtype == 'train' and self.frame_windows is not None:
+            return self.frame_windows[i]
+        else:
+            return self.datasets[i].batch_idxs[dtype]
+
     def reset_iterators(self, dtype):
         """Reset iterators so that all data is available.
 
+        This builds the schedule for the next pass through the data: the order of trials within
+        each session is drawn from the global torch random number generator, and the order in
+        which sessions are visited is drawn from the global numpy random number generator. Each
+        session appears in the schedule once for each of its trials (or windows of frames, see
+        :meth:`set_frame_window`), so sessions are sampled in proportion to their number of
+        batches. All random numbers are drawn in the main process,
+        before any data is loaded; the schedule therefore only depends on the torch and numpy
+        seeds, and not on the number of worker processes.
+
         Parameters
         ----------
         dtype : :obj:`str`
             'train' | 'val' | 'test' | 'all'
 
         """
+        if dtype == 'all':
+            dtypes = sorted(self._dtypes)
+        else:
+            dtypes = [dtype]
+
+        for dtype_ in dtypes:
+            trial_orders = []
+            for i in range(self.n_datasets):
+                batch_units = self._get_batch_units(i, dtype_)
+                trial_orders.append(batch_units[torch.randperm(len(batch_units)).numpy()])
+            sessions = np.repeat(
+                np.arange(self.n_datasets), [len(trials) for trials in trial_orders])
+            self._set_schedule(dtype_, np.random.permutation(sessions), trial_orders)
+
+    def get_schedule(self, dtype):
+        """Return the (session, trial) schedule of the current pass through the data.
+
+        Parameters
+        ----------
+        dtype : :obj:`str`
+            'train' | 'val' | 'test'
+
+        Returns
+        -------
+        :obj:`np.ndarray`
+            array of shape (n_batches, 2); each row contains the session index and trial index of
+            a single batch, in the order in which they are served by :meth:`next_batch`. If
+            training data is served in windows of frames (see :meth:`set_frame_window`), the
+            training schedule has shape (n_batches, 4), and each row additionally contains the
+            first frame and one past the last frame of the window
+
+        """
+        sessions = self.schedule[dtype]
+        n_cols = 4 if np.ndim(self._get_batch_units(0, dtype)) == 2 else 2
+        schedule = np.zeros((len(sessions), n_cols), dtype=np.int64)
+        schedule[:, 0] = sessions
+        for i in range(self.n_datasets):
+            schedule[sessions == i, 1:] = np.reshape(
+                self.dataset_samplers[i][dtype].indices, (-1, n_cols - 1))
+        return schedule
+
+    def set_schedule(self, dtype, schedule):
+        """Replay a schedule previously returned by :meth:`get_schedule`.
+
+        Parameters
+        ----------
+        dtype : :obj:`str`
+            'train' | 'val' | 'test'
+        schedule : :obj:`np.ndarray`
+            array of shape (n_batches, 2) or (n_batches, 4); see :meth:`get_schedule`
+
+        """
+        schedule = np.asarray(schedule, dtype=np.int64)
+        sessions = schedule[:, 0]
+        if np.any(sessions < 0) or np.any(sessions >= self.n_datasets):
+            raise ValueError('schedule contains invalid session indices')
+        if schedule.shape[1] == 2:
+            trial_orders = [schedule[sessions == i, 1] for i in range(self.n_datasets)]
+        else:
+            trial_orders = [schedule[sessions == i, 1:] for i in range(self.n_datasets)]
+        self._set_schedule(dtype, sessions, trial_orders)
 
+    def _set_schedule(self, dtype, sessions, trial_orders):
+        """Set session order and per-session trial orders, and reset the data iterators."""
+        self.schedule[dtype] = sessions
+        self.schedule_pos[dtype] = 0
         for i in range(self.n_datasets):
-            if dtype == 'all':
-                for dtype_ in self._dtypes:
-                    self.dataset_iters[i][dtype_] = iter(self.dataset_loaders[i][dtype_])
-            else:
-                self.dataset_iters[i][dtype] = iter(self.dataset_loaders[i][dtype])
+            self.dataset_samplers[i][dtype].indices = trial_orders[i]
+        self.schedule_samplers[dtype].sessions = sessions
+        # data loader iterators draw a base seed for their workers from the torch random number
+        # generator, except when persistent workers are reused; create iterators once all orders
+        # have been chosen, and always draw one number per session (as the per-session data
+        # loaders of previous versions did) so that the random number stream does not depend on
+        # the number of workers or on how data is served
+        if self.serve_numpy:
+            self.data_iters[dtype] = iter(self.schedule_samplers[dtype])
+        else:
+            with torch.random.fork_rng(devices=[]):
+                self.data_iters[dtype] = iter(self.data_loaders[dtype])
+        for _ in range(self.n_datasets):
+            torch.empty((), dtype=torch.int64).random_()
 
     def next_batch(self, dtype):
         """Return next batch of data.
 
-        The data generator iterates randomly through sessions and trials. Once a session runs out
-        of trials it is skipped.
+        Batches are served in the order given by the schedule built in :meth:`reset_iterators`.
+
+        If data is returned as numpy arrays and loaded in the main process
+        (:obj:`as_numpy=True, num_workers=0`), batches are taken directly from the datasets rather
+        than through torch data loaders: arrays are not converted to tensors and back, and for data
+        stored in memory (:obj:`batch_load=False`) the returned arrays are views into the stored
+        data rather than copies; these views should therefore not be modified in place. Batches
+        have the same format in both cases, i.e. each signal is a list containing a single array
+        with a leading batch dimension of size 1.
 
         Parameters
         ----------
@@ -599,20 +1276,27 @@ class ConcatSessionsGenerator(object):
             - **dataset** (:obj:`int`): dataset from which data batch is drawn
 
         """
-        while True:
-            # get next session
-            dataset = np.random.choice(np.arange(self.n_datasets), p=self.batch_ratios)
-
-            # get this session data
-            try:
-                sample = next(self.dataset_iters[dataset][dtype])
-                break
-            except StopIteration:
-                continue
+        pos = self.schedule_pos[dtype]
+        if pos >= len(self.schedule[dtype]):
+            raise StopIteration('all %s batches have been served; reset iterators' % dtype)
+        dataset = self.schedule[dtype][pos]
+        self.schedule_pos[dtype] = pos + 1
+
+        # get this session data
+        if self.serve_numpy:
+            _, idx = next(self.data_iters[dtype])
+            sample = self.datasets[dataset][idx]
+            for signal in sample:
+                if signal != 'batch_idx':
+                    sample[signal] = [ss[None] for ss in sample[signal]]
+            sample['batch_idx'] = np.array([sample['batch_idx']])
+            return sample, dataset
+
+        sample = next(self.data_iters[dtype])
 
         if self.as_numpy:
             for i, signal in enumerate(sample):
-                if signal is not 'batch_idx':
+                if signal != 'batch_idx':
                     sample[signal] = [ss.cpu().detach().numpy() for ss in sample[signal]]
 
         return sample, dataset
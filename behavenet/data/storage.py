@@ -0,0 +1,903 @@
+"""Low-level helpers for accessing the files that back the data generators.
+
+The data generators in :mod:`behavenet.data.data_generator` read the same files many times per
+epoch (once per trial and signal). The helpers in this module keep those reads cheap:
+
+* :class:`HDF5FilePool`: per-process pool of open HDF5 file handles, shared by all sessions
+* :class:`RaggedArray`: trials of varying length stored in a single contiguous array, which can be
+  memory-mapped from disk for random access to individual trials; this is the format used to
+  export latents, states and predictions (see :func:`export_ragged`)
+* :func:`get_signal_metadata`: number of trials, trial lengths, shapes and dtypes of a signal,
+  stored in a small sidecar file next to each data file so that it only needs to be computed once
+* :func:`save_transform_stats`: statistics of transforms fitted to the training trials of a
+  session, stored in a sidecar file next to each data file
+* :func:`read_trial`: read (part of) a trial from an hdf5 group stored in either the per-trial
+  layout or the packed layout written by :func:`convert_to_packed`
+
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import pickle
+import h5py
+import numpy as np
+
+
+class HDF5FilePool(object):
+    """Per-process pool of open (read-only) HDF5 file handles.
+
+    Opening an HDF5 file requires reading its superblock and metadata, which can be slow on
+    network filesystems; closing the file also throws away the chunk cache maintained by h5py. The
+    pool keeps up to :obj:`max_open_files` handles open and closes the least recently used handle
+    once this limit is exceeded.
+
+    Each dataset read through these handles keeps its own chunk cache of :obj:`rdcc_nbytes` bytes
+    (1MB by default in hdf5). Chunks of compressed data are decompressed once when they are read
+    into this cache; if the cache is too small to hold the chunks of a frame window (or of a full
+    trial in the per-trial layout), the same chunks are decompressed repeatedly. Cache settings
+    only apply to files opened after they are set; see :func:`configure_hdf5_pool`.
+
+    The pool is fork-safe: handles are tagged with the id of the process that opened them, and a
+    child process (e.g. a :class:`torch.utils.data.DataLoader` worker) opens its own handles rather
+    than reusing those inherited from the parent. Inherited handles are closed in the child before
+    any file is reopened; otherwise the hdf5 library would recognize the file as already open and
+    share the parent's file state. Since all files are opened read-only, closing them in the child
+    does not affect the parent.
+
+    """
+
+    def __init__(self, max_open_files=32, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None):
+        """
+
+        Parameters
+        ----------
+        max_open_files : :obj:`int`, optional
+            maximum number of simultaneously open files
+        rdcc_nbytes : :obj:`int` or :obj:`NoneType`, optional
+            size of the chunk cache of each dataset in bytes; :obj:`NoneType` uses the hdf5 default
+        rdcc_nslots : :obj:`int` or :obj:`NoneType`, optional
+            number of hash table slots of the chunk cache; should be a prime number roughly 100
+            times larger than the number of chunks that fit in the cache
+        rdcc_w0 : :obj:`float` or :obj:`NoneType`, optional
+            chunk eviction policy, between 0 and 1; use 1 if chunks are read only once
+
+        """
+        self.max_open_files = max_open_files
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.rdcc_w0 = rdcc_w0
+        self._files = OrderedDict()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        self._check_pid()
+        return path in self._files
+
+    def get(self, path):
+        """Return an open handle for the requested file, opening the file if necessary.
+
+        Parameters
+        ----------
+        path : :obj:`str`
+            absolute path to hdf5 file
+
+        Returns
+        -------
+        :obj:`h5py.File` object
+
+        """
+        self._check_pid()
+        f = self._files.get(path, None)
+        if f is not None and f.id.valid:
+            self._files.move_to_end(path)
+            return f
+        f = h5py.File(
+            path, 'r', libver='latest', swmr=True, rdcc_nbytes=self.rdcc_nbytes,
+            rdcc_nslots=self.rdcc_nslots, rdcc_w0=self.rdcc_w0)
+        self._files[path] = f
+        while len(self._files) > self.max_open_files:
+            _, f_old = self._files.popitem(last=False)
+            f_old.close()
+        return f
+
+    def close(self, path=None):
+        """Close a single file, or all files if :obj:`path=None`.
+
+        Parameters
+        ----------
+        path : :obj:`str` or :obj:`NoneType`, optional
+            absolute path to hdf5 file
+
+        """
+        self._check_pid()
+        if path is None:
+            paths = list(self._files.keys())
+        else:
+            paths = [path] if path in self._files else []
+        for path_ in paths:
+            self._files.pop(path_).close()
+
+    def _check_pid(self):
+        """Close handles inherited from a parent process."""
+        pid = os.getpid()
+        if pid != self._pid:
+            for f in self._files.values():
+                if f.id.valid:
+                    f.close()
+            self._files = OrderedDict()
+            self._pid = pid
+
+
+# single pool per process, shared by all datasets/data generators
+_hdf5_pool = HDF5FilePool()
+
+
+def get_hdf5_pool():
+    """Return the process-wide :class:`HDF5FilePool` object.
+
+    Returns
+    -------
+    :obj:`HDF5FilePool` object
+
+    """
+    return _hdf5_pool
+
+
+def configure_hdf5_pool(rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None):
+    """Set the chunk cache parameters of the process-wide :class:`HDF5FilePool` object.
+
+    Files opened with different settings are closed, and reopened on next access. Settings are
+    inherited by :class:`torch.utils.data.DataLoader` worker processes.
+
+    Parameters
+    ----------
+    rdcc_nbytes : :obj:`int` or :obj:`NoneType`, optional
+        size of the chunk cache of each dataset in bytes; :obj:`NoneType` uses the hdf5 default
+    rdcc_nslots : :obj:`int` or :obj:`NoneType`, optional
+        number of hash table slots of the chunk cache; if :obj:`NoneType` and :obj:`rdcc_nbytes`
+        is set, uses a prime number large enough for 4KB chunks
+    rdcc_w0 : :obj:`float` or :obj:`NoneType`, optional
+        chunk eviction policy, between 0 and 1; use 1 if chunks are read only once
+
+    """
+    if rdcc_nbytes is not None and rdcc_nslots is None:
+        rdcc_nslots = _next_prime(100 * max(1, rdcc_nbytes // 4096))
+    settings = (rdcc_nbytes, rdcc_nslots, rdcc_w0)
+    if settings != (_hdf5_pool.rdcc_nbytes, _hdf5_pool.rdcc_nslots, _hdf5_pool.rdcc_w0):
+        _hdf5_pool.close()
+        _hdf5_pool.rdcc_nbytes, _hdf5_pool.rdcc_nslots, _hdf5_pool.rdcc_w0 = settings
+
+
+def _next_prime(n):
+    """Return the smallest prime number larger than or equal to :obj:`n`."""
+    n = max(2, int(n))
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+def get_hdf5_file(path):
+    """Return an open, read-only handle for an HDF5 file from the process-wide pool.
+
+    Handles are owned by the pool and should not be closed by the caller.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to hdf5 file
+
+    Returns
+    -------
+    :obj:`h5py.File` object
+
+    """
+    return _hdf5_pool.get(path)
+
+
+def is_packed(group):
+    """Check whether an hdf5 group stores a signal in the packed layout.
+
+    In the default layout, each trial is stored as a separate dataset :obj:`trial_%04i` in the
+    group. In the packed layout (see :func:`convert_to_packed`), all trials are concatenated along
+    the first (time) dimension into a single dataset :obj:`data`, and trial :obj:`i` is stored in
+    :obj:`data[offsets[i]:offsets[i + 1]]`.
+
+    Parameters
+    ----------
+    group : :obj:`h5py.Group` object
+
+    Returns
+    -------
+    :obj:`bool`
+
+    """
+    return group.attrs.get('layout', '') == 'packed'
+
+
+def get_trial_lengths(group):
+    """Return the number of time points in each trial of a signal stored in an hdf5 group.
+
+    Parameters
+    ----------
+    group : :obj:`h5py.Group` object
+        group stored in either the per-trial or the packed layout
+
+    Returns
+    -------
+    :obj:`np.ndarray`
+
+    """
+    if is_packed(group):
+        return np.diff(group['offsets'][()])
+    else:
+        return np.array(
+            [group[str('trial_%04i' % tr)].shape[0] for tr in range(len(group))], dtype=np.int64)
+
+
+def read_trial(group, idx, frames=None):
+    """Read a single trial of a signal stored in an hdf5 group.
+
+    For the packed layout the requested frames are read with a single hyperslab selection from
+    the concatenated dataset, touching only the chunks that overlap these frames.
+
+    Parameters
+    ----------
+    group : :obj:`h5py.Group` object
+        group stored in either the per-trial or the packed layout
+    idx : :obj:`int`
+        trial index
+    frames : :obj:`slice` or :obj:`NoneType`, optional
+        if not :obj:`NoneType`, only read these frames from the trial
+
+    Returns
+    -------
+    :obj:`np.ndarray`
+
+    """
+    if not is_packed(group):
+        return group[str('trial_%04i' % idx)][() if frames is None else frames]
+    beg, end = group['offsets'][idx:idx + 2]
+    if frames is None:
+        return group['data'][beg:end]
+    start, stop, step = frames.indices(end - beg)
+    data = group['data'][beg + start:beg + max(start, stop)]
+    return data if step == 1 else data[::step]
+
+
+def _get_packed_chunks(shape, dtype, access, chunk_bytes):
+    """Return the chunk shape of a packed dataset; chunks always contain complete frames."""
+    if access == 'random':
+        n_frames = 1
+    elif access == 'sequential':
+        frame_bytes = int(np.prod(shape[1:], dtype=np.int64)) * np.dtype(dtype).itemsize
+        n_frames = max(1, chunk_bytes // max(1, frame_bytes))
+    else:
+        raise ValueError('"%s" is an invalid access pattern' % access)
+    return (int(min(n_frames, max(1, shape[0]))),) + tuple(shape[1:])
+
+
+def get_compression_kwargs(compression=None, shuffle=None):
+    """Return the keyword arguments of :meth:`h5py.Group.create_dataset` for a compression codec.
+
+    Parameters
+    ----------
+    compression : :obj:`str`, :obj:`int` or :obj:`NoneType`, optional
+        :obj:`NoneType`: no compression
+        'lzf': fast compression with moderate compression ratio; available in every h5py install,
+        but only readable from h5py
+        'gzip' or 'gzip-%i': slower, portable compression with level 0-9 (default 4)
+        :obj:`int`: gzip compression with this level
+    shuffle : :obj:`bool` or :obj:`NoneType`, optional
+        apply the byte shuffle filter before compression, which often improves the compression
+        ratio of multi-byte dtypes; defaults to :obj:`True` if data is compressed
+
+    Returns
+    -------
+    :obj:`dict`
+
+    """
+    if compression is None:
+        return {}
+    if isinstance(compression, int):
+        compression = 'gzip-%i' % compression
+    if compression == 'lzf':
+        kwargs = {'compression': 'lzf'}
+    elif compression.startswith('gzip'):
+        level = int(compression[5:]) if len(compression) > 4 else 4
+        if not 0 <= level <= 9:
+            raise ValueError('gzip compression level must be between 0 and 9, not %i' % level)
+        kwargs = {'compression': 'gzip', 'compression_opts': level}
+    else:
+        raise ValueError('"%s" is an invalid compression codec' % compression)
+    kwargs['shuffle'] = True if shuffle is None else shuffle
+    return kwargs
+
+
+def convert_to_packed(
+        src, dst, signals=None, access='sequential', chunks=None, chunk_bytes=2 ** 20,
+        compression=None, shuffle=None):
+    """Convert an hdf5 data file from the per-trial layout to the packed layout.
+
+    Each converted group contains the datasets :obj:`data` (all trials concatenated along the
+    first dimension) and :obj:`offsets` (trial boundaries of shape (n_trials + 1,)), and has the
+    attribute :obj:`layout='packed'`; see :func:`is_packed`. All other groups, datasets and
+    attributes of the source file are copied unchanged. The data generators read both layouts.
+
+    The destination file is first written to a temporary file and then renamed, so that
+    concurrent readers never see a partially written file; :obj:`dst` may equal :obj:`src`.
+
+    Parameters
+    ----------
+    src : :obj:`str`
+        absolute path to source hdf5 file
+    dst : :obj:`str`
+        absolute path to destination hdf5 file
+    signals : :obj:`list` of :obj:`str` or :obj:`NoneType`, optional
+        groups to convert; if :obj:`NoneType`, convert all groups that only contain datasets named
+        :obj:`trial_%04i`
+    access : :obj:`str`, optional
+        expected access pattern, used to choose the chunk shape if :obj:`chunks=None`
+        'sequential': chunks of approximately :obj:`chunk_bytes` bytes, which suits reading
+        whole trials or long frame windows
+        'random': single-frame chunks, which suits reading short windows at random offsets
+    chunks : :obj:`tuple` or :obj:`NoneType`, optional
+        explicit chunk shape of the :obj:`data` datasets, e.g. :obj:`(64, 1, 128, 128)`
+    chunk_bytes : :obj:`int`, optional
+        approximate chunk size for :obj:`access='sequential'`
+    compression : :obj:`str`, :obj:`int` or :obj:`NoneType`, optional
+        compression codec of the :obj:`data` datasets, e.g. 'lzf' | 'gzip-1'; see
+        :func:`get_compression_kwargs`. Compressed chunks are decompressed as a whole, so
+        single-frame chunks are recommended if windows are read at random offsets
+    shuffle : :obj:`bool` or :obj:`NoneType`, optional
+        see :func:`get_compression_kwargs`
+
+    """
+    compression_kwargs = get_compression_kwargs(compression, shuffle)
+    tmp_file = dst + '.tmp%i' % os.getpid()
+    with h5py.File(src, 'r', libver='latest', swmr=True) as f_src, \
+            h5py.File(tmp_file, 'w', libver='latest') as f_dst:
+        for key, value in f_src.attrs.items():
+            f_dst.attrs[key] = value
+        for name, obj in f_src.items():
+            is_trial_group = isinstance(obj, h5py.Group) and not is_packed(obj) \
+                and len(obj) > 0 and all(k.startswith('trial_') for k in obj.keys())
+            if not is_trial_group or (signals is not None and name not in signals):
+                f_src.copy(obj, f_dst, name=name)
+                continue
+            lengths = get_trial_lengths(obj)
+            offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            ex_dset = obj[str('trial_%04i' % 0)]
+            shape = (int(offsets[-1]),) + ex_dset.shape[1:]
+            chunks_ = chunks if chunks is not None else _get_packed_chunks(
+                shape, ex_dset.dtype, access, chunk_bytes)
+            group = f_dst.create_group(name)
+            for key, value in obj.attrs.items():
+                group.attrs[key] = value
+            group.attrs['layout'] = 'packed'
+            group.create_dataset('offsets', data=offsets)
+            dset = group.create_dataset(
+                'data', shape=shape, dtype=ex_dset.dtype,
+                chunks=chunks_ if shape[0] > 0 else None,
+                **(compression_kwargs if shape[0] > 0 else {}))
+            for tr in range(len(lengths)):
+                dset[offsets[tr]:offsets[tr + 1]] = obj[str('trial_%04i' % tr)][()]
+    # make sure no stale handle to the old file is reused
+    if dst in _hdf5_pool:
+        _hdf5_pool.close(dst)
+    os.replace(tmp_file, dst)
+
+
+class RaggedArray(object):
+    """Trials of varying length stored as one contiguous array plus a trial-offset index.
+
+    Trial :obj:`i` is stored in :obj:`data[offsets[i]:offsets[i + 1]]`; indexing a
+    :class:`RaggedArray` returns this slice as a view, without copying data. Trials with no data
+    (e.g. gap trials that were not exported) have length zero. The data can be a numpy array
+    (possibly memory-mapped) or a torch tensor (see :meth:`to_torch`).
+
+    """
+
+    def __init__(self, data, offsets):
+        """
+
+        Parameters
+        ----------
+        data : :obj:`np.ndarray` or :obj:`torch.Tensor`
+            all trials concatenated along the first (time) dimension
+        offsets : :obj:`array-like`
+            trial boundaries of shape (n_trials + 1,)
+
+        """
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_list(cls, arrays):
+        """Build a :class:`RaggedArray` from a list of per-trial arrays.
+
+        Empty arrays (e.g. :obj:`np.array([])`) are treated as zero-length trials.
+
+        Parameters
+        ----------
+        arrays : :obj:`list` of :obj:`np.ndarray` or :obj:`RaggedArray` object
+            each array has shape (time, ...); a :class:`RaggedArray` is returned unchanged
+
+        Returns
+        -------
+        :obj:`RaggedArray` object
+
+        """
+        if isinstance(arrays, cls):
+            return arrays
+        non_empty = [a for a in arrays if a.size > 0]
+        if len(non_empty) > 0:
+            feature_shape = non_empty[0].shape[1:]
+            dtype = np.result_type(*set(a.dtype for a in non_empty))
+        else:
+            feature_shape = ()
+            dtype = np.float32
+        arrays = [a if a.size > 0 else np.zeros((0,) + feature_shape, dtype=dtype) for a in arrays]
+        lengths = [a.shape[0] for a in arrays]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        if len(arrays) > 0:
+            data = np.concatenate(arrays, axis=0).astype(dtype, copy=False)
+        else:
+            data = np.zeros((0,) + feature_shape, dtype=dtype)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.data[int(self.offsets[idx]):int(self.offsets[idx + 1])]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    @property
+    def lengths(self):
+        """Number of time points in each trial."""
+        return np.diff(self.offsets)
+
+    def to_list(self):
+        """Return trials as a list of views into the underlying array."""
+        return [self[idx] for idx in range(len(self))]
+
+    def to_torch(self, dtype=None, pin_memory=False):
+        """Return a :class:`RaggedArray` that stores its data as a single torch tensor.
+
+        The tensor shares memory with the numpy array unless a dtype conversion or pinning is
+        requested.
+
+        Parameters
+        ----------
+        dtype : :obj:`torch.dtype` or :obj:`NoneType`, optional
+            convert data to this dtype
+        pin_memory : :obj:`bool`, optional
+            :obj:`True` to store data in page-locked memory, which speeds up transfers to the gpu;
+            ignored if no gpu is available
+
+        Returns
+        -------
+        :obj:`RaggedArray` object
+
+        """
+        import torch
+        data = self.data
+        if not isinstance(data, torch.Tensor):
+            data = torch.from_numpy(np.ascontiguousarray(data))
+        if dtype is not None:
+            data = data.to(dtype)
+        if pin_memory and torch.cuda.is_available():
+            data = data.pin_memory()
+        return RaggedArray(data, self.offsets)
+
+
+def get_ragged_paths(path):
+    """Return the data/index filenames of the indexed store associated with a data file.
+
+    Exported latents, states and predictions are referred to by a :obj:`.pkl` filename throughout
+    the code (e.g. :obj:`sess_latents.pkl`); the indexed store lives next to this file as
+    :obj:`sess_latents.npy` (data) and :obj:`sess_latents_index.pkl` (trial index and metadata).
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+
+    Returns
+    -------
+    :obj:`tuple`
+        - data file (:obj:`str`)
+        - index file (:obj:`str`)
+
+    """
+    root = os.path.splitext(path)[0]
+    return root + '.npy', root + '_index.pkl'
+
+
+def ragged_exists(path):
+    """Check whether an up-to-date indexed store exists for the requested data file.
+
+    If both a legacy pickle file and an indexed store exist, the indexed store is only used if it
+    is at least as recent as the pickle file.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+
+    Returns
+    -------
+    :obj:`bool`
+
+    """
+    data_file, index_file = get_ragged_paths(path)
+    if not (os.path.exists(data_file) and os.path.exists(index_file)):
+        return False
+    if path.endswith('.pkl') and os.path.exists(path):
+        return os.path.getmtime(index_file) >= os.path.getmtime(path)
+    return True
+
+
+def export_ragged(path, arrays, key, trials=None, export_pkl=False):
+    """Save a list of per-trial arrays as an indexed store.
+
+    Files are first written to temporary files and then renamed, so that concurrent readers
+    never see a partially written store.
+
+    The data can additionally be saved in the pickle format of previous versions of BehaveNet
+    (a :obj:`dict` with the keys :obj:`key` and 'trials'), for code that reads the pickle file
+    directly. The pickle file is written before the indexed store, so that the latter is used by
+    :func:`load_exported_data` and the data generators (see :func:`ragged_exists`).
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file; see :func:`get_ragged_paths` for the files that are created
+    arrays : :obj:`list` of :obj:`np.ndarray`
+        one array per trial, each of shape (time, ...)
+    key : :obj:`str`
+        name of the data, e.g. 'latents' | 'states' | 'predictions'
+    trials : :obj:`dict`, optional
+        train/val/test trial indices, stored with the data
+    export_pkl : :obj:`bool`, optional
+        :obj:`True` to also save the data in a pickle file at :obj:`path`
+
+    """
+    if export_pkl:
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({key: arrays, 'trials': trials}, f)
+        os.replace(tmp_file, path)
+    data_file, index_file = get_ragged_paths(path)
+    ragged = RaggedArray.from_list(arrays)
+    index = {
+        'key': key,
+        'offsets': ragged.offsets,
+        'shape': ragged.data.shape,
+        'dtype': ragged.data.dtype.str,
+        'trials': trials}
+    tmp_file = data_file + '.tmp.npy'
+    np.save(tmp_file, ragged.data)
+    os.replace(tmp_file, data_file)
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(index, f)
+    os.replace(tmp_file, index_file)
+
+
+def load_ragged(path, mmap_mode='r'):
+    """Load an indexed store saved with :func:`export_ragged`.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+    mmap_mode : :obj:`str` or :obj:`NoneType`, optional
+        memory-map mode passed to :func:`numpy.load`; use :obj:`NoneType` to load all data into
+        memory
+
+    Returns
+    -------
+    :obj:`tuple`
+        - data (:obj:`RaggedArray` object)
+        - index (:obj:`dict`): contains 'key', 'offsets', 'shape', 'dtype' and 'trials'
+
+    """
+    data_file, index_file = get_ragged_paths(path)
+    with open(index_file, 'rb') as f:
+        index = pickle.load(f)
+    data = np.load(data_file, mmap_mode=mmap_mode)
+    return RaggedArray(data, index['offsets']), index
+
+
+def _load_ragged_index(path):
+    """Load the index of an indexed store without memory-mapping its data."""
+    _, index_file = get_ragged_paths(path)
+    with open(index_file, 'rb') as f:
+        return pickle.load(f)
+
+
+def get_metadata_path(path):
+    """Return the filename of the metadata sidecar associated with a data file.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+
+    Returns
+    -------
+    :obj:`str`
+        e.g. :obj:`data_metadata.json` for :obj:`data.hdf5`
+
+    """
+    return os.path.splitext(path)[0] + '_metadata.json'
+
+
+def get_file_hash(path, n_bytes=2 ** 20):
+    """Compute a quick content hash of a file from its size and its first and last bytes.
+
+    Reading the full content of large video files would take too long; data files are rewritten
+    as a whole rather than edited in place, so changes in the middle of a file that leave its size
+    and both ends untouched are not expected.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to file
+    n_bytes : :obj:`int`, optional
+        number of bytes read from the start and the end of the file
+
+    Returns
+    -------
+    :obj:`str`
+
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(n_bytes))
+        if size > n_bytes:
+            f.seek(max(size - n_bytes, n_bytes))
+            h.update(f.read(n_bytes))
+    return h.hexdigest()
+
+
+def get_data_hash(path):
+    """Compute a quick content hash of the data stored under a data filename.
+
+    For exported latents/states/predictions the files of the indexed store are hashed if it
+    exists (see :func:`get_ragged_paths`); otherwise the data file itself is hashed (see
+    :func:`get_file_hash`).
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+
+    Returns
+    -------
+    :obj:`str`
+
+    """
+    if ragged_exists(path):
+        files = get_ragged_paths(path)
+    else:
+        files = [path]
+    h = hashlib.sha1()
+    for file in files:
+        h.update(get_file_hash(file).encode())
+    return h.hexdigest()
+
+
+def get_stats_path(path):
+    """Return the filename of the transform statistics sidecar associated with a data file.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+
+    Returns
+    -------
+    :obj:`str`
+        e.g. :obj:`data_stats.json` for :obj:`data.hdf5`
+
+    """
+    return os.path.splitext(path)[0] + '_stats.json'
+
+
+def load_transform_stats(path, key):
+    """Load statistics of a fitted transform from the sidecar of a data file.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+    key : :obj:`str`
+        identifies the data, transform and trials the statistics were computed from
+
+    Returns
+    -------
+    :obj:`dict` or :obj:`NoneType`
+        :obj:`NoneType` if no statistics are stored for this key
+
+    """
+    stats_file = get_stats_path(path)
+    if not os.path.exists(stats_file):
+        return None
+    try:
+        with open(stats_file, 'r') as f:
+            return json.load(f).get(key, None)
+    except ValueError:
+        return None
+
+
+def save_transform_stats(path, key, stats):
+    """Save statistics of a fitted transform to the sidecar of a data file.
+
+    The sidecar is rewritten atomically; if it cannot be written (e.g. the data directory is
+    read-only), the statistics are not persisted and will be recomputed.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+    key : :obj:`str`
+        identifies the data, transform and trials the statistics were computed from
+    stats : :obj:`dict`
+        json-serializable statistics
+
+    """
+    stats_file = get_stats_path(path)
+    all_stats = {}
+    if os.path.exists(stats_file):
+        try:
+            with open(stats_file, 'r') as f:
+                all_stats = json.load(f)
+        except ValueError:
+            all_stats = {}
+    all_stats[key] = stats
+    tmp_file = stats_file + '.tmp%i' % os.getpid()
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(all_stats, f)
+        os.replace(tmp_file, stats_file)
+    except OSError:
+        pass
+
+
+def _compute_signal_metadata(path, signal, key=None):
+    """Compute metadata of a signal by reading its data file."""
+    if key is None:
+        group = get_hdf5_file(path)[signal]
+        lengths = get_trial_lengths(group)
+        n_trials = len(lengths)
+        dset = group['data'] if is_packed(group) else group[str('trial_%04i' % 0)]
+        shape = dset.shape[1:]
+        dtype = dset.dtype.str
+    else:
+        with open(path, 'rb') as f:
+            arrays = pickle.load(f)[key]
+        n_trials = len(arrays)
+        lengths = [a.shape[0] if a.size > 0 else 0 for a in arrays]
+        non_empty = [a for a in arrays if a.size > 0]
+        shape = non_empty[0].shape[1:] if len(non_empty) > 0 else ()
+        dtype = non_empty[0].dtype.str if len(non_empty) > 0 else None
+    return {
+        'n_trials': n_trials, 'lengths': [int(l) for l in lengths],
+        'shape': [int(d) for d in shape], 'dtype': dtype}
+
+
+def get_signal_metadata(path, signal, key=None):
+    """Return the number of trials, trial lengths, and the shape/dtype of a signal.
+
+    For signals stored in hdf5 files and legacy pickle files, this information is cached in a
+    json sidecar file next to the data file (see :func:`get_metadata_path`), which is written on
+    first access. The sidecar records the size and modification time of the data file, and is
+    recomputed if either changes; if only the modification time has changed (e.g. the file was
+    copied), a hash of the start and end of the file is used to decide whether the sidecar is
+    still valid. If the sidecar cannot be written (e.g. the data directory is read-only), the
+    metadata is recomputed on every call. Indexed stores (see :func:`export_ragged`) already
+    contain this information, and do not use a sidecar.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file
+    signal : :obj:`str`
+        signal name; for hdf5 files, the name of the group that contains the signal
+    key : :obj:`str` or :obj:`NoneType`, optional
+        for exported latents/states/predictions, the data key (e.g. 'latents'); if
+        :obj:`NoneType`, the signal is read from an hdf5 file
+
+    Returns
+    -------
+    :obj:`dict`
+        - 'n_trials' (:obj:`int`): number of trials
+        - 'lengths' (:obj:`np.ndarray`): number of time points in each trial
+        - 'shape' (:obj:`tuple`): shape of a single time point
+        - 'dtype' (:obj:`str`): numpy dtype string of the stored data
+
+    """
+    if key is not None and ragged_exists(path):
+        index = _load_ragged_index(path)
+        return {
+            'n_trials': len(index['offsets']) - 1, 'lengths': np.diff(index['offsets']),
+            'shape': tuple(index['shape'][1:]), 'dtype': index['dtype']}
+
+    # read sidecar and check that it describes the current data file
+    meta_file = get_metadata_path(path)
+    stat = os.stat(path)
+    sidecar = None
+    changed = False
+    if os.path.exists(meta_file):
+        try:
+            with open(meta_file, 'r') as f:
+                sidecar = json.load(f)
+        except ValueError:
+            # partially written or corrupted sidecar
+            sidecar = None
+    if sidecar is not None and sidecar['file']['size'] != stat.st_size:
+        sidecar = None
+    elif sidecar is not None and sidecar['file']['mtime_ns'] != stat.st_mtime_ns:
+        if sidecar['file']['hash'] == get_file_hash(path):
+            sidecar['file']['mtime_ns'] = stat.st_mtime_ns
+            changed = True
+        else:
+            sidecar = None
+    if sidecar is None:
+        sidecar = {
+            'file': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': get_file_hash(path)},
+            'signals': {}}
+        changed = True
+
+    # compute and store metadata of this signal if necessary
+    name = signal if key is None else key
+    if name not in sidecar['signals']:
+        sidecar['signals'][name] = _compute_signal_metadata(path, signal, key=key)
+        changed = True
+    if changed:
+        tmp_file = meta_file + '.tmp%i' % os.getpid()
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(sidecar, f)
+            os.replace(tmp_file, meta_file)
+        except OSError:
+            pass
+
+    metadata = dict(sidecar['signals'][name])
+    metadata['lengths'] = np.array(metadata['lengths'], dtype=np.int64)
+    metadata['shape'] = tuple(metadata['shape'])
+    return metadata
+
+
+def load_exported_data(path):
+    """Load exported latents/states/predictions as a dict, from either storage format.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        absolute path to data file (:obj:`.pkl` extension)
+
+    Returns
+    -------
+    :obj:`dict`
+        the data key (e.g. 'latents') contains a :obj:`list` of :obj:`np.ndarray` objects, one per
+        trial; 'trials' contains train/val/test trial indices
+
+    """
+    if ragged_exists(path):
+        ragged, index = load_ragged(path)
+        return {index['key']: ragged.to_list(), 'trials': index['trials']}
+    else:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
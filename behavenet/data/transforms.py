@@ -1,8 +1,14 @@
 """Tranform classes to process data.
 
 Data generator objects can apply these transforms to batches of data upon loading.
+
+Some transforms (:class:`Threshold`, :class:`ZScore`) depend on statistics of the data. These
+subclass :class:`FitTransform`: if they are fit before use (the data generators fit them on the
+training trials of each session), the same session-wide statistics are applied to every trial;
+otherwise statistics are computed from each sample they are applied to.
 """
 
+import hashlib
 import numpy as np
 # from skimage import transform
 
@@ -55,6 +61,88 @@ class Transform(object):
         raise NotImplementedError
 
 
+class RunningStats(object):
+    """Streaming mean and variance of each channel, computed in a single pass over the data.
+
+    Samples are combined with the parallel version of Welford's algorithm (Chan et al. 1979), so
+    that statistics over many trials can be computed without holding all trials in memory, and
+    without the loss of precision of the naive sum-of-squares formula.
+
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, sample):
+        """Add a sample to the statistics.
+
+        Parameters
+        ----------
+        sample : :obj:`np.ndarray`
+            shape (..., n_channels); statistics are computed over all but the last dimension
+
+        """
+        n_b = int(np.prod(sample.shape[:-1]))
+        x = np.reshape(sample, (n_b, sample.shape[-1])).astype(np.float64)
+        if n_b == 0:
+            return
+        mean_b = np.mean(x, axis=0)
+        m2_b = np.sum((x - mean_b) ** 2, axis=0)
+        if self.n == 0:
+            self.n, self.mean, self.m2 = n_b, mean_b, m2_b
+        else:
+            n = self.n + n_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta * n_b / n
+            self.m2 = self.m2 + m2_b + delta ** 2 * self.n * n_b / n
+            self.n = n
+
+    @property
+    def var(self):
+        """Population variance of each channel."""
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        """Population standard deviation of each channel."""
+        return np.sqrt(self.var)
+
+
+class FitTransform(Transform):
+    """Abstract base class for transforms that are fit to data before they are applied."""
+
+    def fit(self, samples):
+        """Compute statistics of the data in a single pass.
+
+        Parameters
+        ----------
+        samples : :obj:`iterable` of :obj:`np.ndarray`
+            e.g. all training trials of a session, each of shape (time, n_channels)
+
+        """
+        raise NotImplementedError
+
+    @property
+    def is_fitted(self):
+        """:obj:`True` if statistics have been computed or set."""
+        return self.get_stats() is not None
+
+    def get_stats(self):
+        """Return fitted statistics as a json-serializable :obj:`dict`, or :obj:`NoneType`."""
+        raise NotImplementedError
+
+    def set_stats(self, stats):
+        """Set statistics returned by :meth:`get_stats`."""
+        raise NotImplementedError
+
+    def _stats_digest(self):
+        """Return a short hash of fitted statistics, used in :obj:`repr`."""
+        stats = self.get_stats()
+        return hashlib.sha1(repr(sorted(stats.items())).encode()).hexdigest()[:12]
+
+
 class GetMask(Transform):
     """Mask data using a static threshold."""
 
@@ -67,7 +155,7 @@ class GetMask(Transform):
         signal1 = signal1 < self.ll_thresh  # ll < ll thresh
         signal2 = signal2 > self.depth_thresh  # depth > depth thresh
         # mask = ll < ll thresh || depth > depth thresh
-        signal = ((signal1.astype('int') + signal2.astype('int')) < 2).astype('int')
+        signal = np.logical_not(np.logical_and(signal1, signal2)).astype('int')
         return signal
 
     def __repr__(self):
@@ -155,7 +243,7 @@ class ClipNormalize(Transform):
 #         return str('Resize(size=(%i, %i))' % (self.x, self.y))
 
 
-class Threshold(Transform):
+class Threshold(FitTransform):
     """Remove channels of neural activity whose mean value is below a threshold."""
 
     def __init__(self, threshold, bin_size):
@@ -171,9 +259,33 @@ class Threshold(Transform):
         """
         self.threshold = threshold
         self.bin_size = bin_size
+        self.fr_mask = None
+
+    def fit(self, samples):
+        """Calculates firing rate over all time points of all samples.
+
+        Parameters
+        ----------
+        samples : :obj:`iterable` of :obj:`np.ndarray`
+            each of shape (time, n_channels)
+
+        """
+        stats = RunningStats()
+        for sample in samples:
+            stats.update(sample)
+        frs = stats.mean / (self.bin_size * 1e-3)
+        self.fr_mask = frs > self.threshold
+
+    def get_stats(self):
+        if self.fr_mask is None:
+            return None
+        return {'fr_mask': self.fr_mask.tolist()}
+
+    def set_stats(self, stats):
+        self.fr_mask = np.array(stats['fr_mask'], dtype=bool)
 
     def __call__(self, sample):
-        """Calculates firing rate over all time points and thresholds.
+        """Calculates firing rate over all time points (if not fit) and thresholds.
 
         Parameters
         ----------
@@ -186,22 +298,52 @@ class Threshold(Transform):
             output shape is (trial, time, n_channels)
 
         """
+        if self.fr_mask is not None:
+            return sample[..., self.fr_mask].astype(np.float64)
         # get firing rates
         frs = np.squeeze(np.mean(sample, axis=(0, 1))) / (self.bin_size * 1e-3)
         fr_mask = frs > self.threshold
         # get rid of neurons below fr threshold
         sample = sample[:, :, fr_mask]
-        return sample.astype(np.float)
+        return sample.astype(np.float64)
 
     def __repr__(self):
-        return str('Threshold(threshold=%f, bin_size=%f)' % (self.threshold, self.bin_size))
+        if self.fr_mask is None:
+            return str('Threshold(threshold=%f, bin_size=%f)' % (self.threshold, self.bin_size))
+        return str('Threshold(threshold=%f, bin_size=%f, stats=%s)' % (
+            self.threshold, self.bin_size, self._stats_digest()))
 
 
-class ZScore(Transform):
+class ZScore(FitTransform):
     """z-score channel activity."""
 
     def __init__(self):
-        pass
+        self.mean = None
+        self.std = None
+
+    def fit(self, samples):
+        """Calculates mean and standard deviation over all time points of all samples.
+
+        Parameters
+        ----------
+        samples : :obj:`iterable` of :obj:`np.ndarray`
+            each of shape (time, n_channels)
+
+        """
+        stats = RunningStats()
+        for sample in samples:
+            stats.update(sample)
+        self.mean = stats.mean
+        self.std = stats.std
+
+    def get_stats(self):
+        if self.mean is None:
+            return None
+        return {'mean': self.mean.tolist(), 'std': self.std.tolist()}
+
+    def set_stats(self, stats):
+        self.mean = np.array(stats['mean'])
+        self.std = np.array(stats['std'])
 
     def __call__(self, sample):
         """
@@ -217,12 +359,17 @@ class ZScore(Transform):
             output shape is (trial, time, n_channels)
 
         """
+        if self.mean is not None:
+            dtype = np.result_type(sample.dtype, np.float32)
+            return ((sample - self.mean) / self.std).astype(dtype, copy=False)
         sample -= np.mean(sample, axis=(0, 1))
         sample /= np.std(sample, axis=(0, 1))
         return sample
 
     def __repr__(self):
-        return 'ZScore()'
+        if self.mean is None:
+            return 'ZScore()'
+        return str('ZScore(stats=%s)' % self._stats_digest())
 
 
 class MakeOneHot(Transform):
@@ -249,11 +396,12 @@ class MakeOneHot(Transform):
             n_trials, n_time = sample.shape
             n_classes = int(np.nanmax(sample))
             onehot = np.zeros((n_trials, n_time, n_classes + 1))
-            for t in range(n_trials):
-                if not any(np.isnan(sample[t])):
-                    onehot[t, np.arange(n_time), sample[t].astype('int')] = 1
-                else:
-                    onehot[t] = np.nan
+            nan_trials = np.any(np.isnan(sample), axis=1)
+            trs = np.where(~nan_trials)[0]
+            trs_rep = np.repeat(trs, n_time)
+            ts_rep = np.tile(np.arange(n_time), len(trs))
+            onehot[trs_rep, ts_rep, sample[trs].astype('int').ravel()] = 1
+            onehot[nan_trials] = np.nan
         else:
             onehot = sample
         return onehot
@@ -294,24 +442,34 @@ class BlockShuffle(Transform):
         np.random.seed(self.rng_seed)
         n_trials, n_time = sample.shape
         sample_shuff = np.zeros_like(sample)
-        for t in range(n_trials):
-            if not any(np.isnan(sample[t])):
-                # mark first time point of state change with a nonzero number
-                state_change = np.where(np.concatenate([[0], np.diff(sample[t])], axis=0) != 0)[0]
-                # collect runs
-                runs = []
-                prev_beg = 0
-                for curr_beg in state_change:
-                    runs.append(np.arange(prev_beg, curr_beg))
-                    prev_beg = curr_beg
-                runs.append(np.arange(prev_beg, n_time))
-                # shuffle runs
-                rand_perm = np.random.permutation(len(runs))
-                runs_shuff = [runs[idx] for idx in rand_perm]
-                # index back into original labels with shuffled indices
-                sample_shuff[t] = sample[t, np.concatenate(runs_shuff)]
-            else:
-                sample_shuff[t] = np.nan
+        nan_trials = np.any(np.isnan(sample), axis=1)
+        if np.any(nan_trials):
+            sample_shuff[nan_trials] = np.nan
+        trs = np.where(~nan_trials)[0]
+        if len(trs) == 0 or n_time == 0:
+            return sample_shuff
+        x = sample[trs]
+
+        # run-length encoding: first time point of each run of identical states, over all trials
+        run_begs = np.ones(x.shape, dtype=bool)
+        run_begs[:, 1:] = np.diff(x, axis=1) != 0
+        run_trs, run_begs = np.nonzero(run_begs)
+        n_runs = np.bincount(run_trs, minlength=len(trs))
+        run_offsets = np.concatenate([[0], np.cumsum(n_runs)])
+        run_ends = np.append(run_begs[1:], n_time)
+        run_ends[run_offsets[1:] - 1] = n_time
+        run_lens = run_ends - run_begs
+
+        # shuffle runs within each trial; permutations are drawn one trial at a time so that
+        # results only depend on the rng seed and the number of runs in each trial
+        perm = np.concatenate(
+            [run_offsets[i] + np.random.permutation(n_runs[i]) for i in range(len(trs))])
+
+        # index back into original labels with shuffled runs
+        lens_shuff = run_lens[perm]
+        out_begs = np.concatenate([[0], np.cumsum(lens_shuff)[:-1]])
+        ts = np.repeat(run_begs[perm] - out_begs, lens_shuff) + np.arange(len(trs) * n_time)
+        sample_shuff[trs] = x[np.repeat(np.arange(len(trs)), n_time), ts].reshape(x.shape)
         return sample_shuff
 
     def __repr__(self):
@@ -351,4 +509,5 @@ class SelectIdxs(Transform):
         return sample[:, :, self.idxs]
 
     def __repr__(self):
-        return str('SelectIndxs(idxs=idxs, sample_name=%s)' % self.sample_name)
+        return str('SelectIdxs(idxs=%s, sample_name=%s)' % (
+            np.asarray(self.idxs).tolist(), self.sample_name))
@@ -4,6 +4,8 @@ import numpy as np
 import random
 import torch
 
+from behavenet.fitting.distributed import is_main_process
+from behavenet.fitting.distributed import run_distributed
 from behavenet.fitting.eval import export_latents_best
 from behavenet.fitting.eval import export_train_plots
 from behavenet.fitting.training import fit
@@ -41,8 +43,31 @@ def main(hparams, *args):
         print('Experiment exists! Aborting fit')
         return
 
+    if hparams.get('n_train_processes', 1) > 1:
+        # fit data-parallel; the test-tube experiment is only used by the main process
+        run_distributed(
+            _train, hparams['n_train_processes'], args=(hparams, sess_ids),
+            main_kwargs={'exp': exp})
+    else:
+        _train(hparams, sess_ids, exp)
+
+
+def _train(hparams, sess_ids, exp=None):
+    """Build data generator and model, and fit model; called by each process of a distributed fit.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        model/training specification
+    sess_ids : :obj:`list` of :obj:`dict`
+        sessions used for fitting
+    exp : :obj:`test_tube.Experiment` object or :obj:`NoneType`, optional
+        test-tube experiment; :obj:`NoneType` for all but the main process of a distributed fit
+
+    """
+
     # build data generator
-    data_generator = build_data_generator(hparams, sess_ids)
+    data_generator = build_data_generator(hparams, sess_ids, export_csv=is_main_process())
 
     # ####################
     # ### CREATE MODEL ###
@@ -55,13 +80,15 @@ def main(hparams, *args):
     hparams['n_datasets'] = len(sess_ids)
     model = AE(hparams)
     model.to(hparams['device'])
-    model.version = exp.version
+    model.version = hparams['version']
     torch_rnd_seed = torch.get_rng_state()
     hparams['training_rnd_seed'] = torch_rnd_seed
 
     # save out hparams as csv and dict
     hparams['training_completed'] = False
-    export_hparams(hparams, exp)
+    hparams['precision'] = hparams.get('precision', 'fp32')
+    if is_main_process():
+        export_hparams(hparams, exp)
     print('done')
 
     # ####################
@@ -69,6 +96,8 @@ def main(hparams, *args):
     # ####################
 
     fit(hparams, model, data_generator, exp, method='ae')
+    if not is_main_process():
+        return
 
     # export training plots
     if hparams['export_train_plots']:
@@ -99,6 +128,11 @@ if __name__ == '__main__':
         gpu_ids = hyperparams.gpus_viz.split(';')
         hyperparams.optimize_parallel_gpu(main, gpu_ids=gpu_ids)
 
+    elif hyperparams.device == 'cpu' and getattr(hyperparams, 'n_train_processes', 1) > 1:
+        # each fit already uses multiple processes; fit hyperparameter combinations sequentially
+        for trial in hyperparams.trials(hyperparams.tt_n_cpu_trials):
+            main(trial)
+
     elif hyperparams.device == 'cpu':
         hyperparams.optimize_parallel_cpu(
             main,
@@ -412,10 +412,11 @@ def estimate_model_footprint(model, input_dim, cutoff_size=20):
     Adapted from http://jacobkimmel.github.io/pytorch_estimating_model_size/.
 
     The estimation:
-    - assumes the model (autoencoder) is symmetric
     - assumes all values (data/parameters) are float32
     - accounts for size of input data
-    - accounts for storage of intermediate layer values and gradients
+    - accounts for storage of intermediate layer values and gradients, which are measured on a few
+      frames and scaled to the batch size; layers with activation checkpointing only store their
+      output (see :func:`behavenet.fitting.chunking.estimate_frame_bytes`)
     - adds an additional 20% fudge factor
 
     Parameters
@@ -424,7 +425,8 @@ def estimate_model_footprint(model, input_dim, cutoff_size=20):
     input_dim : :obj:`array-like`
         dimensions of batch with shape (time, n_channels, y_pix, x_pix)
     cutoff_size : :obj:`float`, optional
-        terminate estimation once model size grows beyond this point (GB)
+        not used; intermediate values are measured on a few frames rather than the full batch,
+        so estimation no longer needs to be terminated early
 
     Returns
     -------
@@ -434,7 +436,7 @@ def estimate_model_footprint(model, input_dim, cutoff_size=20):
     """
 
     import torch
-    from torch.autograd import Variable
+    from behavenet.fitting.chunking import estimate_frame_bytes
 
     allowed_modules = (
         torch.nn.Conv2d,
@@ -459,18 +461,9 @@ def estimate_model_footprint(model, input_dim, cutoff_size=20):
             for p_ in p:
                 curr_bytes += np.prod(np.array(p_.size())) * bytes
 
-    # estimate intermediate size
-    x = Variable(torch.FloatTensor(*input_dim))
-    for layer in model.encoding.encoder:
-        if isinstance(layer, torch.nn.MaxPool2d):
-            x, idx = layer(x)
-        else:
-            x = layer(x)
-        # multiply by 2 - assume decoder is symmetric
-        # multiply by 2 - we need to store values AND gradients
-        curr_bytes += np.prod(x.size()) * bytes * 2 * 2
-        if curr_bytes / 1e9 > cutoff_size:
-            break
+    # estimate intermediate size (values AND gradients), excluding the input data
+    frame_bytes = estimate_frame_bytes(model, input_dim[1:], training=True, dataset=0)
+    curr_bytes += (frame_bytes - np.prod(input_dim[1:]) * bytes) * input_dim[0]
 
     return curr_bytes * 1.2  # safety blanket
 
@@ -8,6 +8,7 @@ import pickle
 from behavenet.fitting.eval import export_states
 from behavenet.fitting.eval import export_train_plots
 from behavenet.fitting.hyperparam_utils import get_all_params
+from behavenet.fitting.metrics import MetricsLogger
 from behavenet.fitting.utils import _clean_tt_dir
 from behavenet.fitting.utils import _print_hparams
 from behavenet.fitting.utils import build_data_generator
@@ -119,6 +120,10 @@ def main(hparams):
 
     # TODO: move fitting into own function
     # TODO: adopt early stopping strategy from ssm
+
+    # log metrics in the background
+    logger = MetricsLogger(exp)
+
     # precompute normalizers
     n_datapoints = {}
     n_datapoints_sess = {}
@@ -139,14 +144,14 @@ def main(hparams):
         # export aggregated metrics on train/val data
         tr_ll = hmm.log_likelihood(latents['train']) / n_datapoints['train']
         val_ll = hmm.log_likelihood(latents['val']) / n_datapoints['val']
-        exp.log({
+        logger.log({
             'epoch': epoch, 'dataset': -1, 'tr_loss': tr_ll, 'val_loss': val_ll, 'trial': -1})
 
         # export individual session metrics on train/val data
         for d in range(data_generator.n_datasets):
             tr_ll = hmm.log_likelihood(latents_sess[d]['train']) / n_datapoints_sess['train'][d]
             val_ll = hmm.log_likelihood(latents_sess[d]['val']) / n_datapoints_sess['val'][d]
-            exp.log({
+            logger.log({
                 'epoch': epoch, 'dataset': d, 'tr_loss': tr_ll, 'val_loss': val_ll, 'trial': -1})
 
     # export individual session metrics on test data
@@ -154,8 +159,8 @@ def main(hparams):
         for i, b in enumerate(trial_idxs_sess[d]['test']):
             n = latents_sess[d]['test'][i].size
             test_ll = hmm.log_likelihood(latents_sess[d]['test'][i]) / n
-            exp.log({'epoch': epoch, 'dataset': d, 'test_loss': test_ll, 'trial': b})
-    exp.save()
+            logger.log({'epoch': epoch, 'dataset': d, 'test_loss': test_ll, 'trial': b})
+    logger.close()
 
     # reconfigure model/states by usage
     zs = [hmm.most_likely_states(x) for x in latents['train']]
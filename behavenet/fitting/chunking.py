@@ -0,0 +1,239 @@
+"""Plan how many frames are passed through a model at once.
+
+Trials (or frame windows) that are too large to be processed at once are split into chunks of
+frames; gradients are accumulated across chunks during training. Rather than using a fixed chunk
+size, the functions in this module derive the chunk size from a memory budget (the hparam
+:obj:`mem_limit_gb`) and an estimate of the memory required per frame, following the same
+accounting as :func:`behavenet.fitting.ae_model_architecture_generator.estimate_model_footprint`:
+
+- the memory required by the model itself (parameters, plus gradients and adam moments during
+  training)
+- the input data
+- intermediate layer values, and their gradients during training; without gradients only the
+  input and output of a single layer are needed at any time
+- for layers with activation checkpointing (see :func:`behavenet.models.aes.checkpoint_layer`),
+  only the output of the layer is stored during training, and the intermediate values of a single
+  checkpointed layer at a time are recomputed during the backward pass
+- an additional 20% fudge factor
+
+Per-frame costs are measured by passing a few frames through the model, so that the estimate
+applies to any model (autoencoders and decoders) and to the dtypes actually used. If no memory
+budget is set, chunks contain a fixed number of frames (:obj:`DEFAULT_CHUNK_SIZE`), as in previous
+versions of BehaveNet.
+
+"""
+
+import numpy as np
+import torch
+from behavenet.fitting.precision import get_autocast
+
+# chunk size used if the hparam `mem_limit_gb` is not set
+DEFAULT_CHUNK_SIZE = 200
+
+# safety factor applied to all estimates
+FUDGE_FACTOR = 1.2
+
+
+def _get_n_bytes(output):
+    """Return the total number of bytes of all tensors in a (nested) module output."""
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    elif isinstance(output, (list, tuple)):
+        return sum([_get_n_bytes(out) for out in output])
+    else:
+        return 0
+
+
+def estimate_param_bytes(model, training=True):
+    """Estimate the memory required by the parameters of a model.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+    training : :obj:`bool`, optional
+        :obj:`True` to include gradients and the two moment estimates of the adam optimizer for
+        all parameters that are updated
+
+    Returns
+    -------
+    :obj:`int`
+        estimated size in bytes
+
+    """
+    n_bytes = 0
+    for p in model.parameters():
+        n_bytes_p = p.numel() * p.element_size()
+        if training and p.requires_grad:
+            # values, gradients, adam moments
+            n_bytes += 4 * n_bytes_p
+        else:
+            n_bytes += n_bytes_p
+    return n_bytes
+
+
+def _get_checkpointed_layers(model):
+    """Return the modules of all checkpointed layers of a model."""
+    checkpointed_layers = []
+    for mod in model.modules():
+        if hasattr(mod, 'get_checkpointed_layers'):
+            checkpointed_layers += mod.get_checkpointed_layers()
+    return checkpointed_layers
+
+
+def estimate_frame_bytes(
+        model, frame_dim, training=True, n_frames=4, precision='fp32', **kwargs):
+    """Estimate the memory required per frame passed through a model.
+
+    A batch of :obj:`n_frames` frames is passed through the model (without gradients and in
+    evaluation mode, so that the model is not modified), and the outputs of all layers are
+    recorded. Models declare layers with activation checkpointing through a
+    :obj:`get_checkpointed_layers` method of any of their modules, which returns the modules of
+    each checkpointed layer (see e.g.
+    :meth:`behavenet.models.aes.ConvAEEncoder.get_checkpointed_layers`).
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+    frame_dim : :obj:`array-like`
+        dimensions of a single frame of model input, e.g. (n_channels, y_pix, x_pix) for
+        autoencoders or (n_channels,) for decoders
+    training : :obj:`bool`, optional
+        :obj:`True` to account for storing all intermediate values and their gradients for the
+        backward pass; :obj:`False` to only account for the largest layer
+    n_frames : :obj:`int`, optional
+        number of frames passed through the model
+    precision : :obj:`str`, optional
+        precision of the forward pass (see :mod:`behavenet.fitting.precision`)
+    kwargs
+        additional keyword arguments for the forward pass of the model (e.g. :obj:`dataset`)
+
+    Returns
+    -------
+    :obj:`float`
+        estimated size in bytes per frame
+
+    """
+
+    layer_bytes = []
+    layer_modules = []
+
+    def hook(module, inputs, output):
+        layer_bytes.append(_get_n_bytes(output))
+        layer_modules.append(module)
+
+    # only record the outputs of leaf modules, which are the actual layers
+    handles = [
+        mod.register_forward_hook(hook) for mod in model.modules()
+        if len(list(mod.children())) == 0]
+
+    param = next(model.parameters())
+    x = torch.zeros((n_frames,) + tuple(frame_dim), dtype=param.dtype, device=param.device)
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad(), get_autocast(precision, param.device):
+            model(x, **kwargs)
+    finally:
+        model.train(was_training)
+        for handle in handles:
+            handle.remove()
+
+    if training:
+        # checkpointed layers only store their output; the intermediate values of one
+        # checkpointed layer at a time are recomputed during the backward pass
+        checkpointed = {}
+        for i_layer, modules in enumerate(_get_checkpointed_layers(model)):
+            for mod in modules:
+                checkpointed[mod] = i_layer
+        stored_bytes = 0
+        recomputed_bytes = {}
+        output_bytes = {}
+        for mod, n_bytes in zip(layer_modules, layer_bytes):
+            if mod in checkpointed:
+                i_layer = checkpointed[mod]
+                recomputed_bytes[i_layer] = recomputed_bytes.get(i_layer, 0) + n_bytes
+                output_bytes[i_layer] = n_bytes  # output of last module is the layer output
+            else:
+                stored_bytes += n_bytes
+        stored_bytes += np.sum(list(output_bytes.values()))
+        stored_bytes += np.max(list(recomputed_bytes.values()) + [0])
+        # store values AND gradients of all layers
+        n_bytes = 2 * stored_bytes
+    else:
+        # input and output of the largest layer
+        n_bytes = 2 * np.max(layer_bytes)
+    # input data
+    n_bytes += x.numel() * x.element_size()
+
+    return n_bytes / n_frames
+
+
+def plan_chunk_size(
+        model, frame_dim, mem_limit_gb=None, training=True, pad=0, max_size=None,
+        precision='fp32', **kwargs):
+    """Return the largest number of frames that can be passed through a model at once.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+    frame_dim : :obj:`array-like`
+        dimensions of a single frame of model input (see :func:`estimate_frame_bytes`)
+    mem_limit_gb : :obj:`float` or :obj:`NoneType`, optional
+        memory budget in GB; if :obj:`NoneType`, the chunk size is :obj:`DEFAULT_CHUNK_SIZE`
+    training : :obj:`bool`, optional
+        :obj:`True` if gradients are computed
+    pad : :obj:`int`, optional
+        number of frames added to either side of each chunk (e.g. :obj:`n_max_lags` for decoders);
+        the chunk size counts the frames without this padding
+    max_size : :obj:`int` or :obj:`NoneType`, optional
+        upper limit of the chunk size, e.g. the number of frames in a trial
+    precision : :obj:`str`, optional
+        precision of the forward pass (see :mod:`behavenet.fitting.precision`)
+    kwargs
+        additional keyword arguments for the forward pass of the model (e.g. :obj:`dataset`)
+
+    Returns
+    -------
+    :obj:`int`
+        chunk size (at least 1)
+
+    """
+    if mem_limit_gb is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    else:
+        n_bytes_budget = mem_limit_gb * 1e9 / FUDGE_FACTOR
+        n_bytes_budget -= estimate_param_bytes(model, training=training)
+        n_bytes_frame = estimate_frame_bytes(
+            model, frame_dim, training=training, precision=precision, **kwargs)
+        chunk_size = int(n_bytes_budget // n_bytes_frame) - 2 * pad
+    if max_size is not None:
+        chunk_size = min(chunk_size, max_size)
+    return max(chunk_size, 1)
+
+
+def get_chunks(n_frames, chunk_size, pad=0):
+    """Split a batch of frames into chunks.
+
+    Parameters
+    ----------
+    n_frames : :obj:`int`
+        number of frames in the batch
+    chunk_size : :obj:`int`
+        number of frames per chunk, not counting padding
+    pad : :obj:`int`, optional
+        number of frames added to either side of each chunk where available, e.g. to provide
+        :obj:`n_max_lags` frames of context for decoders; the padding of adjacent chunks overlaps
+
+    Returns
+    -------
+    :obj:`list` of :obj:`tuple`
+        (idx_beg, idx_end) of each chunk, including padding
+
+    """
+    n_chunks = int(np.ceil(n_frames / chunk_size))
+    chunks = []
+    for chunk in range(n_chunks):
+        idx_beg = max(chunk * chunk_size - pad, 0)
+        idx_end = min((chunk + 1) * chunk_size + pad, n_frames)
+        chunks.append((idx_beg, idx_end))
+    return chunks
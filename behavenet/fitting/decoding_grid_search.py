@@ -5,6 +5,8 @@ import random
 import torch
 import pickle
 
+from behavenet.fitting.distributed import is_main_process
+from behavenet.fitting.distributed import run_distributed
 from behavenet.fitting.hyperparam_utils import get_all_params
 from behavenet.fitting.training import fit
 from behavenet.fitting.utils import _clean_tt_dir
@@ -33,25 +35,48 @@ def main(hparams, *args):
         print('Experiment exists! Aborting fit')
         return
 
+    if hparams.get('n_train_processes', 1) > 1:
+        # fit data-parallel; the test-tube experiment is only used by the main process
+        run_distributed(
+            _train, hparams['n_train_processes'], args=(hparams, sess_ids),
+            main_kwargs={'exp': exp})
+    else:
+        _train(hparams, sess_ids, exp)
+
+
+def _train(hparams, sess_ids, exp=None):
+    """Build data generator and model, and fit model; called by each process of a distributed fit.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        model/training specification
+    sess_ids : :obj:`list` of :obj:`dict`
+        sessions used for fitting
+    exp : :obj:`test_tube.Experiment` object or :obj:`NoneType`, optional
+        test-tube experiment; :obj:`NoneType` for all but the main process of a distributed fit
+
+    """
+
     # build data generator
-    data_generator = build_data_generator(hparams, sess_ids)
+    data_generator = build_data_generator(hparams, sess_ids, export_csv=is_main_process())
 
-    ex_trial = data_generator.datasets[0].batch_idxs['train'][0]
+    dataset = data_generator.datasets[0]
     i_sig = hparams['input_signal']
     o_sig = hparams['output_signal']
 
     if hparams['model_class'] == 'neural-arhmm':
-        hparams['input_size'] = data_generator.datasets[0][ex_trial][i_sig].shape[1]
+        hparams['input_size'] = dataset.get_signal_shape(i_sig)[0]
         hparams['output_size'] = hparams['n_arhmm_states']
     elif hparams['model_class'] == 'arhmm-neural':
         hparams['input_size'] = hparams['n_arhmm_states']
-        hparams['output_size'] = data_generator.datasets[0][ex_trial][o_sig].shape[1]
+        hparams['output_size'] = dataset.get_signal_shape(o_sig)[0]
     elif hparams['model_class'] == 'neural-ae':
-        hparams['input_size'] = data_generator.datasets[0][ex_trial][i_sig].shape[1]
+        hparams['input_size'] = dataset.get_signal_shape(i_sig)[0]
         hparams['output_size'] = hparams['n_ae_latents']
     elif hparams['model_class'] == 'ae-neural':
         hparams['input_size'] = hparams['n_ae_latents']
-        hparams['output_size'] = data_generator.datasets[0][ex_trial][o_sig].shape[1]
+        hparams['output_size'] = dataset.get_signal_shape(o_sig)[0]
     else:
         raise ValueError('%s is an invalid model class' % hparams['model_class'])
 
@@ -78,13 +103,15 @@ def main(hparams, *args):
     hparams['model_build_rnd_seed'] = torch_rnd_seed
     model = Decoder(hparams)
     model.to(hparams['device'])
-    model.version = exp.version
+    model.version = hparams['version']
     torch_rnd_seed = torch.get_rng_state()
     hparams['training_rnd_seed'] = torch_rnd_seed
 
     # save out hparams as csv and dict for easy reloading
     hparams['training_completed'] = False
-    export_hparams(hparams, exp)
+    hparams['precision'] = hparams.get('precision', 'fp32')
+    if is_main_process():
+        export_hparams(hparams, exp)
     print('done')
 
     # ####################
@@ -92,6 +119,8 @@ def main(hparams, *args):
     # ####################
 
     fit(hparams, model, data_generator, exp, method='nll')
+    if not is_main_process():
+        return
 
     # update hparams upon successful training
     hparams['training_completed'] = True
@@ -112,6 +141,11 @@ if __name__ == '__main__':
         gpu_ids = hyperparams.gpus_viz.split(';')
         hyperparams.optimize_parallel_gpu(main, gpu_ids=gpu_ids)
 
+    elif hyperparams.device == 'cpu' and getattr(hyperparams, 'n_train_processes', 1) > 1:
+        # each fit already uses multiple processes; fit hyperparameter combinations sequentially
+        for trial in hyperparams.trials(hyperparams.tt_n_cpu_trials):
+            main(trial)
+
     elif hyperparams.device == 'cpu':
         hyperparams.optimize_parallel_cpu(
             main,
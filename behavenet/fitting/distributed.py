@@ -0,0 +1,258 @@
+"""Data-parallel fitting of pytorch models across cpu processes.
+
+A fit can be distributed over several processes (ranks) that form a :mod:`torch.distributed`
+process group with the gloo backend, e.g. to use all cores of a machine for a single model:
+
+- every pass through the data is split into disjoint shards of the (session, trial) schedule of
+  the data generator, one shard per rank (see :func:`shard_schedule`)
+- after each batch, gradients are averaged over all ranks (see :func:`all_reduce_gradients`), so
+  that every rank takes the same optimizer step and model parameters remain identical; each
+  optimizer step therefore combines one batch from each rank
+- loss metrics are accumulated by each rank and summed over all ranks before they are read (see
+  :func:`all_reduce_metrics`), so that aggregate and per-dataset metrics are the same as those of
+  a single process
+- only rank 0 logs metrics, saves checkpoints and models, and computes test metrics and exports
+
+Processes are started with :func:`run_distributed`; :func:`behavenet.fitting.training.fit` can
+also be called from processes started by another launcher (e.g. :obj:`torchrun`) once the process
+group is initialized. If no process group is initialized, all functions in this module fall back
+to single-process behavior.
+
+"""
+
+import copy
+import os
+import sys
+import tempfile
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    """Return :obj:`True` if running in a process group with more than one process."""
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    """Return the rank of the current process (0 if not distributed)."""
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """Return the number of processes (1 if not distributed)."""
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Return :obj:`True` for the process that logs metrics and saves models (rank 0)."""
+    return get_rank() == 0
+
+
+def run_distributed(fn, n_processes, args=(), main_kwargs=None):
+    """Run a function in several processes that form a process group with the gloo backend.
+
+    Rank 0 runs in the calling process; the remaining ranks are started as new processes (with the
+    'spawn' start method), so that :obj:`fn` and :obj:`args` need to be picklable. The cores of
+    the machine are split evenly among all processes. Standard output of all but rank 0 is
+    discarded.
+
+    Parameters
+    ----------
+    fn : :obj:`callable`
+        module-level function run by every process as :obj:`fn(*args)`
+    n_processes : :obj:`int`
+        total number of processes (ranks)
+    args : :obj:`tuple`, optional
+        arguments of :obj:`fn`
+    main_kwargs : :obj:`dict` or :obj:`NoneType`, optional
+        additional keyword arguments of :obj:`fn` that are only passed to rank 0, e.g. objects
+        that cannot be pickled such as a test-tube experiment
+
+    Returns
+    -------
+    output of :obj:`fn` on rank 0
+
+    """
+    import torch.multiprocessing as mp
+
+    # file used by the processes to find each other; must not exist yet
+    init_dir = tempfile.mkdtemp()
+    init_method = 'file://' + os.path.join(init_dir, 'init')
+    n_threads = max(1, (os.cpu_count() or 1) // n_processes)
+
+    ctx = mp.get_context('spawn')
+    processes = []
+    for rank in range(1, n_processes):
+        process = ctx.Process(
+            target=_run_process, args=(fn, args, rank, n_processes, init_method, n_threads))
+        process.start()
+        processes.append(process)
+
+    n_threads_prev = torch.get_num_threads()
+    try:
+        output = _run_process(
+            fn, args, 0, n_processes, init_method, n_threads, kwargs=main_kwargs)
+    except BaseException:
+        # the other ranks would otherwise wait for rank 0 until the process group times out
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        torch.set_num_threads(n_threads_prev)
+        for process in processes:
+            process.join()
+        if os.path.exists(os.path.join(init_dir, 'init')):
+            os.remove(os.path.join(init_dir, 'init'))
+        os.rmdir(init_dir)
+
+    failed = [rank for rank, process in enumerate(processes, 1) if process.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError('distributed processes %s exited with an error' % failed)
+    return output
+
+
+def _run_process(fn, args, rank, world_size, init_method, n_threads, kwargs=None):
+    torch.set_num_threads(n_threads)
+    if rank > 0:
+        sys.stdout = open(os.devnull, 'w')
+    dist.init_process_group(
+        'gloo', init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        return fn(*args, **(kwargs or {}))
+    finally:
+        dist.destroy_process_group()
+
+
+def broadcast_model(model):
+    """Copy parameters and buffers (e.g. batch norm statistics) of rank 0 to all ranks.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, 0)
+
+
+def broadcast_buffers(model):
+    """Copy buffers (e.g. batch norm statistics) of rank 0 to all ranks.
+
+    Buffers are updated by the forward pass on each rank's own data; broadcasting them after each
+    optimizer step keeps all ranks identical, as in
+    :obj:`torch.nn.parallel.DistributedDataParallel`.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for buffer in model.buffers():
+            dist.broadcast(buffer.data, 0)
+
+
+def shard_schedule(data_generator, dtype):
+    """Restrict the current pass through the data to the shard of the current rank.
+
+    The schedule of rank 0 (see
+    :meth:`behavenet.data.data_generator.ConcatSessionsGenerator.get_schedule`) is broadcast to
+    all ranks, and rank :obj:`r` serves every :obj:`world_size`-th batch of this schedule starting
+    with batch :obj:`r`. Must be called by all ranks after the iterators of :obj:`dtype` are
+    reset.
+
+    Parameters
+    ----------
+    data_generator : :obj:`ConcatSessionsGenerator` object
+    dtype : :obj:`str`
+        'train' | 'val' | 'test'
+
+    Returns
+    -------
+    :obj:`int`
+        number of batches served to the current rank
+
+    """
+    if not is_distributed():
+        return data_generator.n_tot_batches[dtype]
+    schedule = torch.from_numpy(data_generator.get_schedule(dtype))
+    dist.broadcast(schedule, 0)
+    schedule = schedule.numpy()[get_rank()::get_world_size()]
+    data_generator.set_schedule(dtype, schedule)
+    return len(schedule)
+
+
+def get_n_steps(n_batches):
+    """Return the number of optimizer steps needed for all ranks to process :obj:`n_batches`."""
+    return int(np.ceil(n_batches / get_world_size()))
+
+
+def all_reduce_gradients(parameters, has_batch=True):
+    """Average gradients over all ranks.
+
+    Gradients are averaged over the ranks that processed a batch in the current step; all ranks
+    need to call this function, including those without a batch (e.g. in the last step of an
+    epoch). Parameters without gradients on any rank (e.g. unused session-specific layers) keep
+    their gradient set to :obj:`NoneType`.
+
+    Parameters
+    ----------
+    parameters : :obj:`iterable` of :obj:`torch.Tensor`
+        model parameters
+    has_batch : :obj:`bool`, optional
+        :obj:`True` if the current rank processed a batch in the current step
+
+    """
+    if not is_distributed():
+        return
+    parameters = list(parameters)
+    # all gradients, flags for gradients that exist, and the number of ranks with a batch are
+    # reduced in a single call
+    values = []
+    for param in parameters:
+        if param.grad is None:
+            values.append(torch.zeros(param.numel(), dtype=param.dtype, device=param.device))
+        else:
+            values.append(param.grad.detach().reshape(-1))
+    has_grad = [float(param.grad is not None) for param in parameters]
+    values.append(torch.tensor(has_grad + [float(has_batch)], dtype=values[0].dtype))
+    values = torch.cat(values)
+    dist.all_reduce(values)
+
+    n_ranks = values[-1]
+    has_grad = values[-(len(parameters) + 1):-1]
+    idx_beg = 0
+    for i, param in enumerate(parameters):
+        idx_end = idx_beg + param.numel()
+        if has_grad[i] > 0:
+            param.grad = (values[idx_beg:idx_end] / n_ranks).view_as(param)
+        else:
+            param.grad = None
+        idx_beg = idx_end
+
+
+def all_reduce_metrics(metrics):
+    """Sum accumulated metrics over all ranks.
+
+    Parameters
+    ----------
+    metrics : :obj:`behavenet.fitting.metrics.MetricAccumulator` object
+        metrics accumulated by the current rank
+
+    Returns
+    -------
+    :obj:`behavenet.fitting.metrics.MetricAccumulator` object
+        new accumulator with metrics summed over all ranks
+
+    """
+    reduced = copy.copy(metrics)
+    reduced.values = metrics.values.clone()
+    if is_distributed():
+        dist.all_reduce(reduced.values)
+    return reduced
@@ -1,6 +1,14 @@
 """Utility functions for evaluating model fits."""
 
 import numpy as np
+import torch
+from behavenet.data.data_generator import images_to_float
+from behavenet.data.storage import export_ragged
+from behavenet.fitting.chunking import get_chunks
+from behavenet.fitting.chunking import plan_chunk_size
+from behavenet.fitting.inference import get_inference_engine
+from behavenet.fitting.inference import use_inference_engine
+from behavenet.fitting.precision import get_autocast
 from behavenet.fitting.utils import get_best_model_and_data
 
 
@@ -8,7 +16,18 @@ def export_latents(data_generator, model, filename=None):
     """Export predicted latents using an already initialized data_generator and model.
 
     Latents are saved based on the model's hparams dict unless another file is provided. The
-    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_latents.pkl`.
+    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_latents.pkl`; the data is
+    stored in an indexed format next to this filename (see
+    :func:`behavenet.data.storage.export_ragged`) so that individual trials can be loaded without
+    reading the whole file. The pickle file itself is also written unless the model hparam
+    :obj:`export_pkl` is :obj:`False`.
+
+    If the model hparam :obj:`inference_engine` is :obj:`True`, latents are computed with a
+    compiled, frozen copy of the encoder (see :mod:`behavenet.fitting.inference`). Otherwise trials
+    are processed by the model in chunks of frames whose size is planned from the memory budget
+    :obj:`mem_limit_gb` in the model hparams (see :mod:`behavenet.fitting.chunking`). In both cases
+    forward passes run in the precision set by the model hparam :obj:`precision` (see
+    :mod:`behavenet.fitting.precision`).
 
     Parameters
     ----------
@@ -21,10 +40,14 @@ def export_latents(data_generator, model, filename=None):
 
     """
 
-    import pickle
     import os
 
     model.eval()
+    mem_limit_gb = model.hparams.get('mem_limit_gb', None)
+    precision = model.hparams.get('precision', 'fp32')
+    device = next(model.parameters()).device
+    chunk_size = None
+    use_engine = use_inference_engine(model)
 
     # initialize container for latents
     latents = [[] for _ in range(data_generator.n_datasets)]
@@ -39,29 +62,35 @@ def export_latents(data_generator, model, filename=None):
             data, sess = data_generator.next_batch(dtype)
 
             if next(model.parameters()).is_cuda:
-                data = {key: val.to('cuda') for key, val in data.items()}
+                data = {key: val.to('cuda', non_blocking=True) for key, val in data.items()}
+
+            y = images_to_float(data['images'][0])
+            if use_engine:
+                # the engine chooses its own batch size
+                curr_latents = get_inference_engine(model, dataset=sess).encode(y)
+                latents[sess][data['batch_idx'].item()] = curr_latents.cpu().numpy()
+                continue
 
             # process batch, perhaps in chunks if full batch is too large to fit on gpu
-            chunk_size = 200
-            y = data['images'][0]
+            if chunk_size is None:
+                chunk_size = plan_chunk_size(
+                    model, y.shape[1:], training=False, dataset=sess, precision=precision,
+                    mem_limit_gb=None if mem_limit_gb is None else float(mem_limit_gb))
             batch_size = y.shape[0]
-            if batch_size > chunk_size:
-                latents[sess][data['batch_idx'].item()] = np.full(
-                    shape=(data['images'].shape[1], model.hparams['n_ae_latents']),
-                    fill_value=np.nan)
-                # split into chunks
-                n_chunks = int(np.ceil(batch_size / chunk_size))
-                for chunk in range(n_chunks):
-                    # take chunks of size chunk_size, plus overlap due to
-                    # max_lags
-                    idx_beg = chunk * chunk_size
-                    idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
-                    curr_latents, _, _ = model.encoding(y[idx_beg:idx_end], dataset=sess)
-                    latents[sess][data['batch_idx'].item()][idx_beg:idx_end, :] = \
-                        curr_latents.cpu().detach().numpy()
-            else:
-                curr_latents, _, _ = model.encoding(y, dataset=sess)
-                latents[sess][data['batch_idx'].item()] = curr_latents.cpu().detach().numpy()
+            with torch.no_grad(), get_autocast(precision, device):
+                if batch_size > chunk_size:
+                    latents[sess][data['batch_idx'].item()] = np.full(
+                        shape=(data['images'].shape[1], model.hparams['n_ae_latents']),
+                        fill_value=np.nan)
+                    # split into chunks
+                    for idx_beg, idx_end in get_chunks(batch_size, chunk_size):
+                        curr_latents, _, _ = model.encoding(y[idx_beg:idx_end], dataset=sess)
+                        latents[sess][data['batch_idx'].item()][idx_beg:idx_end, :] = \
+                            curr_latents.float().cpu().detach().numpy()
+                else:
+                    curr_latents, _, _ = model.encoding(y, dataset=sess)
+                    latents[sess][data['batch_idx'].item()] = \
+                        curr_latents.float().cpu().detach().numpy()
 
     # save latents separately for each dataset
     for sess, dataset in enumerate(data_generator.datasets):
@@ -69,20 +98,25 @@ def export_latents(data_generator, model, filename=None):
             # get save name which includes lab/expt/animal/session
             sess_id = str('%s_%s_%s_%s_latents.pkl' % (
                 dataset.lab, dataset.expt, dataset.animal, dataset.session))
-            filename = os.path.join(
+            filename_ = os.path.join(
                 model.hparams['expt_dir'], 'version_%i' % model.version, sess_id)
-        # save out array in pickle file
-        print('saving latents %i of %i:\n%s' % (sess + 1, data_generator.n_datasets, filename))
-        latents_dict = {'latents': latents[sess], 'trials': dataset.batch_idxs}
-        with open(filename, 'wb') as f:
-            pickle.dump(latents_dict, f)
+        else:
+            filename_ = filename
+        # save out arrays in indexed store
+        print('saving latents %i of %i:\n%s' % (sess + 1, data_generator.n_datasets, filename_))
+        export_ragged(
+            filename_, latents[sess], key='latents', trials=dataset.batch_idxs,
+            export_pkl=model.hparams.get('export_pkl', True))
 
 
 def export_states(hparams, data_generator, model, filename=None):
     """Export predicted latents using an already initialized data_generator and model.
 
     States are saved based on the hparams dict unless another file is provided. The default
-    filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_states.pkl`.
+    filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_states.pkl`; the data is stored in an
+    indexed format next to this filename (see :func:`behavenet.data.storage.export_ragged`) so that
+    individual trials can be loaded without reading the whole file. The pickle file itself is also
+    written unless the hparam :obj:`export_pkl` is :obj:`False`.
 
     Parameters
     ----------
@@ -97,7 +131,6 @@ def export_states(hparams, data_generator, model, filename=None):
 
     """
 
-    import pickle
     import os
 
     # initialize container for states
@@ -129,24 +162,35 @@ def export_states(hparams, data_generator, model, filename=None):
             # get save name which includes lab/expt/animal/session
             sess_id = str('%s_%s_%s_%s_states.pkl' % (
                 dataset.lab, dataset.expt, dataset.animal, dataset.session))
-            filename = os.path.join(
+            filename_ = os.path.join(
                 hparams['expt_dir'], 'version_%i' % hparams['version'], sess_id)
-        # save out array in pickle file
-        print('saving states %i of %i:\n%s' % (sess + 1, data_generator.n_datasets, filename))
-        states_dict = {'states': states[sess], 'trials': dataset.batch_idxs}
-        with open(filename, 'wb') as f:
-            pickle.dump(states_dict, f)
+        else:
+            filename_ = filename
+        # save out arrays in indexed store
+        print('saving states %i of %i:\n%s' % (sess + 1, data_generator.n_datasets, filename_))
+        export_ragged(
+            filename_, states[sess], key='states', trials=dataset.batch_idxs,
+            export_pkl=hparams.get('export_pkl', True))
 
 
 def export_predictions(data_generator, model, filename=None):
     """Export decoder predictions using an already initialized data_generator and model.
 
     Predictions are saved based on the model's hparams dict unless another file is provided. The
-    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_predictions.pkl`.
+    default filename is `[lab_id]_[expt_id]_[animal_id]_[session_id]_predictions.pkl`; the data is
+    stored in an indexed format next to this filename (see
+    :func:`behavenet.data.storage.export_ragged`) so that individual trials can be loaded without
+    reading the whole file. The pickle file itself is also written unless the model hparam
+    :obj:`export_pkl` is :obj:`False`.
 
     This function only supports pytorch decoding models - not autoencoders. To get AE
     reconstructions see the `get_reconstruction` function in this module.
 
+    Trials are processed in chunks of frames whose size is planned from the memory budget
+    :obj:`mem_limit_gb` in the model hparams (see :mod:`behavenet.fitting.chunking`); each chunk
+    is padded with :obj:`n_max_lags` frames on either side. Forward passes run in the precision set
+    by the model hparam :obj:`precision` (see :mod:`behavenet.fitting.precision`).
+
     Parameters
     ----------
     data_generator : :obj:`ConcatSessionGenerator` object
@@ -158,10 +202,13 @@ def export_predictions(data_generator, model, filename=None):
 
     """
 
-    import pickle
     import os
 
     model.eval()
+    mem_limit_gb = model.hparams.get('mem_limit_gb', None)
+    precision = model.hparams.get('precision', 'fp32')
+    device = next(model.parameters()).device
+    chunk_size = None
 
     # initialize container for latents
     predictions = [[] for _ in range(data_generator.n_datasets)]
@@ -177,7 +224,7 @@ def export_predictions(data_generator, model, filename=None):
             data, sess = data_generator.next_batch(dtype)
 
             if next(model.parameters()).is_cuda:
-                data = {key: val.to('cuda') for key, val in data.items()}
+                data = {key: val.to('cuda', non_blocking=True) for key, val in data.items()}
 
             predictors = data[model.hparams['input_signal']][0]
             targets = data[model.hparams['output_signal']][0]
@@ -188,41 +235,42 @@ def export_predictions(data_generator, model, filename=None):
 
             # process batch, perhaps in chunks if full batch is too large
             # to fit on gpu
-            chunk_size = 200
+            if chunk_size is None:
+                chunk_size = plan_chunk_size(
+                    model, predictors.shape[1:], training=False, pad=max_lags, precision=precision,
+                    mem_limit_gb=None if mem_limit_gb is None else float(mem_limit_gb))
             batch_size = targets.shape[0]
-            if batch_size > chunk_size:
-                # split into chunks
-                n_chunks = int(np.ceil(batch_size / chunk_size))
-                for chunk in range(n_chunks):
-                    # take chunks of size chunk_size, plus overlap due to
-                    # max_lags
-                    idx_beg = np.max([chunk * chunk_size - max_lags, 0])
-                    idx_end = np.min([(chunk + 1) * chunk_size + max_lags, batch_size])
-                    outputs, _ = model(predictors[idx_beg:idx_end])
-                    slc = (idx_beg + max_lags, idx_end - max_lags)
-                    predictions[sess][data['batch_idx'].item()][slice(*slc), :] = \
-                        outputs[max_lags:-max_lags].cpu().detach().numpy()
-            else:
-                outputs, _ = model(predictors)
-                slc = (max_lags, -max_lags)
+            with torch.no_grad(), get_autocast(precision, device):
+                if batch_size > chunk_size:
+                    # split into chunks of size chunk_size, plus overlap due to max_lags
+                    for idx_beg, idx_end in get_chunks(batch_size, chunk_size, pad=max_lags):
+                        outputs, _ = model(predictors[idx_beg:idx_end])
+                        slc = (idx_beg + max_lags, idx_end - max_lags)
+                        predictions[sess][data['batch_idx'].item()][slice(*slc), :] = \
+                            outputs[max_lags:-max_lags].float().cpu().detach().numpy()
+                else:
+                    outputs, _ = model(predictors)
+                    slc = (max_lags, -max_lags)
 
-                predictions[sess][data['batch_idx'].item()][slice(*slc), :] = \
-                    outputs[max_lags:-max_lags].cpu().detach().numpy()
+                    predictions[sess][data['batch_idx'].item()][slice(*slc), :] = \
+                        outputs[max_lags:-max_lags].float().cpu().detach().numpy()
 
-    # save latents separately for each dataset
+    # save predictions separately for each dataset
     for sess, dataset in enumerate(data_generator.datasets):
         if filename is None:
             # get save name which includes lab/expt/animal/session
             sess_id = str('%s_%s_%s_%s_predictions.pkl' % (
                 dataset.lab, dataset.expt, dataset.animal, dataset.session))
-
-            filename = os.path.join(
+            filename_ = os.path.join(
                 model.hparams['expt_dir'], 'version_%i' % model.version, sess_id)
-        # save out array in pickle file
-        print('saving latents %i of %i to %s' % (sess + 1, data_generator.n_datasets, filename))
-        predictions_dict = {'predictions': predictions[sess], 'trials': dataset.batch_idxs}
-        with open(filename, 'wb') as f:
-            pickle.dump(predictions_dict, f)
+        else:
+            filename_ = filename
+        # save out arrays in indexed store
+        print('saving predictions %i of %i to %s' % (
+            sess + 1, data_generator.n_datasets, filename_))
+        export_ragged(
+            filename_, predictions[sess], key='predictions', trials=dataset.batch_idxs,
+            export_pkl=model.hparams.get('export_pkl', True))
 
 
 def export_latents_best(hparams, filename=None, export_all=False):
@@ -277,12 +325,18 @@ def export_predictions_best(hparams, filename=None, export_all=False):
 def get_reconstruction(model, inputs, dataset=None, return_latents=False):
     """Reconstruct an image from either image or latent inputs.
 
+    The forward pass runs in the precision set by the model hparam :obj:`precision` (see
+    :mod:`behavenet.fitting.precision`). If the model hparam :obj:`inference_engine` is
+    :obj:`True` and the model is in evaluation mode, images are reconstructed by a compiled,
+    frozen copy of the model (see :mod:`behavenet.fitting.inference`).
+
     Parameters
     ----------
     model : :obj:`AE` object
         pytorch model
     inputs : :obj:`torch.Tensor` object
-        - image tensor of shape (batch, channels, y_pix, x_pix)
+        - image tensor of shape (batch, channels, y_pix, x_pix); float values in [0, 1] or uint8
+          values in [0, 255]
         - latents tensor of shape (batch, n_ae_latents)
     dataset : :obj:`int` or :obj:`NoneType`, optional
         for use with session-specific io layers
@@ -297,6 +351,8 @@ def get_reconstruction(model, inputs, dataset=None, return_latents=False):
     """
     import torch
 
+    # uint8 images are converted on their current device
+    inputs = images_to_float(inputs)
     if not isinstance(inputs, torch.Tensor):
         inputs = torch.Tensor(inputs)
 
@@ -306,14 +362,19 @@ def get_reconstruction(model, inputs, dataset=None, return_latents=False):
     else:
         input_type = 'images'
 
-    if input_type == 'images':
-        ims_recon, latents = model(inputs, dataset=dataset)
+    precision = model.hparams.get('precision', 'fp32')
+    if input_type == 'images' and use_inference_engine(model):
+        ims_recon, latents = get_inference_engine(model, dataset=dataset).reconstruct(inputs)
     else:
-        # TODO: how to incorporate maxpool layers for decoding only?
-        ims_recon = model.decoding(inputs, None, None, dataset=None)
-        latents = inputs
-    ims_recon = ims_recon.cpu().detach().numpy()
-    latents = latents.cpu().detach().numpy()
+        with get_autocast(precision, next(model.parameters()).device):
+            if input_type == 'images':
+                ims_recon, latents = model(inputs, dataset=dataset)
+            else:
+                # TODO: how to incorporate maxpool layers for decoding only?
+                ims_recon = model.decoding(inputs, None, None, dataset=None)
+                latents = inputs
+    ims_recon = ims_recon.float().cpu().detach().numpy()
+    latents = latents.float().cpu().detach().numpy()
 
     if return_latents:
         return ims_recon, latents
@@ -405,15 +466,15 @@ def export_train_plots(hparams, dtype, loss_type='mse', save_file=None, format='
     import pandas as pd
     import seaborn as sns
     import matplotlib.pyplot as plt
+    from behavenet.fitting.metrics import load_metrics
     from behavenet.fitting.utils import read_session_info_from_csv
 
     sns.set_style('white')
     sns.set_context('talk')
 
-    # find metrics csv file
+    # load metrics file
     version_dir = os.path.join(hparams['expt_dir'], 'version_%i' % hparams['version'])
-    metric_file = os.path.join(version_dir, 'metrics.csv')
-    metrics = pd.read_csv(metric_file)
+    metrics = load_metrics(version_dir)
 
     # collect data from csv file
     sess_ids = read_session_info_from_csv(os.path.join(version_dir, 'session_info.csv'))
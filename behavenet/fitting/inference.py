@@ -0,0 +1,411 @@
+"""Compiled, frozen inference engines for trained autoencoders.
+
+Exporting latents (:func:`behavenet.fitting.eval.export_latents`) and reconstructing images
+(:func:`behavenet.fitting.eval.get_reconstruction`) only require forward passes of a trained model
+in evaluation mode. An :class:`InferenceEngine` compiles these forward passes once into TorchScript
+graphs that are specialized for inference:
+
+- the encoder has its own entry point (:meth:`InferenceEngine.encode`), in which max pooling
+  layers do not compute the pooling indices that are only needed by the decoder
+- graphs are traced for a single dataset, i.e. session-specific layers are selected when the
+  engine is built, so that the python loop over layers of the eager model is not run per batch
+- parameters are frozen into the graph as constants (:obj:`torch.jit.freeze`), which folds batch
+  norm layers into the preceding convolutions; :obj:`torch.jit.optimize_for_inference` then fuses
+  convolutions with their activations where the backend supports it (e.g. oneDNN on cpu)
+- weights and inputs of convolutional models use the channels-last memory format
+- with the hparam :obj:`precision='bf16'` all layers run on a bfloat16 copy of the weights,
+  rather than under autocast as during fitting (see :mod:`behavenet.fitting.precision`)
+- the number of frames per forward pass is chosen by timing candidate batch sizes up to the chunk
+  size planned from the memory budget (see :mod:`behavenet.fitting.chunking`), unless it is set
+  with the hparam :obj:`inference_batch_size`
+
+:func:`get_inference_engine` caches engines for each model, and rebuilds them if the parameters of
+the model have changed since. The encoder of an engine can be saved as a standalone TorchScript
+file (:meth:`InferenceEngine.save`) that is loaded without the model code
+(:meth:`InferenceEngine.load`).
+
+Engines are only used by the export functions if the hparam :obj:`inference_engine` is
+:obj:`True` (see :func:`use_inference_engine`); whether they are faster than the eager model
+depends on the pytorch build and the hardware (see :obj:`benchmarks/inference.py`), and building
+an engine (including tuning its batch size) takes several seconds per dataset. Inference engines
+require pytorch>=1.8.
+
+"""
+
+import copy
+import itertools
+import json
+import time
+import warnings
+import weakref
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as functional
+from behavenet.fitting.chunking import get_chunks
+from behavenet.fitting.chunking import plan_chunk_size
+from behavenet.fitting.precision import PRECISIONS
+from behavenet.models.aes import AE
+from behavenet.models.aes import ConvAEEncoder
+
+# largest batch size considered when tuning the batch size
+MAX_TUNED_BATCH_SIZE = 256
+
+# cached engines of each model
+_engines = weakref.WeakKeyDictionary()
+
+
+class _Encoder(nn.Module):
+    """Encoder forward pass of a single dataset without max pooling indices."""
+
+    def __init__(self, encoding, dataset=None, dtype=torch.float32, channels_last=False):
+        super().__init__()
+        self.encoding = encoding
+        self.dataset = dataset
+        self.dtype = dtype
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        x = x.to(self.dtype)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if isinstance(self.encoding, ConvAEEncoder):
+            for names in self.encoding.layers.values():
+                for name in names:
+                    layer = getattr(self.encoding.encoder, name)
+                    if isinstance(layer, nn.MaxPool2d):
+                        x = functional.max_pool2d(
+                            x, layer.kernel_size, layer.stride, layer.padding, layer.dilation,
+                            ceil_mode=layer.ceil_mode)
+                    elif isinstance(layer, nn.ModuleList):
+                        x = layer[self.dataset](x)
+                    else:
+                        x = layer(x)
+            x = self.encoding.FF(x.reshape(x.shape[0], -1))
+        else:
+            x, _, _ = self.encoding(x)
+        return x.float()
+
+
+class _Reconstructor(nn.Module):
+    """Full autoencoder forward pass of a single dataset."""
+
+    def __init__(self, model, dataset=None, dtype=torch.float32, channels_last=False):
+        super().__init__()
+        self.model = model
+        self.dataset = dataset
+        self.dtype = dtype
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        x = x.to(self.dtype)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        latents, pool_idx, output_size = self.model.encoding(x, dataset=self.dataset)
+        if output_size is None:
+            # linear autoencoder
+            y = self.model.decoding(latents)
+        else:
+            # spatial sizes of unpooled outputs are the same for all batches; python ints are
+            # traced as constants rather than as functions of the input
+            output_size = [tuple(int(dim) for dim in size[-2:]) for size in output_size]
+            y = self.model.decoding(latents, pool_idx, output_size, dataset=self.dataset)
+        return y.float(), latents.float()
+
+
+def _compile(module, example, optimize=True):
+    """Trace and freeze a module, and optimize it for inference on the current machine."""
+    with torch.no_grad(), warnings.catch_warnings():
+        # recent versions of pytorch deprecate torch.jit in favor of torch.compile
+        warnings.simplefilter('ignore', FutureWarning)
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(module.eval(), example)
+        frozen = torch.jit.freeze(traced)
+    if optimize:
+        frozen = _optimize(frozen)
+    return frozen
+
+
+def _optimize(frozen):
+    """Optimize a frozen module; optimized modules can no longer be saved."""
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        if hasattr(torch.jit, 'optimize_for_inference'):
+            frozen = torch.jit.optimize_for_inference(frozen)
+    return frozen
+
+
+def _run(function, x, batch_size):
+    """Run a compiled forward pass on batches of frames and concatenate the outputs."""
+    chunks = get_chunks(x.shape[0], batch_size) or [(0, 0)]
+    outputs = [function(x[idx_beg:idx_end]) for idx_beg, idx_end in chunks]
+    if isinstance(outputs[0], tuple):
+        return tuple(torch.cat(output) for output in zip(*outputs))
+    else:
+        return torch.cat(outputs)
+
+
+class InferenceEngine(object):
+    """Compiled, frozen forward passes of a trained autoencoder for a single dataset."""
+
+    def __init__(
+            self, model, dataset=None, precision=None, batch_size=None, channels_last=None,
+            max_batch_size=None):
+        """
+
+        Parameters
+        ----------
+        model : :obj:`AE` object
+            trained autoencoder; the engine uses a copy of its current parameters
+        dataset : :obj:`int` or :obj:`NoneType`, optional
+            dataset (session) for session-specific io layers
+        precision : :obj:`str` or :obj:`NoneType`, optional
+            'fp32' | 'bf16'; defaults to the model hparam :obj:`precision`
+        batch_size : :obj:`int` or :obj:`NoneType`, optional
+            number of frames per forward pass; if :obj:`NoneType`, the hparam
+            :obj:`inference_batch_size` is used if set, and the batch size is tuned otherwise (see
+            :meth:`tune_batch_size`)
+        channels_last : :obj:`bool` or :obj:`NoneType`, optional
+            :obj:`True` to use the channels-last memory format; defaults to :obj:`True` for
+            convolutional models
+        max_batch_size : :obj:`int` or :obj:`NoneType`, optional
+            largest batch size considered when tuning; defaults to the chunk size planned from
+            the memory budget :obj:`mem_limit_gb` in the model hparams, and at most
+            :obj:`MAX_TUNED_BATCH_SIZE`
+
+        """
+        if not hasattr(torch.jit, 'freeze'):
+            raise NotImplementedError('inference engines require pytorch>=1.8')
+        if precision is None:
+            precision = model.hparams.get('precision', 'fp32')
+        if precision not in PRECISIONS:
+            raise ValueError('"%s" is not a valid precision; must be one of %s' % (
+                precision, PRECISIONS))
+        if channels_last is None:
+            channels_last = model.model_type == 'conv'
+
+        self.dataset = dataset
+        self.precision = precision
+        self.channels_last = channels_last
+        self.frame_dim = tuple(int(dim) for dim in model.img_size)
+        self.device = next(model.parameters()).device
+        self.dtype = torch.bfloat16 if precision == 'bf16' else torch.float32
+
+        # compile a copy of the model so that the eager model is not modified
+        self._model = copy.deepcopy(model).eval().to(self.dtype)
+        if channels_last:
+            self._model.to(memory_format=torch.channels_last)
+        self._encoder = _compile(
+            _Encoder(self._model.encoding, dataset, self.dtype, channels_last),
+            self._get_frames(2))
+        # compiled on first use
+        self._reconstructor = None
+
+        if batch_size is None:
+            batch_size = model.hparams.get('inference_batch_size', None)
+        if batch_size is None:
+            if max_batch_size is None:
+                mem_limit_gb = model.hparams.get('mem_limit_gb', None)
+                max_batch_size = plan_chunk_size(
+                    model, self.frame_dim, training=False, dataset=dataset, precision=precision,
+                    mem_limit_gb=None if mem_limit_gb is None else float(mem_limit_gb),
+                    max_size=MAX_TUNED_BATCH_SIZE)
+            batch_size = self.tune_batch_size(max_batch_size)
+        self.batch_size = int(batch_size)
+
+    def _get_frames(self, n_frames):
+        return torch.rand((n_frames,) + self.frame_dim, device=self.device)
+
+    def encode(self, x):
+        """Compute latents of a batch of frames.
+
+        Parameters
+        ----------
+        x : :obj:`torch.Tensor` object
+            float images of shape (n_frames, n_channels, y_pix, x_pix) on the device of the model
+
+        Returns
+        -------
+        :obj:`torch.Tensor`
+            latents of shape (n_frames, n_ae_latents) in float32
+
+        """
+        with torch.no_grad():
+            return _run(self._encoder, x, self.batch_size)
+
+    def reconstruct(self, x):
+        """Compute reconstructions and latents of a batch of frames.
+
+        Parameters
+        ----------
+        x : :obj:`torch.Tensor` object
+            float images of shape (n_frames, n_channels, y_pix, x_pix) on the device of the model
+
+        Returns
+        -------
+        :obj:`tuple`
+            - reconstructions (:obj:`torch.Tensor`): shape (n_frames, n_channels, y_pix, x_pix)
+            - latents (:obj:`torch.Tensor`): shape (n_frames, n_ae_latents)
+
+        """
+        if self._model is None:
+            raise NotImplementedError('engines loaded from file only provide latents')
+        if self._reconstructor is None:
+            self._reconstructor = _compile(
+                _Reconstructor(self._model, self.dataset, self.dtype, self.channels_last),
+                self._get_frames(2))
+        with torch.no_grad():
+            return _run(self._reconstructor, x, self.batch_size)
+
+    def tune_batch_size(self, max_batch_size, n_repeats=2):
+        """Return the batch size with the highest throughput of the encoder.
+
+        Powers of two (starting at 8) up to :obj:`max_batch_size`, as well as
+        :obj:`max_batch_size` itself, are timed on random frames.
+
+        Parameters
+        ----------
+        max_batch_size : :obj:`int`
+            largest batch size considered
+        n_repeats : :obj:`int`, optional
+            number of timed forward passes for each batch size; the fastest is used
+
+        Returns
+        -------
+        :obj:`int`
+
+        """
+        batch_sizes = [2 ** n for n in range(3, int(np.log2(max(max_batch_size, 1))) + 1)]
+        if max_batch_size not in batch_sizes:
+            batch_sizes.append(max_batch_size)
+        times = []
+        with torch.no_grad():
+            for batch_size in batch_sizes:
+                x = self._get_frames(batch_size)
+                # the first passes with a new input shape are used to optimize the graph
+                for _ in range(2):
+                    self._encoder(x)
+                t_batch = np.inf
+                for _ in range(n_repeats):
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    t_beg = time.time()
+                    self._encoder(x)
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    t_batch = min(t_batch, time.time() - t_beg)
+                times.append(t_batch / batch_size)
+        return batch_sizes[int(np.argmin(times))]
+
+    def save(self, filepath):
+        """Save the frozen encoder as a standalone TorchScript file.
+
+        Optimizations that depend on the machine (such as fused convolutions) are applied when the
+        file is loaded with :meth:`load`.
+
+        Parameters
+        ----------
+        filepath : :obj:`str`
+            absolute path of the file
+
+        """
+        if self._model is None:
+            raise NotImplementedError('engines loaded from file cannot be saved')
+        encoder = _compile(
+            _Encoder(self._model.encoding, self.dataset, self.dtype, self.channels_last),
+            self._get_frames(2), optimize=False)
+        info = {
+            'dataset': self.dataset, 'precision': self.precision, 'batch_size': self.batch_size,
+            'frame_dim': list(self.frame_dim), 'channels_last': self.channels_last}
+        torch.jit.save(encoder, filepath, _extra_files={'engine.json': json.dumps(info)})
+
+    @classmethod
+    def load(cls, filepath, map_location=None):
+        """Load an engine saved with :meth:`save`; only :meth:`encode` is available.
+
+        Parameters
+        ----------
+        filepath : :obj:`str`
+            absolute path of the file
+        map_location : :obj:`str` or :obj:`torch.device` or :obj:`NoneType`, optional
+            device on which the engine is loaded
+
+        Returns
+        -------
+        :obj:`InferenceEngine` object
+
+        """
+        extra_files = {'engine.json': ''}
+        encoder = torch.jit.load(filepath, map_location=map_location, _extra_files=extra_files)
+        info = json.loads(extra_files['engine.json'])
+        engine = cls.__new__(cls)
+        engine.dataset = info['dataset']
+        engine.precision = info['precision']
+        engine.channels_last = info['channels_last']
+        engine.frame_dim = tuple(info['frame_dim'])
+        engine.batch_size = info['batch_size']
+        engine.device = torch.device('cpu' if map_location is None else map_location)
+        engine.dtype = torch.bfloat16 if engine.precision == 'bf16' else torch.float32
+        engine._model = None
+        engine._encoder = _optimize(encoder)
+        engine._reconstructor = None
+        return engine
+
+
+def _get_state_version(model):
+    # in-place updates (optimizer steps, load_state_dict) increment the version of a tensor
+    return tuple(
+        (id(tensor), tensor._version)
+        for tensor in itertools.chain(model.parameters(), model.buffers()))
+
+
+def get_inference_engine(model, dataset=None):
+    """Return an inference engine of a model, building it if necessary.
+
+    Engines are cached for each model, dataset, precision, batch size and device, and rebuilt if
+    parameters of the model have been updated since the engine was built.
+
+    Parameters
+    ----------
+    model : :obj:`AE` object
+        trained autoencoder
+    dataset : :obj:`int` or :obj:`NoneType`, optional
+        dataset (session) for session-specific io layers; ignored if the model has none
+
+    Returns
+    -------
+    :obj:`InferenceEngine` object
+
+    """
+    if not model.hparams.get('fit_sess_io_layers', False):
+        # all datasets share the same engine
+        dataset = None
+    key = (
+        dataset, model.hparams.get('precision', 'fp32'),
+        model.hparams.get('inference_batch_size', None), str(next(model.parameters()).device))
+    version = _get_state_version(model)
+    engines = _engines.setdefault(model, {})
+    if key not in engines or engines[key][0] != version:
+        engines[key] = (version, InferenceEngine(model, dataset=dataset))
+    return engines[key][1]
+
+
+def use_inference_engine(model):
+    """Return :obj:`True` if forward passes of a model should use an inference engine.
+
+    Engines are opt-in: they are used for autoencoders in evaluation mode if the hparam
+    :obj:`inference_engine` is :obj:`True` and the installed pytorch version supports them.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model
+
+    Returns
+    -------
+    :obj:`bool`
+
+    """
+    return isinstance(model, AE) \
+        and model.hparams.get('inference_engine', False) \
+        and not model.training \
+        and hasattr(torch.jit, 'freeze')
@@ -0,0 +1,373 @@
+"""Accumulate training metrics and log them to disk.
+
+Metrics are accumulated over batches as sums of sufficient statistics (see
+:class:`MetricAccumulator`), which stay on the device of the model until they are logged; pooled
+metrics such as the variance-weighted :math:`R^2` (:func:`get_r2`) and the accuracy
+(:func:`get_accuracy`) are computed from these statistics.
+
+test-tube rewrites the complete :obj:`metrics.csv` file (and the tags) every time
+:obj:`Experiment.save` is called, so that the cost of logging grows with the number of logged
+rows. :class:`MetricsLogger` produces the same file, but buffers rows in memory and appends them
+in batches on a background thread. When the logger is closed, a columnar copy of the metrics
+(:obj:`metrics.pkl`, a pickled :obj:`pandas.DataFrame`) is written next to the csv file, which
+:func:`load_metrics` reads much faster than the csv file.
+
+"""
+
+import atexit
+import os
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import torch
+
+
+class MetricAccumulator(object):
+    """Sums of metric statistics, accumulated separately for each dataset.
+
+    All statistics are stored in a single float64 tensor of shape (n_datasets, n_values) on the
+    device of the model, so that adding the statistics of a batch requires neither a device
+    synchronization nor a copy to host memory; values are only copied when read with :meth:`get`.
+    """
+
+    def __init__(self, shapes, n_datasets=1, device='cpu'):
+        """
+
+        Parameters
+        ----------
+        shapes : :obj:`dict`
+            name and shape of each statistic, e.g. :obj:`{'loss': (), 'sum_y': (n_outputs,)}`
+        n_datasets : :obj:`int`, optional
+            total number of datasets (sessions) served by data generator
+        device : :obj:`str` or :obj:`torch.device`, optional
+            device on which statistics are accumulated
+
+        """
+        self.shapes = OrderedDict((name, tuple(shape)) for name, shape in shapes.items())
+        self.slices = {}
+        idx_beg = 0
+        for name, shape in self.shapes.items():
+            idx_end = idx_beg + int(np.prod(shape))
+            self.slices[name] = slice(idx_beg, idx_end)
+            idx_beg = idx_end
+        self.values = torch.zeros((n_datasets, idx_beg), dtype=torch.float64, device=device)
+
+    def add(self, dataset=0, **stats):
+        """Add statistics of a batch.
+
+        Parameters
+        ----------
+        dataset : :obj:`int`, optional
+            dataset (session) of the batch
+        stats
+            values of statistics by name (:obj:`float` or :obj:`torch.Tensor` of matching shape)
+
+        """
+        for name, val in stats.items():
+            self.values[dataset, self.slices[name]] += torch.as_tensor(
+                val, dtype=self.values.dtype, device=self.values.device).reshape(-1)
+
+    def reset(self):
+        """Set all statistics to zero."""
+        self.values.zero_()
+
+    def get(self, name, dataset=None):
+        """Return a statistic.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            name of statistic
+        dataset : :obj:`int` or :obj:`NoneType`, optional
+            if :obj:`NoneType`, returns the statistic summed over all datasets; if :obj:`int`,
+            returns the statistic of the associated dataset
+
+        Returns
+        -------
+        :obj:`np.ndarray`
+            statistic with its original shape
+
+        """
+        if dataset is None:
+            val = self.values[:, self.slices[name]].sum(dim=0)
+        else:
+            val = self.values[dataset, self.slices[name]]
+        return val.cpu().numpy().reshape(self.shapes[name])
+
+    def state_dict(self):
+        """Return the accumulated statistics as a :obj:`dict`."""
+        return {'values': self.values}
+
+    def load_state_dict(self, state_dict):
+        """Restore accumulated statistics.
+
+        Parameters
+        ----------
+        state_dict : :obj:`dict`
+            output of :meth:`state_dict`
+
+        """
+        self.values.copy_(state_dict['values'])
+
+
+def get_r2(n, sum_y, sum_y2, ss_res):
+    """Compute the variance-weighted :math:`R^2` from sufficient statistics.
+
+    This is equivalent to :obj:`sklearn.metrics.r2_score(..., multioutput='variance_weighted')`
+    over all accumulated time points, i.e. one minus the residual sum of squares divided by the
+    total sum of squares, both summed over outputs.
+
+    Parameters
+    ----------
+    n : :obj:`float`
+        number of time points
+    sum_y : :obj:`np.ndarray`
+        sum of targets, shape (n_outputs,)
+    sum_y2 : :obj:`np.ndarray`
+        sum of squared targets, shape (n_outputs,)
+    ss_res : :obj:`np.ndarray`
+        sum of squared residuals, shape (n_outputs,)
+
+    Returns
+    -------
+    :obj:`float`
+
+    """
+    if n == 0:
+        return np.nan
+    ss_tot = np.sum(sum_y2 - sum_y ** 2 / n)
+    ss_res = np.sum(ss_res)
+    if ss_tot <= 0:
+        # constant targets
+        return 1.0 if ss_res == 0 else 0.0
+    return float(1.0 - ss_res / ss_tot)
+
+
+def get_accuracy(confusion):
+    """Compute the fraction of correct predictions from a confusion matrix.
+
+    Parameters
+    ----------
+    confusion : :obj:`np.ndarray`
+        counts of (target, prediction) pairs, shape (n_classes, n_classes)
+
+    Returns
+    -------
+    :obj:`float`
+
+    """
+    n = np.sum(confusion)
+    if n == 0:
+        return np.nan
+    return float(np.trace(confusion) / n)
+
+
+def get_metrics_paths(version_dir):
+    """Return paths of the csv file and columnar copy of the metrics of a test-tube version.
+
+    Parameters
+    ----------
+    version_dir : :obj:`str`
+        absolute path of the test-tube version directory
+
+    Returns
+    -------
+    :obj:`tuple`
+        - (:obj:`str`): csv file
+        - (:obj:`str`): columnar copy
+
+    """
+    return os.path.join(version_dir, 'metrics.csv'), os.path.join(version_dir, 'metrics.pkl')
+
+
+def load_metrics(version_dir):
+    """Load the metrics of a test-tube version.
+
+    The columnar copy written by :class:`MetricsLogger` is used if it is up to date; otherwise the
+    csv file is read.
+
+    Parameters
+    ----------
+    version_dir : :obj:`str`
+        absolute path of the test-tube version directory
+
+    Returns
+    -------
+    :obj:`pandas.DataFrame`
+
+    """
+    import pandas as pd
+    csv_file, columnar_file = get_metrics_paths(version_dir)
+    if os.path.exists(columnar_file) \
+            and os.path.getmtime(columnar_file) >= os.path.getmtime(csv_file):
+        return pd.read_pickle(columnar_file)
+    else:
+        return pd.read_csv(csv_file)
+
+
+class MetricsLogger(object):
+    """Buffered, append-only replacement for the metric logging of a test-tube experiment.
+
+    Rows are logged with :meth:`log`, as with :obj:`Experiment.log`, and written to disk by
+    :meth:`save`. The logged rows are shared with :obj:`exp.metrics`, so that files saved later by
+    the experiment (e.g. when exporting hparams) contain the same metrics. Without an experiment,
+    rows are only kept in memory (e.g. by processes of a distributed fit that do not log).
+    """
+
+    def __init__(self, exp, max_buffer=1000):
+        """
+
+        Parameters
+        ----------
+        exp : :obj:`test_tube.Experiment` object or :obj:`NoneType`
+            defines where metrics are saved; if :obj:`NoneType`, metrics are not saved
+        max_buffer : :obj:`int`, optional
+            number of buffered rows that are written without waiting for :meth:`save`
+
+        """
+        self.exp = exp
+        self.max_buffer = max_buffer
+        self._buffer = []
+        if exp is None:
+            self.csv_file, self.columnar_file = None, None
+            self.metrics = []
+            self._thread = None
+            return
+        version_dir = exp.get_data_path(exp.name, exp.version)
+        self.csv_file, self.columnar_file = get_metrics_paths(version_dir)
+        self.metrics = exp.metrics
+
+        # rows and columns written to disk; only accessed by the writer thread
+        self._columns = []
+        self._written = []
+
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+        if len(self.metrics) > 0:
+            self._queue.put(('rewrite', list(self.metrics)))
+
+    def log(self, metrics_dict):
+        """Add a row of metrics.
+
+        Parameters
+        ----------
+        metrics_dict : :obj:`dict`
+            metric names and values
+
+        """
+        metrics_dict = metrics_dict.copy()
+        if 'created_at' not in metrics_dict:
+            metrics_dict['created_at'] = str(datetime.utcnow())
+        for key, val in metrics_dict.items():
+            if val.__class__.__name__ in ['float32', 'float64']:
+                metrics_dict[key] = float(val)
+        self.metrics.append(metrics_dict)
+        self._buffer.append(metrics_dict)
+        if len(self._buffer) >= self.max_buffer:
+            self.save()
+
+    def save(self):
+        """Append all buffered rows to the csv file in the background."""
+        if self._thread is None:
+            self._buffer = []
+            return
+        self._check_error()
+        if len(self._buffer) > 0:
+            self._queue.put(('append', self._buffer))
+            self._buffer = []
+
+    def reset(self, metrics):
+        """Replace all logged rows, e.g. when resuming training from a checkpoint.
+
+        Parameters
+        ----------
+        metrics : :obj:`list` of :obj:`dict`
+            rows of metrics
+
+        """
+        self._buffer = []
+        self.metrics = list(metrics)
+        if self._thread is None:
+            return
+        self.exp.metrics = self.metrics
+        self._queue.put(('rewrite', list(self.metrics)))
+
+    def flush(self):
+        """Write all rows and wait until they are on disk."""
+        if self._thread is None:
+            return
+        self.save()
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """Write all rows, write the columnar copy and stop the background thread."""
+        if self._thread is None:
+            return
+        if self._thread.is_alive():
+            self.save()
+            self._queue.put(('columnar', None))
+            self._queue.put(None)
+            self._thread.join()
+            atexit.unregister(self.close)
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                if self._error is None:
+                    action, rows = item
+                    if action == 'append':
+                        self._append(rows)
+                    elif action == 'rewrite':
+                        self._columns = []
+                        self._written = []
+                        self._append(rows)
+                    elif action == 'columnar':
+                        self._write_columnar()
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _get_dataframe(self, rows):
+        import pandas as pd
+        return pd.DataFrame(rows, columns=self._columns)
+
+    def _append(self, rows):
+        # columns are ordered by first appearance, as in the files written by test-tube
+        n_columns = len(self._columns)
+        for row in rows:
+            for key in row.keys():
+                if key not in self._columns:
+                    self._columns.append(key)
+        new_file = len(self._written) == 0
+        self._written.extend(rows)
+        if new_file or len(self._columns) > n_columns:
+            # rewrite the whole file with the new header
+            tmp_file = self.csv_file + '.tmp'
+            self._get_dataframe(self._written).to_csv(tmp_file, index=False)
+            os.replace(tmp_file, self.csv_file)
+        else:
+            with open(self.csv_file, 'a') as f:
+                self._get_dataframe(rows).to_csv(f, header=False, index=False)
+
+    def _write_columnar(self):
+        tmp_file = self.columnar_file + '.tmp'
+        self._get_dataframe(self._written).to_pickle(tmp_file)
+        os.replace(tmp_file, self.columnar_file)
@@ -0,0 +1,67 @@
+"""Run model forward passes in reduced precision.
+
+The hparam :obj:`precision` selects the numerical precision of forward passes during fitting and
+when exporting model outputs:
+
+- 'fp32': all computations in float32 (default)
+- 'bf16': forward passes run under :obj:`torch.autocast` with bfloat16, e.g. to use the bfloat16
+  instructions of recent cpus (AVX-512 BF16/AMX). Parameters (and therefore gradient updates)
+  remain in float32, and model outputs are cast back to float32 before losses are computed.
+
+Reduced precision requires pytorch>=1.10.
+
+"""
+
+import contextlib
+import torch
+
+PRECISIONS = ['fp32', 'bf16']
+
+
+def get_autocast(precision='fp32', device='cpu'):
+    """Return a context manager in which forward passes run in the requested precision.
+
+    Parameters
+    ----------
+    precision : :obj:`str`, optional
+        'fp32' | 'bf16'
+    device : :obj:`str` or :obj:`torch.device`, optional
+        device of the model
+
+    Returns
+    -------
+    context manager
+
+    """
+    if precision == 'fp32':
+        # no-op context
+        return contextlib.ExitStack()
+    elif precision == 'bf16':
+        if not hasattr(torch, 'autocast'):
+            raise NotImplementedError('bf16 precision requires pytorch>=1.10')
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    else:
+        raise ValueError('"%s" is not a valid precision; must be one of %s' % (
+            precision, PRECISIONS))
+
+
+def outputs_to_float(outputs):
+    """Cast floating point tensors in (a tuple of) model outputs to float32.
+
+    Parameters
+    ----------
+    outputs : :obj:`torch.Tensor` or :obj:`tuple`
+        model outputs; entries that are not floating point tensors (e.g. :obj:`NoneType` or pool
+        indices) are returned unchanged
+
+    Returns
+    -------
+    :obj:`torch.Tensor` or :obj:`tuple`
+
+    """
+    if isinstance(outputs, tuple):
+        return tuple(outputs_to_float(output) for output in outputs)
+    elif isinstance(outputs, torch.Tensor) and outputs.is_floating_point():
+        return outputs.float()
+    else:
+        return outputs
@@ -1,14 +1,34 @@
 """Functions and classes for fitting PyTorch models with stochastic gradient descent."""
 
 import copy
+import inspect
 import os
+import queue
+import threading
 import numpy as np
 from tqdm import tqdm
 import torch
 from torch import nn
-from sklearn.metrics import r2_score, accuracy_score
+from behavenet.data.data_generator import images_to_float
+from behavenet.fitting.chunking import get_chunks
+from behavenet.fitting.chunking import plan_chunk_size
+from behavenet.fitting.distributed import all_reduce_gradients
+from behavenet.fitting.distributed import all_reduce_metrics
+from behavenet.fitting.distributed import broadcast_buffers
+from behavenet.fitting.distributed import broadcast_model
+from behavenet.fitting.distributed import get_n_steps
+from behavenet.fitting.distributed import is_distributed
+from behavenet.fitting.distributed import is_main_process
+from behavenet.fitting.distributed import shard_schedule
 from behavenet.fitting.eval import export_latents
 from behavenet.fitting.eval import export_predictions
+from behavenet.fitting.metrics import get_accuracy
+from behavenet.fitting.metrics import get_r2
+from behavenet.fitting.metrics import MetricAccumulator
+from behavenet.fitting.metrics import MetricsLogger
+from behavenet.fitting.precision import get_autocast
+from behavenet.fitting.precision import outputs_to_float
+from behavenet.fitting.utils import get_checkpoint_path
 
 # TODO: use epoch number as rng seed so that batches are served in a controllable way?
 # TODO: make it easy to finish training if unexpectedly stopped
@@ -20,48 +40,157 @@ class FitMethod(object):
     """Base method for defining model losses and tracking loss metrics.
 
     Loss metrics are tracked for the aggregate dataset (potentially spanning multiple sessions) as
-    well as session-specific metrics for easier downstream plotting.
+    well as session-specific metrics for easier downstream plotting. Metrics are accumulated on
+    the device of the model as sums of statistics (see
+    :class:`behavenet.fitting.metrics.MetricAccumulator`), and are only copied to host memory
+    when logged.
+
+    Like a :obj:`torch.nn.Module`, a fit method is either in training mode (see :meth:`train`),
+    in which :meth:`calc_loss` computes gradients for an optimizer step, or in evaluation mode
+    (see :meth:`eval`), in which losses are only evaluated.
+
+    Forward passes of the model are run in the precision set by the hparam :obj:`precision` (see
+    :meth:`forward`).
+
+    In a distributed fit (see :mod:`behavenet.fitting.distributed`) each process accumulates the
+    metrics of its own batches; :meth:`sync_metrics` sums them over all processes, and the summed
+    metrics are read until metrics of that data type are updated or reset again.
     """
 
-    def __init__(self, model, metric_strs, n_datasets=1):
+    def __init__(self, model, metric_shapes, n_datasets=1):
         """
 
         Parameters
         ----------
         model : :obj:`PyTorch` model
-        metric_strs : :obj:`list` of :obj:`strs`
-            names of metrics to be tracked, e.g. 'epoch', 'batch', 'train_loss', etc.
+        metric_shapes : :obj:`dict`
+            names and shapes of the statistics to be tracked, e.g. :obj:`{'batches': (),
+            'loss': ()}`
         n_datasets : :obj:`int`
             total number of datasets (sessions) served by data generator
 
         """
         self.model = model
-        self.metrics = {}
         self.n_datasets = n_datasets
-        dtype_strs = ['train', 'val', 'test', 'curr']
-
-        # aggregate metrics over all datasets
-        for dtype in dtype_strs:
-            self.metrics[dtype] = {}
-            for metric in metric_strs:
-                self.metrics[dtype][metric] = 0
-
-        # separate metrics by dataset
-        if self.n_datasets > 1:
-            self.metrics_by_dataset = []
-            for dataset in range(self.n_datasets):
-                self.metrics_by_dataset.append({})
-                for dtype in dtype_strs:
-                    self.metrics_by_dataset[dataset][dtype] = {}
-                    for metric in metric_strs:
-                        self.metrics_by_dataset[dataset][dtype][metric] = 0
-        else:
-            self.metrics_by_dataset = None
+        self.training = True
+
+        # number of frames processed at once with/without gradients; if not set, chunk sizes are
+        # planned from the memory budget (see behavenet.fitting.chunking)
+        self.chunk_size = self.model.hparams.get('chunk_size', None)
+        self.eval_chunk_size = self.model.hparams.get('eval_chunk_size', None)
+        self._planned_chunk_sizes = {}
+        # chunk sizes planned from a memory budget depend on the machine; the loss of each chunk is
+        # then weighted by its share of the batch, so that gradients do not depend on the chunking
+        self.weight_chunks = self.chunk_size is None \
+            and self.model.hparams.get('mem_limit_gb', None) is not None
+        # precision of forward passes ('fp32' | 'bf16'); parameters are always kept in fp32
+        self.precision = self.model.hparams.get('precision', 'fp32')
+        # metrics separated by dataset; aggregate metrics are summed over datasets
+        device = next(self.model.parameters()).device
+        self.device = device
+        self.metrics = {}
+        for dtype in ['train', 'val', 'test']:
+            self.metrics[dtype] = MetricAccumulator(metric_shapes, n_datasets, device=device)
+        # metrics summed over all processes of a distributed fit
+        self._synced_metrics = {}
+
+        # statistics of the current batch
+        self.curr = {}
 
     def get_parameters(self):
         """Get all model parameters that have gradient updates turned on."""
         return filter(lambda p: p.requires_grad, self.model.parameters())
 
+    def train(self):
+        """Compute gradients in :meth:`calc_loss` and put the model in training mode."""
+        self.training = True
+        self.model.train()
+        return self
+
+    def eval(self):
+        """Only evaluate losses in :meth:`calc_loss` and put the model in evaluation mode.
+
+        Losses are computed under :obj:`torch.inference_mode` (:obj:`torch.no_grad` for older
+        versions of PyTorch), so that no autograd graph is built and no backward pass is run;
+        since no intermediate values are stored for the backward pass, batches are split into
+        larger chunks (see :meth:`get_chunk_size`).
+        """
+        self.training = False
+        self.model.eval()
+        return self
+
+    def get_chunk_size(self, frame_dim, pad=0, **kwargs):
+        """Return the maximum number of frames passed through the model at once.
+
+        The chunk sizes of the training and evaluation modes can be fixed with the hparams
+        :obj:`chunk_size` and :obj:`eval_chunk_size`, respectively; otherwise they are planned
+        once per input shape from the memory budget :obj:`mem_limit_gb` (see
+        :func:`behavenet.fitting.chunking.plan_chunk_size`), and default to 200 frames if no
+        budget is set.
+
+        With a fixed chunk size, gradients of the mean loss of each chunk are summed over chunks,
+        as in previous versions of BehaveNet; with a planned chunk size, the loss of each chunk is
+        weighted by its number of frames, so that gradients are those of the mean loss of the
+        batch.
+
+        Parameters
+        ----------
+        frame_dim : :obj:`array-like`
+            dimensions of a single frame of model input
+        pad : :obj:`int`, optional
+            number of frames added to either side of each chunk
+        kwargs
+            additional keyword arguments for the forward pass of the model (e.g. :obj:`dataset`)
+
+        Returns
+        -------
+        :obj:`int`
+
+        """
+        chunk_size = self.chunk_size if self.training else self.eval_chunk_size
+        if chunk_size is not None:
+            return int(chunk_size)
+        key = (self.training, tuple(frame_dim), pad)
+        if key not in self._planned_chunk_sizes:
+            mem_limit_gb = self.model.hparams.get('mem_limit_gb', None)
+            self._planned_chunk_sizes[key] = plan_chunk_size(
+                self.model, frame_dim, training=self.training, pad=pad,
+                mem_limit_gb=None if mem_limit_gb is None else float(mem_limit_gb),
+                precision=self.precision, **kwargs)
+        return self._planned_chunk_sizes[key]
+
+    def grad_context(self):
+        """Return the autograd context in which the model is run by :meth:`calc_loss`."""
+        if self.training:
+            return torch.enable_grad()
+        elif hasattr(torch, 'inference_mode'):
+            return torch.inference_mode()
+        else:
+            return torch.no_grad()
+
+    def forward(self, *args, **kwargs):
+        """Run the forward pass of the model in the precision set by the hparam :obj:`precision`.
+
+        With 'bf16' precision the forward pass runs under :obj:`torch.autocast`, and floating point
+        outputs are cast back to float32 so that losses (and the backward pass from the loss) are
+        computed in float32 (see :mod:`behavenet.fitting.precision`).
+
+        Parameters
+        ----------
+        args
+            inputs of the model
+        kwargs
+            additional keyword arguments for the forward pass of the model (e.g. :obj:`dataset`)
+
+        Returns
+        -------
+        model outputs
+
+        """
+        with get_autocast(self.precision, self.device):
+            outputs = self.model(*args, **kwargs)
+        return outputs_to_float(outputs)
+
     def calc_loss(self, data, **kwargs):
         """Calculate loss on data."""
         raise NotImplementedError
@@ -75,7 +204,8 @@ class FitMethod(object):
             datatype to calculate loss for (e.g. 'train', 'val', 'test')
 
         """
-        return self.metrics[dtype]['loss'] / self.metrics[dtype]['batches']
+        metrics = self._get_metrics(dtype)
+        return float(metrics.get('loss') / metrics.get('batches'))
 
     def create_metric_row(
             self, dtype, epoch, batch, dataset, trial, best_epoch=None,
@@ -108,11 +238,11 @@ class FitMethod(object):
         """
 
         if by_dataset and self.n_datasets > 1:
-            loss = self.metrics_by_dataset[dataset][dtype]['loss'] \
-                      / self.metrics_by_dataset[dataset][dtype]['batches']
+            metrics = self._get_metrics(dtype)
+            loss = float(metrics.get('loss', dataset) / metrics.get('batches', dataset))
         else:
             dataset = -1
-            loss = self.metrics[dtype]['loss'] / self.metrics[dtype]['batches']
+            loss = self.get_loss(dtype)
 
         if dtype == 'train':
             metric_row = {
@@ -150,14 +280,8 @@ class FitMethod(object):
             datatype to reset metrics for (e.g. 'train', 'val', 'test')
 
         """
-        # reset aggregate metrics
-        for key in self.metrics[dtype].keys():
-            self.metrics[dtype][key] = 0
-        # reset separated metrics
-        if self.n_datasets > 1:
-            for dataset in range(self.n_datasets):
-                for key in self.metrics_by_dataset[dataset][dtype].keys():
-                    self.metrics_by_dataset[dataset][dtype][key] = 0
+        self.metrics[dtype].reset()
+        self._synced_metrics.pop(dtype, None)
 
     def update_metrics(self, dtype, dataset=None):
         """Update metrics for a specific dtype/dataset.
@@ -167,35 +291,64 @@ class FitMethod(object):
         dtype : :obj:`str`
             dataset type to update metrics for (e.g. 'train', 'val', 'test')
         dataset : :obj:`int` or :obj:`NoneType`, optional
-            if :obj:`NoneType`, updates the aggregated metrics; if :obj:`int`, updates the
-            associated dataset/session
+            dataset/session of the current batch; :obj:`NoneType` is only valid for a single
+            dataset
+
+        """
+        self.metrics[dtype].add(0 if dataset is None else dataset, **self.curr)
+        self._synced_metrics.pop(dtype, None)
+        # reset current metrics
+        self.curr = {}
+
+    def sync_metrics(self, dtype):
+        """Sum metrics over all processes of a distributed fit; no-op for a single process.
+
+        Must be called by all processes.
+
+        Parameters
+        ----------
+        dtype : :obj:`str`
+            datatype to sync metrics for (e.g. 'train', 'val', 'test')
+
+        """
+        if is_distributed():
+            self._synced_metrics[dtype] = all_reduce_metrics(self.metrics[dtype])
+
+    def _get_metrics(self, dtype):
+        """Return metrics summed over all processes if synced, otherwise local metrics."""
+        return self._synced_metrics.get(dtype, self.metrics[dtype])
+
+    def state_dict(self):
+        """Return the accumulated metrics as a :obj:`dict`, e.g. for checkpointing."""
+        return {dtype: self._get_metrics(dtype).state_dict() for dtype in self.metrics.keys()}
+
+    def load_state_dict(self, state_dict):
+        """Restore accumulated metrics.
+
+        Parameters
+        ----------
+        state_dict : :obj:`dict`
+            output of :meth:`state_dict`
 
         """
-        for key in self.metrics[dtype].keys():
-            if self.metrics['curr'][key] is not None:
-                # update aggregate methods
-                self.metrics[dtype][key] += self.metrics['curr'][key]
-                # update separated metrics
-                if dataset is not None and self.n_datasets > 1:
-                    self.metrics_by_dataset[dataset][dtype][key] += \
-                        self.metrics['curr'][key]
-                # reset current metrics
-                self.metrics['curr'][key] = 0
+        for dtype, metrics in self.metrics.items():
+            metrics.load_state_dict(state_dict[dtype])
+        self._synced_metrics = {}
 
 
 class AELoss(FitMethod):
     """MSE loss for non-variational autoencoders."""
 
     def __init__(self, model, n_datasets=1):
-        metric_strs = ['batches', 'loss']
-        super().__init__(model, metric_strs, n_datasets=n_datasets)
+        metric_shapes = {'batches': (), 'loss': ()}
+        super().__init__(model, metric_shapes, n_datasets=n_datasets)
 
     def calc_loss(self, data, dataset=0, **kwargs):
         """Calculate MSE loss for autoencoder.
 
-        The batch is split into chunks if larger than a hard-coded `chunk_size` to keep memory
-        requirements low; gradients are accumulated across all chunks before a gradient step is
-        taken.
+        The batch is split into chunks if larger than the chunk size (see :meth:`get_chunk_size`)
+        to stay within the memory budget; in training mode gradients are accumulated across all
+        chunks before a gradient step is taken.
 
         Parameters
         ----------
@@ -207,63 +360,81 @@ class AELoss(FitMethod):
         """
 
         if self.model.hparams['device'] == 'cuda':
-            data = {key: val.to('cuda') for key, val in data.items()}
+            data = {key: val.to('cuda', non_blocking=True) for key, val in data.items()}
 
-        y = data['images'][0]
+        y = images_to_float(data['images'][0])
 
         if 'masks' in data:
             masks = data['masks'][0]
         else:
             masks = None
 
-        chunk_size = 200
-        batch_size = y.shape[0]
-
-        if batch_size > chunk_size:
-            # split into chunks
-            n_chunks = int(np.ceil(batch_size / chunk_size))
-            loss_val = 0
-            for chunk in range(n_chunks):
-                idx_beg = chunk * chunk_size
-                idx_end = np.min([(chunk + 1) * chunk_size, batch_size])
-                y_mu, _ = self.model(y[idx_beg:idx_end], dataset=dataset)
+        with self.grad_context():
+            chunk_size = self.get_chunk_size(y.shape[1:], dataset=dataset)
+            batch_size = y.shape[0]
+
+            if batch_size > chunk_size:
+                # split into chunks
+                loss_val = 0
+                for idx_beg, idx_end in get_chunks(batch_size, chunk_size):
+                    y_mu, _ = self.forward(y[idx_beg:idx_end], dataset=dataset)
+                    if masks is not None:
+                        loss = torch.mean((
+                            (y[idx_beg:idx_end] - y_mu) ** 2) *
+                            masks[idx_beg:idx_end])
+                    else:
+                        loss = torch.mean((y[idx_beg:idx_end] - y_mu) ** 2)
+                    # compute gradients
+                    if self.training:
+                        if self.weight_chunks:
+                            (loss * (idx_end - idx_beg) / batch_size).backward()
+                        else:
+                            loss.backward()
+                    # get loss value (weighted by batch size)
+                    loss_val += loss.detach() * (idx_end - idx_beg)
+                loss_val /= y.shape[0]
+            else:
+                y_mu, _ = self.forward(y, dataset=dataset)
+                # define loss
                 if masks is not None:
-                    loss = torch.mean((
-                        (y[idx_beg:idx_end] - y_mu) ** 2) *
-                        masks[idx_beg:idx_end])
+                    loss = torch.mean(((y - y_mu)**2) * masks)
                 else:
-                    loss = torch.mean((y[idx_beg:idx_end] - y_mu) ** 2)
+                    loss = torch.mean((y - y_mu) ** 2)
                 # compute gradients
-                loss.backward()
-                # get loss value (weighted by batch size)
-                loss_val += loss.item() * (idx_end - idx_beg)
-            loss_val /= y.shape[0]
-        else:
-            y_mu, _ = self.model(y, dataset=dataset)
-            # define loss
-            if masks is not None:
-                loss = torch.mean(((y - y_mu)**2) * masks)
-            else:
-                loss = torch.mean((y - y_mu) ** 2)
-            # compute gradients
-            loss.backward()
-            # get loss value
-            loss_val = loss.item()
+                if self.training:
+                    loss.backward()
+                # get loss value
+                loss_val = loss.detach()
 
         # store current metrics
-        self.metrics['curr']['loss'] = loss_val
-        self.metrics['curr']['batches'] = 1
+        self.curr['loss'] = loss_val
+        self.curr['batches'] = 1
 
 
 class NLLLoss(FitMethod):
-    """Negative log-likelihood loss for supervised models (en/decoders)."""
+    """Negative log-likelihood loss for supervised models (en/decoders).
+
+    Besides the loss, the variance-weighted :math:`R^2` (gaussian noise) or the fraction of
+    correct predictions (categorical noise) is computed over all time points of the accumulated
+    batches (see :func:`behavenet.fitting.metrics.get_r2` and
+    :func:`behavenet.fitting.metrics.get_accuracy`).
+    """
 
     def __init__(self, model, n_datasets=1):
         if n_datasets > 1:
             raise ValueError('NLLLoss only supports single datasets')
 
-        metric_strs = ['batches', 'loss', 'r2', 'fc']
-        super().__init__(model, metric_strs, n_datasets=n_datasets)
+        # sufficient statistics of r2/accuracy
+        n_outputs = model.hparams['output_size']
+        metric_shapes = {'batches': (), 'loss': ()}
+        if model.hparams['noise_dist'] in ['gaussian', 'gaussian-full']:
+            metric_shapes['n'] = ()
+            metric_shapes['sum_y'] = (n_outputs,)
+            metric_shapes['sum_y2'] = (n_outputs,)
+            metric_shapes['ss_res'] = (n_outputs,)
+        elif model.hparams['noise_dist'] == 'categorical':
+            metric_shapes['confusion'] = (n_outputs, n_outputs)
+        super().__init__(model, metric_shapes, n_datasets=n_datasets)
 
         # choose loss based on noise distribution of the model
         if self.model.hparams['noise_dist'] == 'gaussian':
@@ -281,9 +452,9 @@ class NLLLoss(FitMethod):
     def calc_loss(self, data, **kwargs):
         """Calculate negative log-likelihood loss for supervised models.
 
-        The batch is split into chunks if larger than a hard-coded `chunk_size` to keep memory
-        requirements low; gradients are accumulated across all chunks before a gradient step is
-        taken.
+        The batch is split into chunks if larger than the chunk size (see :meth:`get_chunk_size`)
+        to stay within the memory budget; in training mode gradients are accumulated across all
+        chunks before a gradient step is taken.
 
         Parameters
         ----------
@@ -293,88 +464,92 @@ class NLLLoss(FitMethod):
         """
 
         if self.model.hparams['device'] == 'cuda':
-            data = {key: val.to('cuda') for key, val in data.items()}
+            data = {key: val.to('cuda', non_blocking=True) for key, val in data.items()}
 
         predictors = data[self.model.hparams['input_signal']][0]
         targets = data[self.model.hparams['output_signal']][0]
 
         max_lags = self.model.hparams['n_max_lags']
 
-        chunk_size = 200
-        batch_size = targets.shape[0]
-
-        if batch_size > chunk_size:
-            # split into chunks
-            n_chunks = int(np.ceil(batch_size / chunk_size))
-            outputs_all = []
-            loss_val = 0
-            for chunk in range(n_chunks):
-                # take chunks of size chunk_size, plus overlap due to max_lags
-                idx_beg = np.max([chunk * chunk_size - max_lags, 0])
-                idx_end = np.min([(chunk + 1) * chunk_size + max_lags, batch_size])
-                outputs, precision = self.model(predictors[idx_beg:idx_end])
+        with self.grad_context():
+            chunk_size = self.get_chunk_size(predictors.shape[1:], pad=max_lags)
+            batch_size = targets.shape[0]
+
+            if batch_size > chunk_size:
+                # split into chunks of size chunk_size, plus overlap due to max_lags
+                outputs_all = []
+                loss_val = 0
+                for idx_beg, idx_end in get_chunks(batch_size, chunk_size, pad=max_lags):
+                    outputs, precision = self.forward(predictors[idx_beg:idx_end])
+                    # define loss on allowed window of data
+                    if self.model.hparams['noise_dist'] == 'gaussian-full':
+                        loss = self._loss(
+                            outputs[max_lags:-max_lags],
+                            targets[idx_beg:idx_end][max_lags:-max_lags],
+                            precision[max_lags:-max_lags])
+                    else:
+                        loss = self._loss(
+                            outputs[max_lags:-max_lags],
+                            targets[idx_beg:idx_end][max_lags:-max_lags])
+                    # compute gradients
+                    if self.training:
+                        if self.weight_chunks:
+                            # share of the frames on which the loss of the full batch is defined
+                            n_frames = outputs[max_lags:-max_lags].shape[0]
+                            (loss * n_frames / (batch_size - 2 * max_lags)).backward()
+                        else:
+                            loss.backward()
+                    # get loss value (weighted by batch size)
+                    loss_val += loss.detach() * outputs[max_lags:-max_lags].shape[0]
+                    outputs_all.append(outputs[max_lags:-max_lags].detach())
+                loss_val /= targets.shape[0]
+                outputs_all = torch.cat(outputs_all, dim=0)
+            else:
+                outputs, precision = self.forward(predictors)
                 # define loss on allowed window of data
                 if self.model.hparams['noise_dist'] == 'gaussian-full':
                     loss = self._loss(
                         outputs[max_lags:-max_lags],
-                        targets[idx_beg:idx_end][max_lags:-max_lags],
+                        targets[max_lags:-max_lags],
                         precision[max_lags:-max_lags])
                 else:
                     loss = self._loss(
                         outputs[max_lags:-max_lags],
-                        targets[idx_beg:idx_end][max_lags:-max_lags])
+                        targets[max_lags:-max_lags])
                 # compute gradients
-                loss.backward()
-                # get loss value (weighted by batch size)
-                loss_val += loss.item() * outputs[max_lags:-max_lags].shape[0]
-                outputs_all.append(
-                    outputs[max_lags:-max_lags].cpu().detach().numpy())
-            loss_val /= targets.shape[0]
-            outputs_all = np.concatenate(outputs_all, axis=0)
-        else:
-            outputs, precision = self.model(predictors)
-            # define loss on allowed window of data
-            if self.model.hparams['noise_dist'] == 'gaussian-full':
-                loss = self._loss(
-                    outputs[max_lags:-max_lags],
-                    targets[max_lags:-max_lags],
-                    precision[max_lags:-max_lags])
-            else:
-                loss = self._loss(
-                    outputs[max_lags:-max_lags],
-                    targets[max_lags:-max_lags])
-            # compute gradients
-            loss.backward()
-            # get loss value
-            loss_val = loss.item()
-            outputs_all = outputs[max_lags:-max_lags].cpu().detach().numpy()
-
+                if self.training:
+                    loss.backward()
+                # get loss value
+                loss_val = loss.detach()
+                outputs_all = outputs[max_lags:-max_lags].detach()
+
+            # store current metrics; statistics remain on the device until they are logged
+            self.curr = self._get_stats(targets[max_lags:-max_lags], outputs_all)
+            self.curr['loss'] = loss_val
+            self.curr['batches'] = 1
+
+    def _get_stats(self, targets, outputs):
+        """Sufficient statistics of r2 (gaussian noise) or accuracy (categorical noise)."""
         if self.model.hparams['noise_dist'] == 'gaussian' \
                 or self.model.hparams['noise_dist'] == 'gaussian-full':
             # use variance-weighted r2s to ignore small-variance latents
-            r2 = r2_score(
-                targets[max_lags:-max_lags].cpu().detach().numpy(),
-                outputs_all,
-                multioutput='variance_weighted')
-            fc = None
+            targets = targets.double()
+            return {
+                'n': targets.shape[0],
+                'sum_y': targets.sum(dim=0),
+                'sum_y2': (targets ** 2).sum(dim=0),
+                'ss_res': ((targets - outputs.double()) ** 2).sum(dim=0)}
         elif self.model.hparams['noise_dist'] == 'poisson':
             raise NotImplementedError
         elif self.model.hparams['noise_dist'] == 'categorical':
-            r2 = None
-            fc = accuracy_score(
-                targets[max_lags:-max_lags].cpu().detach().numpy(),
-                np.argmax(outputs_all, axis=1))
+            n_classes = self.model.hparams['output_size']
+            idxs = targets.long() * n_classes + torch.argmax(outputs, dim=1)
+            return {'confusion': torch.bincount(idxs, minlength=n_classes ** 2)}
         else:
             raise ValueError(
                 '"%s" is not a valid noise_dist' %
                 self.model.hparams['noise_dist'])
 
-        # store current metrics
-        self.metrics['curr']['loss'] = loss_val
-        self.metrics['curr']['r2'] = r2
-        self.metrics['curr']['fc'] = fc
-        self.metrics['curr']['batches'] = 1
-
     def create_metric_row(
             self, dtype, epoch, batch, dataset, trial, best_epoch=None, by_dataset=False,
             *args, **kwargs):
@@ -405,10 +580,19 @@ class NLLLoss(FitMethod):
 
         """
 
-        norm = self.metrics[dtype]['batches']
-        loss = self.metrics[dtype]['loss'] / norm
-        r2 = self.metrics[dtype]['r2'] / norm
-        fc = self.metrics[dtype]['fc'] / norm
+        metrics = self._get_metrics(dtype)
+        loss = self.get_loss(dtype)
+        # metrics that do not apply to the noise distribution are reported as 0
+        if 'ss_res' in metrics.shapes:
+            r2 = get_r2(
+                metrics.get('n'), metrics.get('sum_y'), metrics.get('sum_y2'),
+                metrics.get('ss_res'))
+        else:
+            r2 = 0.0
+        if 'confusion' in metrics.shapes:
+            fc = get_accuracy(metrics.get('confusion'))
+        else:
+            fc = 0.0
         if dtype == 'train':
             metric_row = {
                 'epoch': epoch,
@@ -504,6 +688,170 @@ class EarlyStopping(object):
             self.stopped_epoch = epoch
             self.should_stop = True
 
+    def state_dict(self):
+        """Return the state of the early stopping criterion as a :obj:`dict`."""
+        return {
+            'prev_losses': self.prev_losses.tolist(),
+            'best_epoch': self.best_epoch,
+            'best_loss': self.best_loss,
+            'stopped_epoch': self.stopped_epoch,
+            'should_stop': self.should_stop}
+
+    def load_state_dict(self, state_dict):
+        """Restore the state of the early stopping criterion.
+
+        Parameters
+        ----------
+        state_dict : :obj:`dict`
+            output of :meth:`state_dict`
+
+        """
+        self.prev_losses = np.array(state_dict['prev_losses'], dtype=np.float64)
+        self.best_epoch = state_dict['best_epoch']
+        self.best_loss = state_dict['best_loss']
+        self.stopped_epoch = state_dict['stopped_epoch']
+        self.should_stop = state_dict['should_stop']
+
+
+def _copy_to_cpu(obj):
+    """Copy all tensors in a (nested) container to cpu memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        obj_cpu = type(obj)((key, _copy_to_cpu(val)) for key, val in obj.items())
+        if hasattr(obj, '_metadata'):
+            # version info of state dicts
+            obj_cpu._metadata = copy.deepcopy(obj._metadata)
+        return obj_cpu
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(val) for val in obj)
+    else:
+        return copy.deepcopy(obj)
+
+
+def get_cpu_state_dict(model):
+    """Return a copy of the state dict of a model (or optimizer) in cpu memory.
+
+    Parameters
+    ----------
+    model : :obj:`PyTorch` model or optimizer
+
+    Returns
+    -------
+    :obj:`dict`
+
+    """
+    return _copy_to_cpu(model.state_dict())
+
+
+def save_checkpoint(obj, filepath):
+    """Save an object with :obj:`torch.save` such that the file is never partially written.
+
+    The object is first written to a temporary file in the same directory, which then replaces
+    :obj:`filepath`.
+
+    Parameters
+    ----------
+    obj : :obj:`object`
+        e.g. a model state dict
+    filepath : :obj:`str`
+        absolute path of the checkpoint file
+
+    """
+    tmp_filepath = filepath + '.tmp'
+    torch.save(obj, tmp_filepath)
+    os.replace(tmp_filepath, filepath)
+
+
+def load_checkpoint(filepath):
+    """Load a checkpoint saved with :func:`save_checkpoint` into cpu memory.
+
+    Parameters
+    ----------
+    filepath : :obj:`str`
+        absolute path of the checkpoint file
+
+    Returns
+    -------
+    :obj:`object`
+
+    """
+    kwargs = {'map_location': 'cpu'}
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        # training checkpoints also contain python objects such as logged metrics
+        kwargs['weights_only'] = False
+    return torch.load(filepath, **kwargs)
+
+
+class CheckpointWriter(object):
+    """Save checkpoints in a background thread so that training does not wait for disk writes.
+
+    Checkpoints are written with :func:`save_checkpoint`. If a file is saved again before its
+    previous version has been written, only the newest version is written. Errors raised by the
+    writer are re-raised by the next call to :meth:`save`, :meth:`flush` or :meth:`close`.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            filepath = self._queue.get()
+            if filepath is None:
+                self._queue.task_done()
+                break
+            with self._lock:
+                obj = self._pending.pop(filepath, None)
+            try:
+                if obj is not None and self._error is None:
+                    save_checkpoint(obj, filepath)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def save(self, obj, filepath):
+        """Queue an object for saving.
+
+        Parameters
+        ----------
+        obj : :obj:`object`
+            object to save; must not be modified afterwards (e.g. the output of
+            :func:`get_cpu_state_dict`)
+        filepath : :obj:`str`
+            absolute path of the checkpoint file
+
+        """
+        self._check_error()
+        with self._lock:
+            queued = filepath in self._pending
+            self._pending[filepath] = obj
+        if not queued:
+            self._queue.put(filepath)
+
+    def flush(self):
+        """Wait until all queued checkpoints have been written."""
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """Write all queued checkpoints and stop the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check_error()
+
 
 def fit(hparams, model, data_generator, exp, method='ae'):
     """Fit pytorch models with stochastic gradient descent and early stopping.
@@ -525,13 +873,41 @@ def fit(hparams, model, data_generator, exp, method='ae'):
     the first half of the batches have been processed, then again after all batches have been
     processed.
 
-    Monitored metrics are saved in a csv file in the model directory. This logging is handled by
-    the :obj:`testtube` package.
+    Monitored metrics are saved in a csv file in the model directory, in the format of the
+    :obj:`testtube` package; rows are appended in the background by
+    :class:`behavenet.fitting.metrics.MetricsLogger`.
+
+    By default each training batch is a full trial. If the :obj:`hparams` key
+    :obj:`'frame_window'` is set, training batches are instead windows with a fixed number of
+    frames, drawn from all training trials (see
+    :meth:`behavenet.data.data_generator.ConcatSessionsGenerator.set_frame_window`); for decoders,
+    each window is padded with :obj:`'n_max_lags'` frames on either side.
+
+    Whenever the validation loss improves, a copy of the model parameters is kept in cpu memory
+    and saved as :obj:`best_val_model.pt` by a background thread (see :class:`CheckpointWriter`),
+    so that training does not wait for the disk. At the end of training the best parameters are
+    loaded into :obj:`model`, which is then used to compute test metrics.
+
+    Every :obj:`'checkpoint_interval'` epochs (default 1; 0 to disable) the full training state
+    is saved: model and optimizer state, the current epoch, early stopping and best model
+    tracking, and the metrics logged so far. If this checkpoint exists when :obj:`fit` is called
+    (e.g. because the job was preempted and :func:`behavenet.fitting.utils.create_tt_experiment`
+    returned the interrupted version), training resumes after the last saved epoch; since batches
+    are seeded by epoch number, the resumed fit serves the same batches as an uninterrupted one.
+    The checkpoint is deleted once training is finished.
 
     At the end of training, model outputs (such as latents for autoencoder models, or predictions
     for decoder models) can optionally be computed and saved using the :obj:`hparams` keys
     :obj:`'export_latents'` or :obj:`'export_predictions'`, respectively.
 
+    If called by all processes of a distributed process group (see
+    :mod:`behavenet.fitting.distributed`), the model is fit data-parallel on cpu: each process
+    serves a disjoint shard of every pass through the training and validation data, and each
+    optimizer step averages the gradients of one batch from each process (so that an epoch takes
+    fewer, larger steps than a single-process fit). Only the process with rank 0 logs metrics,
+    saves models and checkpoints, and computes test metrics and exports; :obj:`exp` is only used
+    by this process.
+
     Parameters
     ----------
     hparams : :obj:`dict`
@@ -540,14 +916,17 @@ def fit(hparams, model, data_generator, exp, method='ae'):
         model to fit
     data_generator : :obj:`ConcatSessionsGenerator` object
         data generator to serve data batches
-    exp : :obj:`test_tube.Experiment` object
-        for logging training progress
+    exp : :obj:`test_tube.Experiment` object or :obj:`NoneType`
+        for logging training progress; may be :obj:`NoneType` for processes other than rank 0 of a
+        distributed fit
     method : :obj:`str`
         specifies the type of loss - 'ae' | 'nll'
 
     """
 
     # check inputs
+    if is_distributed() and hparams['device'] != 'cpu':
+        raise NotImplementedError('distributed fits are only supported on cpu')
     if method == 'ae':
         loss = AELoss(model, n_datasets=data_generator.n_datasets)
     elif method == 'nll':
@@ -560,13 +939,32 @@ def fit(hparams, model, data_generator, exp, method='ae'):
         loss.get_parameters(), lr=hparams['learning_rate'], weight_decay=hparams.get('l2_reg', 0),
         amsgrad=True)
 
-    # enumerate batches on which validation metrics should be recorded
+    # serve training data in fixed-size windows of frames rather than full trials
+    if hparams.get('frame_window', None):
+        data_generator.set_frame_window(hparams['frame_window'], pad=hparams.get('n_max_lags', 0))
+
+    # write checkpoints and metrics in the background
+    writer = CheckpointWriter()
+    logger = MetricsLogger(exp if is_main_process() else None)
+    try:
+        _fit(hparams, model, data_generator, exp, method, loss, optimizer, writer, logger)
+    finally:
+        logger.close()
+        writer.close()
+
+
+def _fit(hparams, model, data_generator, exp, method, loss, optimizer, writer, logger):
+    """Training loop and test evaluation of :func:`fit`."""
+
+    # enumerate batches on which validation metrics should be recorded; in a distributed fit, each
+    # step processes one batch on each process
+    n_train_steps = get_n_steps(data_generator.n_tot_batches['train'])
     best_val_loss = np.inf
     best_val_epoch = None
-    best_val_model = None
+    best_val_state = None
     val_check_batch = np.linspace(
-        data_generator.n_tot_batches['train'] * hparams['val_check_interval'],
-        data_generator.n_tot_batches['train'] * (hparams['max_n_epochs']+1),
+        n_train_steps * hparams['val_check_interval'],
+        n_train_steps * (hparams['max_n_epochs']+1),
         int((hparams['max_n_epochs'] + 1) / hparams['val_check_interval'])).astype('int')
 
     # early stopping set-up
@@ -576,8 +974,38 @@ def fit(hparams, model, data_generator, exp, method='ae'):
     else:
         early_stop = None
 
-    i_epoch = 0
-    for i_epoch in range(hparams['max_n_epochs'] + 1):
+    # resume from checkpoint of an interrupted fit
+    version = exp.version if exp is not None else hparams['version']
+    checkpoint_file = get_checkpoint_path(hparams, version)
+    checkpoint_interval = hparams.get('checkpoint_interval', 1)
+    start_epoch = 0
+    if os.path.exists(checkpoint_file):
+        checkpoint = load_checkpoint(checkpoint_file)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        loss.load_state_dict(checkpoint['loss_metrics'])
+        best_val_loss = checkpoint['best_val_loss']
+        best_val_epoch = checkpoint['best_val_epoch']
+        best_val_state = checkpoint['best_val_state']
+        if early_stop is not None:
+            early_stop.load_state_dict(checkpoint['early_stop'])
+        if not is_main_process():
+            # checkpointed metrics are summed over processes; only count them once
+            for dtype in ['train', 'val']:
+                loss.reset_metrics(dtype)
+        for dtype in ['train', 'val']:
+            loss.sync_metrics(dtype)
+        logger.reset(checkpoint['exp_metrics'])
+        start_epoch = checkpoint['epoch'] + 1
+        if early_stop is not None and early_stop.should_stop:
+            start_epoch = hparams['max_n_epochs'] + 1
+        print('resuming training after epoch %i' % checkpoint['epoch'])
+
+    # start all processes from the same parameters
+    broadcast_model(model)
+
+    i_epoch = max(start_epoch - 1, 0)
+    for i_epoch in range(start_epoch, hparams['max_n_epochs'] + 1):
         # Note: the 0th epoch has no training (randomly initialized model is evaluated) so we cycle
         # through `max_n_epochs` training epochs
 
@@ -600,34 +1028,43 @@ def fit(hparams, model, data_generator, exp, method='ae'):
 
         loss.reset_metrics('train')
         data_generator.reset_iterators('train')
+        n_train_batches = shard_schedule(data_generator, 'train')
 
-        for i_train in tqdm(range(data_generator.n_tot_batches['train'])):
+        for i_train in tqdm(range(n_train_steps), disable=not is_main_process()):
 
-            model.train()
+            loss.train()
 
             # zero out gradients. Don't want gradients from previous iterations
             optimizer.zero_grad()
 
-            # get next minibatch and put it on the device
-            data, dataset = data_generator.next_batch('train')
+            # processes may run out of batches in the last step of a distributed epoch
+            if i_train < n_train_batches:
+
+                # get next minibatch and put it on the device
+                data, dataset = data_generator.next_batch('train')
 
-            # call the appropriate loss function
-            loss.calc_loss(data, dataset=dataset)
-            loss.update_metrics('train', dataset=dataset)
+                # call the appropriate loss function
+                loss.calc_loss(data, dataset=dataset)
+                loss.update_metrics('train', dataset=dataset)
 
             # step (evaluate untrained network on epoch 0)
             if i_epoch > 0:
+                all_reduce_gradients(
+                    loss.get_parameters(), has_batch=i_train < n_train_batches)
                 optimizer.step()
+            # batch norm statistics are updated by each process on its own batches
+            broadcast_buffers(model)
 
             # check validation according to schedule
-            curr_batch = (i_train + 1) + i_epoch * data_generator.n_tot_batches['train']
+            curr_batch = (i_train + 1) + i_epoch * n_train_steps
             if np.any(curr_batch == val_check_batch):
 
                 loss.reset_metrics('val')
                 data_generator.reset_iterators('val')
-                model.eval()
+                n_val_batches = shard_schedule(data_generator, 'val')
+                loss.eval()
 
-                for i_val in range(data_generator.n_tot_batches['val']):
+                for i_val in range(n_val_batches):
 
                     # get next minibatch and put it on the device
                     data, dataset = data_generator.next_batch('val')
@@ -636,61 +1073,93 @@ def fit(hparams, model, data_generator, exp, method='ae'):
                     loss.calc_loss(data, dataset=dataset)
                     loss.update_metrics('val', dataset=dataset)
 
+                loss.sync_metrics('train')
+                loss.sync_metrics('val')
+
                 # save best val model
                 if loss.get_loss('val') < best_val_loss:
                     best_val_loss = loss.get_loss('val')
-                    filepath = os.path.join(
-                        hparams['expt_dir'], 'version_%i' % exp.version, 'best_val_model.pt')
-                    torch.save(model.state_dict(), filepath)
-
-                    model.hparams = None
-                    best_val_model = copy.deepcopy(model)
-                    model.hparams = hparams
-                    best_val_model.hparams = hparams
+                    if is_main_process():
+                        best_val_state = get_cpu_state_dict(model)
+                        filepath = os.path.join(
+                            hparams['expt_dir'], 'version_%i' % version, 'best_val_model.pt')
+                        writer.save(best_val_state, filepath)
                     best_val_epoch = i_epoch
 
                 # export aggregated metrics on train/val data
-                exp.log(loss.create_metric_row(
+                logger.log(loss.create_metric_row(
                     'train', i_epoch, i_train, -1, trial=-1,
                     by_dataset=False, best_epoch=best_val_epoch))
-                exp.log(loss.create_metric_row(
+                logger.log(loss.create_metric_row(
                     'val', i_epoch, i_train, -1, trial=-1,
                     by_dataset=False, best_epoch=best_val_epoch))
                 # export individual session metrics on train/val data
                 if data_generator.n_datasets > 1:
                     for dataset in range(data_generator.n_datasets):
-                        exp.log(loss.create_metric_row(
+                        logger.log(loss.create_metric_row(
                             'train', i_epoch, i_train, dataset, trial=-1,
                             by_dataset=True, best_epoch=best_val_epoch))
-                        exp.log(loss.create_metric_row(
+                        logger.log(loss.create_metric_row(
                             'val', i_epoch, i_train, dataset, trial=-1,
                             by_dataset=True, best_epoch=best_val_epoch))
-                exp.save()
+                logger.save()
 
-            elif (i_train + 1) % data_generator.n_tot_batches['train'] == 0:
+            elif (i_train + 1) % n_train_steps == 0:
                 # export training metrics at end of epoch
+                loss.sync_metrics('train')
 
                 # export aggregated metrics on train/val data
-                exp.log(loss.create_metric_row(
+                logger.log(loss.create_metric_row(
                     'train', i_epoch, i_train, -1, trial=-1,
                     by_dataset=False, best_epoch=best_val_epoch))
                 # export individual session metrics on train/val data
                 if data_generator.n_datasets > 1:
                     for dataset in range(data_generator.n_datasets):
-                        exp.log(loss.create_metric_row(
+                        logger.log(loss.create_metric_row(
                             'train', i_epoch, i_train, dataset, trial=-1,
                             by_dataset=True, best_epoch=best_val_epoch))
-                exp.save()
+                logger.save()
 
         if hparams['enable_early_stop']:
             early_stop.on_val_check(i_epoch, loss.get_loss('val'))
-            if early_stop.should_stop:
-                break
+
+        # save full training state to resume from
+        if checkpoint_interval and (i_epoch + 1) % checkpoint_interval == 0 \
+                and is_main_process():
+            writer.save({
+                'epoch': i_epoch,
+                'model': get_cpu_state_dict(model),
+                'optimizer': get_cpu_state_dict(optimizer),
+                'loss_metrics': get_cpu_state_dict(loss),
+                'best_val_loss': best_val_loss,
+                'best_val_epoch': best_val_epoch,
+                'best_val_state': best_val_state,
+                'early_stop': None if early_stop is None else early_stop.state_dict(),
+                'exp_metrics': copy.deepcopy(logger.metrics)}, checkpoint_file)
+
+        if hparams['enable_early_stop'] and early_stop.should_stop:
+            break
+
+    # test metrics and exports are computed on full trials
+    if data_generator.frame_windows is not None:
+        data_generator.set_frame_window(None)
 
     # save out last model
-    if hparams.get('save_last_model', False):
-        filepath = os.path.join(hparams['expt_dir'], 'version_%i' % exp.version, 'last_model.pt')
-        torch.save(model.state_dict(), filepath)
+    if hparams.get('save_last_model', False) and is_main_process():
+        filepath = os.path.join(hparams['expt_dir'], 'version_%i' % version, 'last_model.pt')
+        writer.save(get_cpu_state_dict(model), filepath)
+
+    # training is finished; the checkpoint is no longer needed
+    writer.flush()
+    if not is_main_process():
+        # test metrics and exports are computed by a single process
+        return
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    # the trained model is no longer needed; evaluate the best model from here on
+    model.load_state_dict(best_val_state)
+    best_val_model = model
 
     # compute test loss
     if method == 'ae':
@@ -702,7 +1171,7 @@ def fit(hparams, model, data_generator, exp, method='ae'):
 
     test_loss.reset_metrics('test')
     data_generator.reset_iterators('test')
-    best_val_model.eval()
+    test_loss.eval()
 
     for i_test in range(data_generator.n_tot_batches['test']):
 
@@ -715,10 +1184,10 @@ def fit(hparams, model, data_generator, exp, method='ae'):
         test_loss.update_metrics('test', dataset=dataset)
 
         # calculate metrics for each *batch* (rather than whole dataset)
-        exp.log(test_loss.create_metric_row(
+        logger.log(test_loss.create_metric_row(
             'test', i_epoch, i_test, dataset, trial=data['batch_idx'].item(), by_dataset=True))
 
-    exp.save()
+    logger.save()
 
     # export latents
     if method == 'ae' and hparams['export_latents']:
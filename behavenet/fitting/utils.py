@@ -527,42 +527,89 @@ def experiment_exists(hparams, which_version=False):
 
     """
 
+    found_match = False
+    version = None
+    for version, hparams_ in _get_matching_versions(hparams):
+        # found match - did it finish training?
+        if hparams_['training_completed']:
+            found_match = True
+            break
+
+    if which_version and found_match:
+        return found_match, version
+    elif which_version and not found_match:
+        return found_match, None
+    else:
+        return found_match
+
+
+def get_resumable_version(hparams):
+    """Search testtube versions for an unfinished fit with the same hyperparameters.
+
+    A version can be resumed if training did not complete but a checkpoint was saved (see
+    :func:`get_checkpoint_path`).
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        needs to contain enough information to specify a test tube experiment (model + training
+        parameters)
+
+    Returns
+    -------
+    :obj:`int` or :obj:`NoneType`
+        version number, or :obj:`NoneType` if no version can be resumed
+
+    """
+    for version, hparams_ in _get_matching_versions(hparams):
+        if not hparams_['training_completed'] \
+                and os.path.exists(get_checkpoint_path(hparams, version)):
+            return version
+    return None
+
+
+def _get_matching_versions(hparams):
+    """Yield (version, hparams) of all testtube versions that match the model params."""
+
     import pickle
 
     try:
         tt_versions = get_subdirs(hparams['expt_dir'])
     except StopIteration:
         # no versions yet
-        if which_version:
-            return False, None
-        else:
-            return False
+        return
 
     # get model-specific params
     hparams_less = get_model_params(hparams)
 
-    found_match = False
-    version = None
     for version in tt_versions:
         # load hparams
         version_file = os.path.join(hparams['expt_dir'], version, 'meta_tags.pkl')
         try:
             with open(version_file, 'rb') as f:
                 hparams_ = pickle.load(f)
-            if all([hparams_[key] == hparams_less[key] for key in hparams_less.keys()]):
-                # found match - did it finish training?
-                if hparams_['training_completed']:
-                    found_match = True
-                    break
         except IOError:
             continue
+        if all([hparams_[key] == hparams_less[key] for key in hparams_less.keys()]):
+            yield int(version.split('_')[-1]), hparams_
 
-    if which_version and found_match:
-        return found_match, int(version.split('_')[-1])
-    elif which_version and not found_match:
-        return found_match, None
-    else:
-        return found_match
+
+def get_checkpoint_path(hparams, version):
+    """Return the path of the file used to resume training of a testtube version.
+
+    Parameters
+    ----------
+    hparams : :obj:`dict`
+        needs to contain 'expt_dir'
+    version : :obj:`int`
+        testtube version
+
+    Returns
+    -------
+    :obj:`str`
+
+    """
+    return os.path.join(hparams['expt_dir'], 'version_%i' % version, 'checkpoint.pt')
 
 
 def get_model_params(hparams):
@@ -646,7 +693,8 @@ def export_hparams(hparams, exp):
     """Export hyperparameter dictionary.
 
     The dict is export once as a csv file (for easy human reading) and again as a pickled dict
-    (for easy python loading/parsing).
+    (for easy python loading/parsing). Unlike :obj:`exp.save`, this does not rewrite the metrics
+    of the experiment (see :class:`behavenet.fitting.metrics.MetricsLogger`).
 
     Parameters
     ----------
@@ -657,13 +705,16 @@ def export_hparams(hparams, exp):
 
     """
     import pickle
+    import pandas as pd
     # save out as pickle
     meta_file = os.path.join(hparams['expt_dir'], 'version_%i' % exp.version, 'meta_tags.pkl')
     with open(meta_file, 'wb') as f:
         pickle.dump(hparams, f)
-    # save out as csv
+    # save out as csv (same format as test-tube)
     exp.tag(hparams)
-    exp.save()
+    meta_file = os.path.join(hparams['expt_dir'], 'version_%i' % exp.version, 'meta_tags.csv')
+    pd.DataFrame({'key': list(exp.tags.keys()), 'value': list(exp.tags.values())}).to_csv(
+        meta_file, index=False)
 
 
 def get_lab_example(hparams, lab, expt):
@@ -732,6 +783,10 @@ def create_tt_experiment(hparams):
     hparams : :obj:`dict`
         dictionary of hyperparameters defining experiment that will be saved as a csv file
 
+    If a fit with the same hyperparameters was interrupted after saving a checkpoint (see
+    :func:`get_resumable_version`), its version is reused so that training resumes from the
+    checkpoint.
+
     Returns
     -------
     :obj:`tuple`
@@ -754,10 +809,16 @@ def create_tt_experiment(hparams):
     if experiment_exists(hparams):
         return None, None, None
 
+    # resume an interrupted fit if possible
+    version = get_resumable_version(hparams)
+    if version is not None:
+        print('resuming version %i' % version)
+
     exp = Experiment(
         name=hparams['experiment_name'],
         debug=False,
-        save_dir=os.path.dirname(hparams['expt_dir']))
+        save_dir=os.path.dirname(hparams['expt_dir']),
+        version=version)
     exp.save()
     hparams['version'] = exp.version
 
@@ -795,13 +856,32 @@ def build_data_generator(hparams, sess_ids, export_csv=True):
         trial_splits = {'train_tr': trs[0], 'val_tr': trs[1], 'test_tr': trs[2], 'gap_tr': trs[3]}
     else:
         trial_splits = None
+    if hparams.get('hdf5_cache_mb', None) is not None:
+        from behavenet.data.storage import configure_hdf5_pool
+        configure_hdf5_pool(rdcc_nbytes=int(hparams['hdf5_cache_mb'] * 2 ** 20))
+    if hparams.get('use_session_cache', False):
+        from behavenet.data.cache import get_default_cache_dir
+        session_cache_dir = hparams.get('session_cache_dir', None) or get_default_cache_dir()
+    else:
+        session_cache_dir = None
+    if hparams.get('use_transform_cache', False):
+        from behavenet.data.cache import get_default_transform_cache_dir
+        transform_cache_dir = hparams.get('transform_cache_dir', None) or \
+            get_default_transform_cache_dir()
+    else:
+        transform_cache_dir = None
     print('constructing data generator...', end='')
     data_generator = ConcatSessionsGenerator(
         hparams['data_dir'], sess_ids,
         signals_list=signals, transforms_list=transforms, paths_list=paths,
         device=hparams['device'], as_numpy=hparams['as_numpy'], batch_load=hparams['batch_load'],
         rng_seed=hparams['rng_seed_data'], trial_splits=trial_splits,
-        train_frac=hparams['train_frac'])
+        train_frac=hparams['train_frac'], num_workers=hparams.get('n_data_workers', 0),
+        pin_memory=hparams.get('pin_memory', False),
+        persistent_workers=hparams.get('persistent_workers', True),
+        prefetch_factor=hparams.get('prefetch_factor', 2),
+        images_as_uint8=hparams.get('images_as_uint8', False),
+        session_cache_dir=session_cache_dir, transform_cache_dir=transform_cache_dir)
     # csv order will reflect dataset order in data generator
     if export_csv:
         export_session_info_to_csv(os.path.join(
@@ -833,9 +913,10 @@ def get_best_model_version(expt_dir, measure='val_loss', best_def='min', n_best=
     """
     import pickle
     import pandas as pd
+    from behavenet.fitting.metrics import load_metrics
     # gather all versions
     versions = get_subdirs(expt_dir)
-    # load csv files with model metrics (saved out from test tube)
+    # load model metrics (saved out from test tube)
     metrics = []
     for i, version in enumerate(versions):
         # make sure training has been completed
@@ -846,8 +927,8 @@ def get_best_model_version(expt_dir, measure='val_loss', best_def='min', n_best=
             meta_tags = pickle.load(f)
         if not meta_tags['training_completed']:
             continue
-        # read metrics csv file
-        metric = pd.read_csv(os.path.join(expt_dir, version, 'metrics.csv'))
+        # read metrics file
+        metric = load_metrics(os.path.join(expt_dir, version))
 
         # get validation loss of best model
         if best_def == 'min':
@@ -1,9 +1,119 @@
 """Autoencoder models implemented in PyTorch."""
 
+import inspect
+import re
+from collections import OrderedDict
 import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as functional
+from torch.utils.checkpoint import checkpoint
+
+
+def get_layer_groups(layers):
+    """Group the modules of a convolutional encoder/decoder by layer.
+
+    Each layer of a convolutional encoder/decoder consists of several modules that share the same
+    layer number, e.g. `conv0`, `batchnorm0`, `maxpool0`, `relu0`.
+
+    Parameters
+    ----------
+    layers : :obj:`torch.nn.ModuleList`
+        modules of encoder/decoder
+
+    Returns
+    -------
+    :obj:`OrderedDict`
+        layer numbers as keys, and module names of each layer as values
+
+    """
+    groups = OrderedDict()
+    for name, _ in layers.named_children():
+        layer_num = int(re.search(r'(\d+)(_sess_io_layers)?$', name).group(1))
+        groups.setdefault(layer_num, []).append(name)
+    return groups
+
+
+def get_checkpoint_layers(checkpoint_layers, layer_nums):
+    """Parse the hparams that select the checkpointed layers of a convolutional encoder/decoder.
+
+    Parameters
+    ----------
+    checkpoint_layers : :obj:`str`, :obj:`bool`, :obj:`list` or :obj:`NoneType`
+        'none' | 'all' | layer numbers, either as a list or as a string like '0;1;2'
+    layer_nums : :obj:`array-like`
+        numbers of all layers
+
+    Returns
+    -------
+    :obj:`list`
+        numbers of checkpointed layers
+
+    """
+    layer_nums = list(layer_nums)
+    if checkpoint_layers is None or checkpoint_layers is False \
+            or checkpoint_layers in ['none', '']:
+        return []
+    elif checkpoint_layers is True or checkpoint_layers == 'all':
+        checkpoint_layers = layer_nums
+    else:
+        if isinstance(checkpoint_layers, str):
+            checkpoint_layers = checkpoint_layers.split(';')
+        checkpoint_layers = sorted([int(layer_num) for layer_num in checkpoint_layers])
+        for layer_num in checkpoint_layers:
+            if layer_num not in layer_nums:
+                raise ValueError('%i is not a valid layer; must be one of %s' % (
+                    layer_num, layer_nums))
+    if len(checkpoint_layers) > 0 \
+            and 'use_reentrant' not in inspect.signature(checkpoint).parameters:
+        raise NotImplementedError('activation checkpointing requires pytorch>=1.11')
+    return checkpoint_layers
+
+
+def checkpoint_layer(function, *args):
+    """Run a layer without storing its intermediate values for the backward pass.
+
+    The intermediate values are recomputed during the backward pass by calling :obj:`function`
+    again; :obj:`function` is called with the additional keyword argument :obj:`recompute`, which
+    is :obj:`True` for the recomputation, so that e.g. running statistics of batch norm layers are
+    only updated once.
+
+    Parameters
+    ----------
+    function : :obj:`callable`
+        forward pass of the layer
+    args
+        arguments of :obj:`function`
+
+    Returns
+    -------
+    output of :obj:`function`
+
+    """
+    n_calls = [0]
+
+    def run_function(*args):
+        n_calls[0] += 1
+        return function(*args, recompute=n_calls[0] > 1)
+
+    return checkpoint(run_function, *args, use_reentrant=False)
+
+
+def _batch_norm(layer, x, recompute=False):
+    if recompute and layer.training and layer.track_running_stats:
+        # normalize with batch statistics; running statistics are updated on copies so that they
+        # are not updated again
+        return functional.batch_norm(
+            x, layer.running_mean.clone(), layer.running_var.clone(), layer.weight, layer.bias,
+            True, 0.0, layer.eps)
+    else:
+        return layer(x)
+
+
+def _get_layer_modules(layers, names):
+    # all leaf modules of a layer (including all session-specific modules)
+    return [mod for name in names for mod in getattr(layers, name).modules()
+            if len(list(mod.children())) == 0]
 
 
 class ConvAEEncoder(nn.Module):
@@ -26,11 +136,16 @@ class ConvAEEncoder(nn.Module):
             - 'ae_encoding_x_padding' (:obj:`list`)
             - 'ae_encoding_y_padding' (:obj:`list`)
             - 'ae_encoding_layer_type' (:obj:`list`)
+            - 'ae_encoding_checkpoint_layers' (:obj:`str`, optional): layers whose intermediate
+              values are recomputed during the backward pass rather than stored (activation
+              checkpointing); 'none' (default) | 'all' | layer numbers like '0;1'
 
         """
         super(ConvAEEncoder, self).__init__()
         self.hparams = hparams
         self.encoder = None
+        self.layers = None
+        self.checkpoint_layers = None
         self.build_model()
 
     def __str__(self):
@@ -122,6 +237,10 @@ class ConvAEEncoder(nn.Module):
         else:
             raise ValueError('Not valid model type')
 
+        self.layers = get_layer_groups(self.encoder)
+        self.checkpoint_layers = get_checkpoint_layers(
+            self.hparams.get('ae_encoding_checkpoint_layers', None), self.layers.keys())
+
     def _get_conv2d_args(self, layer, global_layer):
 
         if layer == 0:
@@ -191,18 +310,16 @@ class ConvAEEncoder(nn.Module):
         # max pooling to use in unpooling
         pool_idx = []
         target_output_size = []
-        for layer in self.encoder:
-            if isinstance(layer, nn.MaxPool2d):
-                target_output_size.append(x.size())
-                x, idx = layer(x)
-                pool_idx.append(idx)
-            elif isinstance(layer, nn.ModuleList):
-                x = layer[dataset](x)
+        for layer_num, names in self.layers.items():
+            if layer_num in self.checkpoint_layers and torch.is_grad_enabled():
+                x, idx, outsize = checkpoint_layer(self._forward_layer, x, names, dataset)
             else:
-                x = layer(x)
+                x, idx, outsize = self._forward_layer(x, names, dataset)
+            pool_idx += idx
+            target_output_size += outsize
 
         # Reshape for ff layer
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
 
         if self.hparams['model_class'] == 'ae':
             return self.FF(x), pool_idx, target_output_size
@@ -211,6 +328,37 @@ class ConvAEEncoder(nn.Module):
         else:
             raise ValueError('"%s" is not a valid model class' % self.hparams['model_class'])
 
+    def _forward_layer(self, x, names, dataset=None, recompute=False):
+        """Process input data with the modules of a single layer."""
+        pool_idx = []
+        target_output_size = []
+        for name in names:
+            layer = getattr(self.encoder, name)
+            if isinstance(layer, nn.MaxPool2d):
+                target_output_size.append(x.size())
+                x, idx = layer(x)
+                pool_idx.append(idx)
+            elif isinstance(layer, nn.ModuleList):
+                x = layer[dataset](x)
+            elif isinstance(layer, nn.BatchNorm2d):
+                x = _batch_norm(layer, x, recompute=recompute)
+            else:
+                x = layer(x)
+        return x, pool_idx, target_output_size
+
+    def get_checkpointed_layers(self):
+        """Return the modules of each checkpointed layer, e.g. to estimate memory requirements.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`list`
+            leaf modules of each checkpointed layer
+
+        """
+        return [
+            _get_layer_modules(self.encoder, self.layers[layer_num])
+            for layer_num in self.checkpoint_layers]
+
     def freeze(self):
         """Prevent updates to encoder parameters."""
         for param in self.parameters():
@@ -244,11 +392,16 @@ class ConvAEDecoder(nn.Module):
             - 'ae_decoding_layer_type' (:obj:`list`)
             - 'ae_decoding_starting_dim' (:obj:`list`)
             - 'ae_decoding_last_FF_layer' (:obj:`bool`)
+            - 'ae_decoding_checkpoint_layers' (:obj:`str`, optional): layers whose intermediate
+              values are recomputed during the backward pass rather than stored (activation
+              checkpointing); 'none' (default) | 'all' | layer numbers like '0;1'
 
         """
         super(ConvAEDecoder, self).__init__()
         self.hparams = hparams
         self.decoder = None
+        self.layers = None
+        self.checkpoint_layers = None
         self.build_model()
 
     def __str__(self):
@@ -366,6 +519,10 @@ class ConvAEDecoder(nn.Module):
         else:
             raise ValueError('Not valid model type')
 
+        self.layers = get_layer_groups(self.decoder)
+        self.checkpoint_layers = get_checkpoint_layers(
+            self.hparams.get('ae_decoding_checkpoint_layers', None), self.layers.keys())
+
     def _get_convtranspose2d_args(self, layer, global_layer):
 
         # input channels
@@ -465,11 +622,34 @@ class ConvAEDecoder(nn.Module):
             self.hparams['ae_decoding_starting_dim'][1],
             self.hparams['ae_decoding_starting_dim'][2])
 
-        for name, layer in self.decoder.named_children():
-            if isinstance(layer, nn.MaxUnpool2d):
+        for layer_num, names in self.layers.items():
+            # pop unpooling info here rather than in a (possibly recomputed) checkpointed layer
+            if any([isinstance(getattr(self.decoder, name), nn.MaxUnpool2d) for name in names]):
                 idx = pool_idx.pop(-1)
                 outsize = target_output_size.pop(-1)
-                x = layer(x, idx, outsize)
+            else:
+                idx = None
+                outsize = None
+            if layer_num in self.checkpoint_layers and torch.is_grad_enabled():
+                x = checkpoint_layer(self._forward_layer, x, names, idx, outsize, dataset)
+            else:
+                x = self._forward_layer(x, names, idx, outsize, dataset)
+
+        if self.hparams['model_class'] == 'ae':
+            return x
+        elif self.hparams['model_class'] == 'vae':
+            raise NotImplementedError
+        else:
+            raise ValueError('"%s" is not a valid model class' % self.hparams['model_class'])
+
+    def _forward_layer(
+            self, x, names, pool_idx=None, target_output_size=None, dataset=None,
+            recompute=False):
+        """Process input data with the modules of a single layer."""
+        for name in names:
+            layer = getattr(self.decoder, name)
+            if isinstance(layer, nn.MaxUnpool2d):
+                x = layer(x, pool_idx, target_output_size)
             elif isinstance(layer, nn.ConvTranspose2d):
                 x = layer(x)
                 if self.conv_t_pads[name] is not None:
@@ -483,22 +663,31 @@ class ConvAEDecoder(nn.Module):
                     # (-i does cropping!)
                     x = functional.pad(x, [-i for i in self.conv_t_pads[name]])
             elif isinstance(layer, nn.Linear):
-                x = x.view(x.shape[0],-1)
+                x = x.reshape(x.shape[0], -1)
                 x = layer(x)
                 x = x.view(
                     -1,
                     self.hparams['ae_input_dim'][0],
                     self.hparams['ae_input_dim'][1],
                     self.hparams['ae_input_dim'][2])
+            elif isinstance(layer, nn.BatchNorm2d):
+                x = _batch_norm(layer, x, recompute=recompute)
             else:
                 x = layer(x)
+        return x
 
-        if self.hparams['model_class'] == 'ae':
-            return x
-        elif self.hparams['model_class'] == 'vae':
-            raise NotImplementedError
-        else:
-            raise ValueError('"%s" is not a valid model class' % self.hparams['model_class'])
+    def get_checkpointed_layers(self):
+        """Return the modules of each checkpointed layer, e.g. to estimate memory requirements.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`list`
+            leaf modules of each checkpointed layer
+
+        """
+        return [
+            _get_layer_modules(self.decoder, self.layers[layer_num])
+            for layer_num in self.checkpoint_layers]
 
     def freeze(self):
         """Prevent updates to decoder parameters."""
@@ -698,6 +887,8 @@ class AE(nn.Module):
             - 'ae_decoding_layer_type' (:obj:`list`)
             - 'ae_decoding_starting_dim' (:obj:`list`)
             - 'ae_decoding_last_FF_layer' (:obj:`bool`)
+            - 'ae_encoding_checkpoint_layers' (:obj:`str`, optional)
+            - 'ae_decoding_checkpoint_layers' (:obj:`str`, optional)
 
         """
         super(AE, self).__init__()
@@ -8,6 +8,7 @@ from matplotlib.animation import FFMpegWriter
 import numpy as np
 from behavenet.plotting import concat
 from behavenet import make_dir_if_not_exists
+from behavenet.data.data_generator import images_to_float
 from behavenet.fitting.utils import get_best_model_and_data
 from behavenet.fitting.eval import get_reconstruction
 
@@ -61,7 +62,7 @@ def make_ae_reconstruction_movie_wrapper(
         # choose first test trial
         trial = data_generator.batch_idxs[sess_idx]['test'][0]
     batch = data_generator.datasets[sess_idx][trial]
-    ims_orig_pt = batch['images'][:max_frames]
+    ims_orig_pt = images_to_float(batch['images'][:max_frames])
 
     ims_recon_ae = get_reconstruction(model_ae, ims_orig_pt)
     if include_linear:
@@ -248,7 +249,7 @@ def make_neural_reconstruction_movie_wrapper(
 
     # get images from data generator (move to cpu)
     batch = data_generator_ae.datasets[sess_idx][trial]
-    ims_orig_pt = batch['images'][:max_frames].cpu()  # 400
+    ims_orig_pt = images_to_float(batch['images'][:max_frames].cpu())  # 400
 
     # push images through ae to get reconstruction
     ims_recon_ae = get_reconstruction(model_ae, ims_orig_pt)
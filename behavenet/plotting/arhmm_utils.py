@@ -10,6 +10,7 @@ import matplotlib
 import matplotlib.animation as animation
 from matplotlib.animation import FFMpegWriter
 from behavenet import make_dir_if_not_exists
+from behavenet.data.storage import load_exported_data
 from behavenet.models import AE as AE
 
 
@@ -223,8 +224,7 @@ def get_model_latents_states(
         all_latents = load_labels_like_latents(hparams, sess_ids, sess_idx)
     else:
         _, latents_file = get_transforms_paths('ae_latents', hparams, sess_ids[sess_idx])
-        with open(latents_file, 'rb') as f:
-            all_latents = pickle.load(f)
+        all_latents = load_exported_data(latents_file)
 
     # collect inferred latents/states
     trial_idxs = {}
@@ -338,8 +338,7 @@ def make_syllable_movies_wrapper(
         latents = load_labels_like_latents(hparams, sess_ids, sess_idx)
     else:
         _, latents_file = get_transforms_paths('ae_latents', hparams, sess_ids[sess_idx])
-        with open(latents_file, 'rb') as f:
-            latents = pickle.load(f)
+        latents = load_exported_data(latents_file)
     trial_idxs = latents['trials'][dtype]
     # load model
     model_file = os.path.join(hparams['expt_dir'], 'version_%i' % version, 'best_val_model.pt')
@@ -0,0 +1,137 @@
+"""Benchmark data-parallel fitting of autoencoders across cpu processes.
+
+The same convolutional autoencoder (handcrafted architecture 0) is fit to a synthetic dataset of
+moving gaussian blobs spread over several sessions, once for each requested number of processes
+(see :mod:`behavenet.fitting.distributed`); the time per epoch, the final validation loss and the
+agreement of the epoch 0 metrics (evaluated on the untrained model) with the single-process fit
+are compared, e.g.::
+
+    python benchmarks/distributed.py --n_processes 1 2 4 --n_sessions 2 --n_epochs 3
+
+Every optimizer step of a distributed fit averages one batch from each process, so that an epoch
+has fewer steps; the validation loss after a fixed number of epochs is therefore higher than that
+of a single-process fit unless the learning rate is scaled accordingly.
+
+Processes share the cores of the machine, so speedups require at least as many cores as
+processes.
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import h5py
+import numpy as np
+import torch
+from test_tube import Experiment
+from behavenet.data.data_generator import ConcatSessionsGenerator
+from behavenet.fitting.ae_model_architecture_generator import draw_handcrafted_archs
+from behavenet.fitting.distributed import run_distributed
+from behavenet.fitting.metrics import load_metrics
+from behavenet.fitting.training import fit
+from behavenet.models import AE
+
+
+def make_session(path, n_trials, n_time, n_pix, n_blobs=3, rng_seed=0):
+    """Write uint8 images of gaussian blobs moving on smooth random trajectories."""
+    rng = np.random.RandomState(rng_seed)
+    grid = np.arange(n_pix)
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('images')
+        for tr in range(n_trials):
+            images = np.zeros((n_time, 1, n_pix, n_pix))
+            for b in range(n_blobs):
+                steps = rng.randn(n_time, 2) * n_pix / 100
+                pos = rng.uniform(0.2, 0.8, size=(1, 2)) * n_pix + np.cumsum(steps, axis=0)
+                pos = np.clip(pos, 0, n_pix - 1)
+                width = n_pix / 10 * (1 + b / n_blobs)
+                blob_y = np.exp(-(grid[None, :] - pos[:, 0, None]) ** 2 / (2 * width ** 2))
+                blob_x = np.exp(-(grid[None, :] - pos[:, 1, None]) ** 2 / (2 * width ** 2))
+                images[:, 0] += blob_y[:, :, None] * blob_x[:, None, :]
+            group.create_dataset(
+                'trial_%04i' % tr, data=(255 * images / np.max(images)).astype('uint8'))
+
+
+def fit_model(args, data_dir, hparams, exp=None):
+    """Build data generator and model and fit the model; run by each process."""
+    sess_ids = [
+        {'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': 'sess%i' % s}
+        for s in range(args.n_sessions)]
+    paths = [[os.path.join(data_dir, 'sess%i.hdf5' % s)] for s in range(args.n_sessions)]
+    data_generator = ConcatSessionsGenerator(
+        data_dir, sess_ids, [['images']] * args.n_sessions, [[None]] * args.n_sessions, paths,
+        device='cpu')
+    arch = draw_handcrafted_archs(
+        [1, args.n_pix, args.n_pix], args.n_ae_latents, np.array([0]), check_memory=False)[0]
+    hparams = {**arch, **hparams, 'n_datasets': args.n_sessions}
+    torch.manual_seed(hparams['rng_seed_model'])
+    model = AE(hparams)
+    model.version = hparams['version']
+    t_beg = time.time()
+    fit(hparams, model, data_generator, exp, method='ae')
+    return time.time() - t_beg
+
+
+def main(args):
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        data_dir = os.path.join(tmp_dir, 'data')
+        os.makedirs(data_dir)
+        for s in range(args.n_sessions):
+            make_session(
+                os.path.join(data_dir, 'sess%i.hdf5' % s), args.n_trials, args.n_time,
+                args.n_pix, rng_seed=s)
+        print('%i sessions of %i trials of %i frames (%i x %i pixels)' % (
+            args.n_sessions, args.n_trials, args.n_time, args.n_pix, args.n_pix))
+
+        results = {}
+        for n_processes in args.n_processes:
+            save_dir = os.path.join(tmp_dir, 'fits_%i' % n_processes)
+            hparams = {
+                'model_class': 'ae', 'model_type': 'conv', 'n_ae_latents': args.n_ae_latents,
+                'device': 'cpu', 'rng_seed_model': 0, 'learning_rate': args.learning_rate,
+                'max_n_epochs': args.n_epochs, 'min_n_epochs': 0, 'val_check_interval': 1,
+                'enable_early_stop': False, 'early_stop_history': 1, 'export_latents': False,
+                'checkpoint_interval': 0, 'expt_dir': os.path.join(save_dir, 'test')}
+            exp = Experiment(name='test', save_dir=save_dir)
+            hparams['version'] = exp.version
+            if n_processes > 1:
+                t_fit = run_distributed(
+                    fit_model, n_processes, args=(args, data_dir, hparams),
+                    main_kwargs={'exp': exp})
+            else:
+                t_fit = fit_model(args, data_dir, hparams, exp)
+            metrics = load_metrics(os.path.join(save_dir, 'test', 'version_%i' % exp.version))
+            results[n_processes] = {
+                't_epoch': t_fit / (args.n_epochs + 1),
+                'val_loss': metrics['val_loss'].dropna().values[-1],
+                'epoch_0': metrics[metrics.epoch == 0][['tr_loss', 'val_loss']].values}
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('%-12s %12s %10s %14s %20s' % (
+        'processes', 'epoch (s)', 'speedup', 'final val loss', 'epoch 0 max delta'))
+    base = results[args.n_processes[0]]
+    for n_processes, res in results.items():
+        delta = np.nanmax(np.abs(res['epoch_0'].astype(float) - base['epoch_0'].astype(float)))
+        print('%-12i %12.3f %9.2fx %14.6f %20.3e' % (
+            n_processes, res['t_epoch'], base['t_epoch'] / res['t_epoch'], res['val_loss'],
+            delta))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_processes', default=[1, 2], nargs='+', type=int)
+    parser.add_argument('--n_sessions', default=2, type=int)
+    parser.add_argument('--n_trials', default=20, type=int)
+    parser.add_argument('--n_time', default=100, type=int)
+    parser.add_argument('--n_pix', default=64, type=int)
+    parser.add_argument('--n_ae_latents', default=8, type=int)
+    parser.add_argument('--n_epochs', default=3, type=int)
+    parser.add_argument('--learning_rate', default=1e-4, type=float)
+    parser.add_argument('--tmp_dir', default=None, type=str)
+    main(parser.parse_args())
@@ -0,0 +1,109 @@
+"""Compare HDF5 read throughput of compression codecs and chunk caches on a synthetic session.
+
+A synthetic session of uint8 videos is written in the per-trial layout, converted to the packed
+layout with each requested codec, and then read back through the same code path as the data
+generators (:func:`behavenet.data.storage.read_trial`), both as whole trials and as frame windows
+at random offsets. Results depend strongly on the filesystem and CPU, so this should be run on the
+machines that will be used for fitting, e.g.::
+
+    python benchmarks/hdf5_codecs.py --tmp_dir /path/to/scratch --codecs none lzf gzip-1 gzip-4
+
+Note that the OS page cache is not dropped between reads; use a session larger than the memory
+of the machine (or drop the page cache between codecs) to measure disk-bound throughput.
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import h5py
+import numpy as np
+from behavenet.data.storage import configure_hdf5_pool
+from behavenet.data.storage import convert_to_packed
+from behavenet.data.storage import get_hdf5_file
+from behavenet.data.storage import get_hdf5_pool
+from behavenet.data.storage import read_trial
+
+
+def make_session(path, n_trials, n_frames, y_pix, x_pix, rng_seed=0):
+    """Write a synthetic session of smooth, noisy videos (compressible like real behavior)."""
+    rng = np.random.RandomState(rng_seed)
+    yy, xx = np.meshgrid(np.arange(y_pix), np.arange(x_pix), indexing='ij')
+    with h5py.File(path, 'w', libver='latest') as f:
+        group = f.create_group('images')
+        for tr in range(n_trials):
+            t = np.arange(n_frames)[:, None, None]
+            cy, cx = rng.uniform(0, y_pix), rng.uniform(0, x_pix)
+            blob = np.exp(-((yy - cy - 5 * np.sin(t / 10.0)) ** 2 + (xx - cx) ** 2) / 200.0)
+            frames = 100 + 120 * blob + rng.normal(scale=4, size=blob.shape)
+            group.create_dataset(
+                'trial_%04i' % tr, data=np.clip(frames, 0, 255).astype('uint8')[:, None])
+
+
+def time_reads(path, n_trials, n_frames, frame_window, n_windows, rng_seed=0):
+    """Return read throughput in MB/s for whole trials and for random frame windows."""
+    get_hdf5_pool().close()
+    group = get_hdf5_file(path)['images']
+    t_beg = time.time()
+    n_bytes = 0
+    for tr in range(n_trials):
+        n_bytes += read_trial(group, tr).nbytes
+    mbs_trials = n_bytes / 2 ** 20 / (time.time() - t_beg)
+
+    rng = np.random.RandomState(rng_seed)
+    t_beg = time.time()
+    n_bytes = 0
+    for _ in range(n_windows):
+        tr = rng.randint(n_trials)
+        beg = rng.randint(n_frames - frame_window + 1)
+        n_bytes += read_trial(group, tr, slice(beg, beg + frame_window)).nbytes
+    mbs_windows = n_bytes / 2 ** 20 / (time.time() - t_beg)
+    return mbs_trials, mbs_windows
+
+
+def main(args):
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        src = os.path.join(tmp_dir, 'data.hdf5')
+        make_session(src, args.n_trials, args.n_frames, args.y_pix, args.x_pix)
+        print('%-8s %-10s %9s %8s %12s %12s' % (
+            'codec', 'access', 'cache_mb', 'size_mb', 'trials_mb/s', 'windows_mb/s'))
+        for codec in args.codecs:
+            for access in args.access:
+                dst = os.path.join(tmp_dir, 'data_%s_%s.hdf5' % (codec, access))
+                convert_to_packed(
+                    src, dst, access=access, compression=None if codec == 'none' else codec)
+                size_mb = os.path.getsize(dst) / 2 ** 20
+                for cache_mb in args.cache_mb:
+                    configure_hdf5_pool(
+                        rdcc_nbytes=None if cache_mb <= 0 else int(cache_mb * 2 ** 20))
+                    mbs_trials, mbs_windows = time_reads(
+                        dst, args.n_trials, args.n_frames, args.frame_window, args.n_windows)
+                    print('%-8s %-10s %9g %8.1f %12.1f %12.1f' % (
+                        codec, access, cache_mb, size_mb, mbs_trials, mbs_windows))
+                get_hdf5_pool().close()
+                os.remove(dst)
+    finally:
+        get_hdf5_pool().close()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tmp_dir', default=None, type=str)
+    parser.add_argument('--n_trials', default=50, type=int)
+    parser.add_argument('--n_frames', default=200, type=int)
+    parser.add_argument('--y_pix', default=128, type=int)
+    parser.add_argument('--x_pix', default=128, type=int)
+    parser.add_argument('--frame_window', default=32, type=int)
+    parser.add_argument('--n_windows', default=500, type=int)
+    parser.add_argument('--codecs', default=['none', 'lzf', 'gzip-1', 'gzip-4'], nargs='+')
+    parser.add_argument('--access', default=['sequential', 'random'], nargs='+')
+    parser.add_argument(
+        '--cache_mb', default=[0, 16], type=float, nargs='+',
+        help='chunk cache sizes in MB; 0 uses the hdf5 default')
+    main(parser.parse_args())
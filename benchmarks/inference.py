@@ -0,0 +1,111 @@
+"""Benchmark compiled, frozen inference engines against eager forward passes of autoencoders.
+
+A convolutional autoencoder (handcrafted architecture 0, optionally with batch norm) is evaluated
+on a synthetic session of moving gaussian blobs, once with the eager model and once with an
+inference engine (see :mod:`behavenet.fitting.inference`); the time to encode and to reconstruct
+all frames, the time to build the engine and the largest deviation from the eager outputs are
+compared, e.g.::
+
+    python benchmarks/inference.py --n_trials 10 --n_time 200 --batch_norm
+
+Speedups depend on the pytorch version and the cpu; convolution-activation fusion requires a
+pytorch build with oneDNN (mkldnn).
+
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+from behavenet.fitting.ae_model_architecture_generator import draw_handcrafted_archs
+from behavenet.fitting.inference import InferenceEngine
+from behavenet.models import AE
+
+
+def make_session(n_trials, n_time, n_pix, n_blobs=3, rng_seed=0):
+    """Images of gaussian blobs moving on smooth random trajectories, values in [0, 1]."""
+    rng = np.random.RandomState(rng_seed)
+    grid = np.arange(n_pix)
+    images = np.zeros((n_trials, n_time, 1, n_pix, n_pix), dtype=np.float32)
+    for b in range(n_blobs):
+        steps = rng.randn(n_trials, n_time, 2) * n_pix / 100
+        pos = rng.uniform(0.2, 0.8, size=(n_trials, 1, 2)) * n_pix + np.cumsum(steps, axis=1)
+        pos = np.clip(pos, 0, n_pix - 1)
+        width = n_pix / 10 * (1 + b / n_blobs)
+        blob_y = np.exp(-(grid[None, None, :] - pos[:, :, 0, None]) ** 2 / (2 * width ** 2))
+        blob_x = np.exp(-(grid[None, None, :] - pos[:, :, 1, None]) ** 2 / (2 * width ** 2))
+        images[:, :, 0] += blob_y[:, :, :, None] * blob_x[:, :, None, :]
+    return images / np.max(images)
+
+
+def build_model(n_pix, n_ae_latents, batch_norm, rng_seed=0):
+    hparams = {
+        'model_class': 'ae', 'model_type': 'conv', 'n_ae_latents': n_ae_latents,
+        'device': 'cpu', 'rng_seed_model': rng_seed}
+    arch = draw_handcrafted_archs(
+        [1, n_pix, n_pix], n_ae_latents, np.array([0]), check_memory=False)[0]
+    arch['ae_batch_norm'] = batch_norm
+    arch['ae_batch_norm_momentum'] = None
+    hparams = {**arch, **hparams}
+    torch.manual_seed(rng_seed)
+    model = AE(hparams)
+    if batch_norm:
+        # non-trivial batch norm statistics
+        model.train()
+        with torch.no_grad():
+            model(torch.rand(64, 1, n_pix, n_pix))
+    return model.eval()
+
+
+def time_passes(function, images):
+    t_beg = time.time()
+    with torch.no_grad():
+        outputs = [function(torch.from_numpy(trial)) for trial in images]
+    return time.time() - t_beg, outputs
+
+
+def main(args):
+
+    images = make_session(args.n_trials, args.n_time, args.n_pix)
+    print('%i trials of %i frames (%i x %i pixels)' % (
+        args.n_trials, args.n_time, args.n_pix, args.n_pix))
+
+    model = build_model(args.n_pix, args.n_ae_latents, args.batch_norm)
+    t_beg = time.time()
+    engine = InferenceEngine(model, batch_size=args.batch_size)
+    t_build = time.time() - t_beg
+    print('engine built in %.3f s (batch size %i)' % (t_build, engine.batch_size))
+
+    def encode_eager(x):
+        return model.encoding(x)[0]
+
+    def reconstruct_eager(x):
+        return model(x)[0]
+
+    results = {}
+    for name, eager, compiled in [
+            ('encode', encode_eager, engine.encode),
+            ('reconstruct', reconstruct_eager, lambda x: engine.reconstruct(x)[0])]:
+        t_eager, out_eager = time_passes(eager, images)
+        t_engine, out_engine = time_passes(compiled, images)
+        err = max(
+            float(torch.max(torch.abs(a - b))) for a, b in zip(out_eager, out_engine))
+        results[name] = {'t_eager': t_eager, 't_engine': t_engine, 'err': err}
+
+    print('%-12s %12s %12s %10s %14s' % (
+        'pass', 'eager (s)', 'engine (s)', 'speedup', 'max abs err'))
+    for name, res in results.items():
+        print('%-12s %12.3f %12.3f %9.2fx %14.3e' % (
+            name, res['t_eager'], res['t_engine'], res['t_eager'] / res['t_engine'], res['err']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_trials', default=10, type=int)
+    parser.add_argument('--n_time', default=200, type=int)
+    parser.add_argument('--n_pix', default=64, type=int)
+    parser.add_argument('--n_ae_latents', default=8, type=int)
+    parser.add_argument('--batch_norm', action='store_true', default=False)
+    parser.add_argument('--batch_size', default=None, type=int)
+    main(parser.parse_args())
@@ -0,0 +1,121 @@
+"""Benchmark bfloat16 autocast against float32 for training and evaluating autoencoders.
+
+Two copies of the same convolutional autoencoder (handcrafted architecture 0) are trained on a
+synthetic session of moving gaussian blobs, one with :obj:`precision='fp32'` and one with
+:obj:`precision='bf16'` (see :mod:`behavenet.fitting.precision`); the time per epoch and per
+reconstruction of the test trials, as well as the test reconstruction MSE, are compared, e.g.::
+
+    python benchmarks/precision.py --n_trials 20 --n_time 100 --n_epochs 3
+
+Speedups depend on cpu support for bfloat16 (e.g. AVX-512 BF16 or AMX); without it, bf16 may be
+slower than fp32.
+
+"""
+
+import argparse
+import copy
+import time
+import numpy as np
+import torch
+from behavenet.fitting.ae_model_architecture_generator import draw_handcrafted_archs
+from behavenet.fitting.eval import get_reconstruction
+from behavenet.fitting.training import AELoss
+from behavenet.models import AE
+
+
+def make_session(n_trials, n_time, n_pix, n_blobs=3, rng_seed=0):
+    """Images of gaussian blobs moving on smooth random trajectories, values in [0, 1]."""
+    rng = np.random.RandomState(rng_seed)
+    grid = np.arange(n_pix)
+    images = np.zeros((n_trials, n_time, 1, n_pix, n_pix), dtype=np.float32)
+    for b in range(n_blobs):
+        steps = rng.randn(n_trials, n_time, 2) * n_pix / 100
+        pos = rng.uniform(0.2, 0.8, size=(n_trials, 1, 2)) * n_pix + np.cumsum(steps, axis=1)
+        pos = np.clip(pos, 0, n_pix - 1)
+        width = n_pix / 10 * (1 + b / n_blobs)
+        blob_y = np.exp(-(grid[None, None, :] - pos[:, :, 0, None]) ** 2 / (2 * width ** 2))
+        blob_x = np.exp(-(grid[None, None, :] - pos[:, :, 1, None]) ** 2 / (2 * width ** 2))
+        images[:, :, 0] += blob_y[:, :, :, None] * blob_x[:, :, None, :]
+    return images / np.max(images)
+
+
+def build_model(n_pix, n_ae_latents, precision, rng_seed=0):
+    hparams = {
+        'model_class': 'ae', 'model_type': 'conv', 'n_ae_latents': n_ae_latents,
+        'device': 'cpu', 'precision': precision, 'rng_seed_model': rng_seed}
+    arch = draw_handcrafted_archs(
+        [1, n_pix, n_pix], n_ae_latents, np.array([0]), check_memory=False)[0]
+    hparams = {**arch, **hparams}
+    torch.manual_seed(rng_seed)
+    return AE(hparams)
+
+
+def train_epoch(loss, optimizer, images):
+    loss.train()
+    t_beg = time.time()
+    for trial in np.random.permutation(images.shape[0]):
+        optimizer.zero_grad()
+        loss.calc_loss({'images': torch.from_numpy(images[trial])[None]})
+        optimizer.step()
+    return time.time() - t_beg
+
+
+def evaluate(model, images):
+    model.eval()
+    t_beg = time.time()
+    with torch.no_grad():
+        recon = np.stack([get_reconstruction(model, torch.from_numpy(trial)) for trial in images])
+    return time.time() - t_beg, float(np.mean((recon - images) ** 2))
+
+
+def main(args):
+
+    images = make_session(args.n_trials + args.n_test_trials, args.n_time, args.n_pix)
+    images_train, images_test = images[:args.n_trials], images[args.n_trials:]
+    print('%i train / %i test trials of %i frames (%i x %i pixels)' % (
+        args.n_trials, args.n_test_trials, args.n_time, args.n_pix, args.n_pix))
+
+    results = {}
+    state_dict = None
+    for precision in ['fp32', 'bf16']:
+        model = build_model(args.n_pix, args.n_ae_latents, precision)
+        # start both models from the same weights
+        if state_dict is None:
+            state_dict = copy.deepcopy(model.state_dict())
+        else:
+            model.load_state_dict(state_dict)
+        model.hparams['chunk_size'] = args.n_time
+        loss = AELoss(model)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate)
+        np.random.seed(args.rng_seed)
+        t_epochs = [train_epoch(loss, optimizer, images_train) for _ in range(args.n_epochs)]
+        t_eval, mse = evaluate(model, images_test)
+        # reconstructions of the bf16-trained model in full precision
+        model.hparams['precision'] = 'fp32'
+        _, mse_fp32 = evaluate(model, images_test)
+        results[precision] = {
+            't_epoch': np.min(t_epochs), 't_eval': t_eval, 'mse': mse, 'mse_fp32': mse_fp32}
+
+    print('%-10s %12s %12s %14s %18s' % (
+        'precision', 'epoch (s)', 'recon (s)', 'test mse', 'test mse (fp32)'))
+    for precision, res in results.items():
+        print('%-10s %12.3f %12.3f %14.6f %18.6f' % (
+            precision, res['t_epoch'], res['t_eval'], res['mse'], res['mse_fp32']))
+    print('speedup: training %.2fx, reconstruction %.2fx' % (
+        results['fp32']['t_epoch'] / results['bf16']['t_epoch'],
+        results['fp32']['t_eval'] / results['bf16']['t_eval']))
+    print('test mse delta (bf16 - fp32): %.3e' % (results['bf16']['mse'] - results['fp32']['mse']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_trials', default=20, type=int)
+    parser.add_argument('--n_test_trials', default=5, type=int)
+    parser.add_argument('--n_time', default=100, type=int)
+    parser.add_argument('--n_pix', default=64, type=int)
+    parser.add_argument('--n_ae_latents', default=8, type=int)
+    parser.add_argument('--n_epochs', default=3, type=int)
+    parser.add_argument('--learning_rate', default=1e-4, type=float)
+    parser.add_argument('--rng_seed', default=0, type=int)
+    main(parser.parse_args())
@@ -0,0 +1,103 @@
+"""Benchmark the discrete-state transforms on sessions of ARHMM states.
+
+Random state sequences with runs of geometrically distributed length are transformed with
+:class:`behavenet.data.transforms.MakeOneHot` and :class:`behavenet.data.transforms.BlockShuffle`,
+and compared (timing and outputs) with the previous per-trial loop implementations, e.g.::
+
+    python benchmarks/transforms.py --n_trials 1000 --n_time 1000
+
+"""
+
+import argparse
+import time
+import numpy as np
+from behavenet.data.transforms import BlockShuffle
+from behavenet.data.transforms import MakeOneHot
+
+
+def make_one_hot_loop(sample):
+    """Previous implementation of :class:`MakeOneHot`, looping over trials."""
+    n_trials, n_time = sample.shape
+    n_classes = int(np.nanmax(sample))
+    onehot = np.zeros((n_trials, n_time, n_classes + 1))
+    for t in range(n_trials):
+        if not any(np.isnan(sample[t])):
+            onehot[t, np.arange(n_time), sample[t].astype('int')] = 1
+        else:
+            onehot[t] = np.nan
+    return onehot
+
+
+def block_shuffle_loop(sample, rng_seed):
+    """Previous implementation of :class:`BlockShuffle`, looping over trials and runs."""
+    np.random.seed(rng_seed)
+    n_trials, n_time = sample.shape
+    sample_shuff = np.zeros_like(sample)
+    for t in range(n_trials):
+        if not any(np.isnan(sample[t])):
+            state_change = np.where(np.concatenate([[0], np.diff(sample[t])], axis=0) != 0)[0]
+            runs = []
+            prev_beg = 0
+            for curr_beg in state_change:
+                runs.append(np.arange(prev_beg, curr_beg))
+                prev_beg = curr_beg
+            runs.append(np.arange(prev_beg, n_time))
+            rand_perm = np.random.permutation(len(runs))
+            runs_shuff = [runs[idx] for idx in rand_perm]
+            sample_shuff[t] = sample[t, np.concatenate(runs_shuff)]
+        else:
+            sample_shuff[t] = np.nan
+    return sample_shuff
+
+
+def make_states(n_trials, n_time, n_states, mean_run_len, frac_nan, rng_seed=0):
+    """Random state sequences with geometric run lengths; some trials are all NaN (gap trials)."""
+    rng = np.random.RandomState(rng_seed)
+    switch = rng.rand(n_trials, n_time) < 1.0 / mean_run_len
+    jumps = rng.randint(1, n_states, size=(n_trials, n_time)) * switch
+    states = (np.cumsum(jumps, axis=1) % n_states).astype(np.float64)
+    states[rng.rand(n_trials) < frac_nan] = np.nan
+    return states
+
+
+def time_fn(fn, n_reps):
+    times = []
+    for _ in range(n_reps):
+        t_beg = time.time()
+        out = fn()
+        times.append(time.time() - t_beg)
+    return out, np.min(times)
+
+
+def main(args):
+
+    states = make_states(
+        args.n_trials, args.n_time, args.n_states, args.mean_run_len, args.frac_nan)
+    print('%i trials x %i time points (%i frames)' % (
+        args.n_trials, args.n_time, args.n_trials * args.n_time))
+    print('%-12s %10s %10s %8s %10s' % ('transform', 'loop (s)', 'vec (s)', 'speedup', 'identical'))
+
+    out_loop, t_loop = time_fn(lambda: make_one_hot_loop(states), args.n_reps)
+    out_vec, t_vec = time_fn(lambda: MakeOneHot()(states), args.n_reps)
+    print('%-12s %10.4f %10.4f %8.1f %10s' % (
+        'MakeOneHot', t_loop, t_vec, t_loop / t_vec,
+        np.array_equal(out_loop, out_vec, equal_nan=True)))
+
+    out_loop, t_loop = time_fn(lambda: block_shuffle_loop(states, args.rng_seed), args.n_reps)
+    out_vec, t_vec = time_fn(lambda: BlockShuffle(args.rng_seed)(states), args.n_reps)
+    print('%-12s %10.4f %10.4f %8.1f %10s' % (
+        'BlockShuffle', t_loop, t_vec, t_loop / t_vec,
+        np.array_equal(out_loop, out_vec, equal_nan=True)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_trials', default=1000, type=int)
+    parser.add_argument('--n_time', default=1000, type=int)
+    parser.add_argument('--n_states', default=8, type=int)
+    parser.add_argument('--mean_run_len', default=10, type=float)
+    parser.add_argument('--frac_nan', default=0.1, type=float)
+    parser.add_argument('--rng_seed', default=0, type=int)
+    parser.add_argument('--n_reps', default=3, type=int)
+    main(parser.parse_args())
@@ -0,0 +1,97 @@
+import os
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from test_tube import Experiment
+from behavenet.data.data_generator import ConcatSessionsGenerator
+from behavenet.fitting.distributed import get_rank
+from behavenet.fitting.distributed import run_distributed
+from behavenet.fitting.training import fit
+from behavenet.models import AE
+
+N_PIX = 16
+N_SESSIONS = 2
+
+pytestmark = pytest.mark.skipif(
+    not torch.distributed.is_available(), reason='torch.distributed is not available')
+
+
+def make_session(path, n_trials=10, n_time=20, rng_seed=0):
+    rng = np.random.RandomState(rng_seed)
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('images')
+        for tr in range(n_trials):
+            group.create_dataset(
+                'trial_%04i' % tr,
+                data=rng.randint(0, 256, size=(n_time, 1, N_PIX, N_PIX)).astype('uint8'))
+
+
+def make_hparams(save_dir, version):
+    return {
+        'model_class': 'ae', 'model_type': 'linear', 'n_ae_latents': 4,
+        'n_input_channels': 1, 'y_pixels': N_PIX, 'x_pixels': N_PIX, 'device': 'cpu',
+        'rng_seed_model': 0, 'learning_rate': 1e-3, 'max_n_epochs': 2, 'min_n_epochs': 0,
+        'val_check_interval': 1, 'enable_early_stop': False, 'early_stop_history': 1,
+        'export_latents': False, 'checkpoint_interval': 0,
+        'expt_dir': os.path.join(save_dir, 'test'), 'version': version}
+
+
+def train(data_dir, hparams, exp=None):
+    """Fit a linear autoencoder; run by each process."""
+    sess_ids = [
+        {'lab': 'lab', 'expt': 'expt', 'animal': 'animal', 'session': 'sess%i' % s}
+        for s in range(N_SESSIONS)]
+    paths = [[os.path.join(data_dir, 'sess%i.hdf5' % s)] for s in range(N_SESSIONS)]
+    data_generator = ConcatSessionsGenerator(
+        data_dir, sess_ids, [['images']] * N_SESSIONS, [[None]] * N_SESSIONS, paths,
+        device='cpu')
+    torch.manual_seed(hparams['rng_seed_model'])
+    model = AE(hparams)
+    model.version = hparams['version']
+    if get_rank() > 0:
+        # different initialization on other ranks; overwritten by the weights of rank 0
+        for param in model.parameters():
+            param.data.normal_()
+    fit(hparams, model, data_generator, exp, method='ae')
+    torch.save(
+        model.state_dict(), os.path.join(hparams['expt_dir'], 'params_rank%i.pt' % get_rank()))
+
+
+def fit_model(tmp_path, data_dir, n_processes):
+    save_dir = str(tmp_path / ('fits_%i' % n_processes))
+    exp = Experiment(name='test', save_dir=save_dir)
+    hparams = make_hparams(save_dir, exp.version)
+    if n_processes > 1:
+        run_distributed(train, n_processes, args=(data_dir, hparams), main_kwargs={'exp': exp})
+    else:
+        train(data_dir, hparams, exp)
+    metrics = pd.read_csv(
+        os.path.join(hparams['expt_dir'], 'version_%i' % exp.version, 'metrics.csv'))
+    params = [
+        torch.load(os.path.join(hparams['expt_dir'], 'params_rank%i.pt' % rank))
+        for rank in range(n_processes)]
+    return metrics, params
+
+
+def test_run_distributed(tmp_path):
+
+    data_dir = str(tmp_path / 'data')
+    os.makedirs(data_dir)
+    for s in range(N_SESSIONS):
+        make_session(os.path.join(data_dir, 'sess%i.hdf5' % s), rng_seed=s)
+
+    metrics_1, _ = fit_model(tmp_path, data_dir, 1)
+    metrics_2, params_2 = fit_model(tmp_path, data_dir, 2)
+
+    # epoch 0 metrics are computed with the initial model, and summed over ranks
+    columns = ['dataset', 'tr_loss', 'val_loss']
+    epoch_0_1 = metrics_1[metrics_1.epoch == 0][columns].values.astype(float)
+    epoch_0_2 = metrics_2[metrics_2.epoch == 0][columns].values.astype(float)
+    assert epoch_0_1.shape == epoch_0_2.shape
+    assert np.allclose(epoch_0_1, epoch_0_2, rtol=1e-6, equal_nan=True)
+
+    # all ranks take the same optimizer steps
+    for key, value in params_2[0].items():
+        assert torch.equal(value, params_2[1][key])